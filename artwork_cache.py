@@ -0,0 +1,112 @@
+"""
+Two level cache of album artwork (see get_tk_photo in main.py).
+
+ - In memory: the last artwork shown, decoded and resized to THUMBNAIL_SIZE, up to a
+   number of bytes of pixels, least recently used first out.
+ - On disk: the downloaded files, named after (a hash of) their URL, so artwork shown
+   in an earlier session is not downloaded again.
+
+Artwork is downloaded and decoded on background threads (see fetch_cache.FetchCache),
+so callers can ask for the artwork of songs about to be shown ahead of time, and only
+ever wait for artwork that is not ready yet.
+"""
+from __future__ import annotations
+import hashlib
+import os
+import threading
+from concurrent.futures import Future
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+
+import http_client
+from fetch_cache import FetchCache
+
+# Where the downloaded artwork is kept, relative to the working directory
+DEFAULT_DIRECTORY = "artwork_cache"
+
+# Size every artwork is resized to, the size it is shown at
+THUMBNAIL_SIZE = (100, 100)
+
+# Largest number of bytes of decoded pixels kept in memory (about 650 thumbnails)
+DEFAULT_MEMORY_BYTES = 16 << 20
+
+# Threads downloading and decoding artwork
+_WORKERS = 4
+
+
+class ArtworkCache(FetchCache):
+    """
+    Cache of decoded artwork, by URL, in memory and (as downloaded) on disk.
+
+    attributes:
+     - directory : directory the downloaded files are kept in
+    """
+    directory: str
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, memory_bytes: int = DEFAULT_MEMORY_BYTES) -> None:
+        super().__init__(memory_bytes, _WORKERS, "artwork")
+        self.directory = directory
+
+    def fetch(self, url: str) -> Future:
+        """
+        Return a future of the artwork at url, decoded and resized to THUMBNAIL_SIZE.
+
+        The future is done right away if the artwork is in memory. Otherwise it is read
+        from disk, or downloaded (and saved to disk), in the background. The future
+        raises requests.RequestException if the download fails, or OSError if the file
+        is not an image.
+        """
+        return super().fetch(url)
+
+    def _load(self, url: str) -> Image.Image:
+        """Read (or download) and decode the artwork at url."""
+        image = Image.open(BytesIO(self._read(url)))
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        return image.resize(THUMBNAIL_SIZE, Image.LANCZOS)
+
+    def _bytes(self, image: Image.Image) -> int:
+        """Return the number of bytes taken by the pixels of a decoded image."""
+        return image.width * image.height * len(image.getbands())
+
+    def _read(self, url: str) -> bytes:
+        """Return the file at url, from disk if it was downloaded before."""
+        path = os.path.join(self.directory, hashlib.sha1(url.encode("UTF-8")).hexdigest())
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except OSError:
+            pass
+
+        response = http_client.get(url)
+        response.raise_for_status()
+        data = response.content
+
+        # Written under a temporary name and then moved, so a reader never sees half a file
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            pass  # Not being able to save only means it is downloaded again next session
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return data
+
+
+_cache: Optional[ArtworkCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_artwork_cache() -> ArtworkCache:
+    """Return the cache shared by the whole app, at DEFAULT_DIRECTORY, creating it on the first call."""
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = ArtworkCache()
+        return _cache
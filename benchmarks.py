@@ -0,0 +1,404 @@
+"""
+Benchmarks for the search structures in tracks.py, run from the command line:
+
+    python benchmarks.py build [sizes...]
+    python benchmarks.py query [sizes...]
+    python benchmarks.py search [sizes...]
+    python benchmarks.py recall [sizes...]
+    python benchmarks.py memory [sizes...]
+    python benchmarks.py metadata [sizes...]
+
+Data is random, uniformly distributed 8 dimensional points (the dimension of the
+feature vectors TrackList uses), so no dataset is needed. The metadata benchmark
+generates a random catalog shaped like the Spotify dataset instead.
+"""
+from __future__ import annotations
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from dataset_cache import load_dataset
+from filters import TrackAttributes
+from hnsw import HNSW
+from track_store import TrackStore
+from tracks import _ENGINES, _KDTree
+
+DIMENSIONS = 8
+
+
+def random_points(size: int, seed: int = 111) -> tuple[list[str], np.ndarray]:
+    """
+    Return the ids and features of size random points, in the form taken by the engines
+    (see search_index.SearchIndex): a matrix with one line per feature and one column
+    per point.
+    """
+    features = np.random.default_rng(seed).random((DIMENSIONS, size))
+    return [str(i) for i in range(size)], features
+
+
+def measure(function: Callable[[], object]) -> tuple[float, float]:
+    """
+    Call function twice and return the wall time (seconds) of the first call and the
+    peak memory (MiB) allocated during the second.
+
+    Memory is measured on a separate call since tracing allocations slows code down.
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak / 2 ** 20
+
+
+def benchmark_build(sizes: list[int]) -> None:
+    """
+    Print the build time and peak memory of _KDTree against the original build, which
+    sorted the points at every level and sliced them into sublists.
+    """
+    print(f"{'points':>10} {'build':>10} {'time (s)':>10} {'peak (MiB)':>12}")
+    for size in sizes:
+        data = random_points(size)
+        for name, build in (("sorting", lambda: _sorting_build(*data)), ("selection", lambda: _KDTree.build(*data))):
+            elapsed, peak = measure(build)
+            print(f"{size:>10} {name:>10} {elapsed:>10.2f} {peak:>12.1f}")
+
+
+def benchmark_query(sizes: list[int], queries: int = 200) -> None:
+    """
+    Print the mean latency of n_nearest_neighbours for every engine, for a small k (as
+    used by the playlist generator) and a large one (as used for radio style queues).
+    """
+    print(f"{'points':>10} {'engine':>14} {'k':>6} {'ms/query':>10}")
+    for size in sizes:
+        data = random_points(size)
+        targets = list(map(tuple, np.random.default_rng(0).random((queries, DIMENSIONS)).tolist()))
+        for name, engine in _ENGINES.items():
+            tree = engine.build(*data)
+            for k in (7, 500):
+                start = time.perf_counter()
+                for target in targets:
+                    tree.n_nearest_neighbours(target, k)
+                elapsed = (time.perf_counter() - start) / queries
+                print(f"{size:>10} {name:>14} {k:>6} {elapsed * 1000:>10.3f}")
+
+
+def benchmark_search(sizes: list[int], queries: int = 200) -> None:
+    """
+    Print the mean latency of _KDTree.n_nearest_neighbours against the original KD-Tree
+    (one object per node, searched recursively, see _OriginalKDTree), and check that
+    both find the same points.
+    """
+    print(f"{'points':>10} {'tree':>10} {'k':>6} {'ms/query':>10}")
+    for size in sizes:
+        data = random_points(size)
+        targets = list(map(tuple, np.random.default_rng(0).random((queries, DIMENSIONS)).tolist()))
+        trees = (("original", _OriginalKDTree(*data)), ("kdtree", _KDTree.build(*data)))
+        for k in (7, 100, 500):
+            found = []
+            for name, tree in trees:
+                start = time.perf_counter()
+                found.append([tree.n_nearest_neighbours(target, k) for target in targets])
+                elapsed = (time.perf_counter() - start) / queries
+                print(f"{size:>10} {name:>10} {k:>6} {elapsed * 1000:>10.3f}")
+            if found[0] != found[1]:
+                print(f"{size:>10} results differ for k={k}")
+
+
+def benchmark_recall(sizes: list[int], queries: int = 200, k: int = 7) -> None:
+    """
+    Print the recall (fraction of the true k nearest neighbours found) and mean latency
+    of HNSW for a range of ef_search values, against the exact results of _KDTree.
+    """
+    print(f"{'points':>10} {'engine':>8} {'ef_search':>10} {'recall':>8} {'ms/query':>10} {'build (s)':>10}")
+    for size in sizes:
+        data = random_points(size)
+        targets = list(map(tuple, np.random.default_rng(0).random((queries, DIMENSIONS)).tolist()))
+
+        start = time.perf_counter()
+        tree = _KDTree.build(*data)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        exact = [set(tree.n_nearest_neighbours(target, k)) for target in targets]
+        elapsed = (time.perf_counter() - start) / queries
+        print(f"{size:>10} {'kdtree':>8} {'-':>10} {1:>8.3f} {elapsed * 1000:>10.3f} {build:>10.2f}")
+
+        start = time.perf_counter()
+        graph = HNSW.build(*data)
+        build = time.perf_counter() - start
+        for ef_search in (8, 16, 32, 64, 128, 256):
+            graph.ef_search = ef_search
+            start = time.perf_counter()
+            found = [graph.n_nearest_neighbours(target, k) for target in targets]
+            elapsed = (time.perf_counter() - start) / queries
+            recall = sum(len(expected.intersection(ids)) for expected, ids in zip(exact, found)) / (queries * k)
+            print(f"{size:>10} {'hnsw':>8} {ef_search:>10} {recall:>8.3f} {elapsed * 1000:>10.3f} {build:>10.2f}")
+
+
+def benchmark_memory(sizes: list[int], queries: int = 200, k: int = 7) -> None:
+    """
+    Print, for every engine, the size of its saved index, the Python heap it keeps once
+    loaded (on top of the ids, rows and feature matrix it shares with the TrackList),
+    and how much of the memory-mapped index file is resident after a round of queries
+    from a cold start, all in bytes per point.
+    """
+    print(f"{'points':>10} {'engine':>14} {'file':>8} {'heap':>8} {'resident':>10} {'recall':>8}")
+    for size in sizes:
+        data = random_points(size)
+        targets = list(map(tuple, np.random.default_rng(0).random((queries, DIMENSIONS)).tolist()))
+        exact = [set(ids) for ids in map(_KDTree.build(*data).n_nearest_neighbours, targets, [k] * queries)]
+
+        options = [(name, engine, {}) for name, engine in _ENGINES.items()] + \
+            [("pq float32", _ENGINES["pq"], {"codec": "float32"})]
+        for name, engine, engine_options in options:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "index")
+                engine.build(*data, **engine_options).save(path, "benchmark")
+                _drop_cached(path)
+
+                ids, features = random_points(size)
+                rows = dict(zip(ids, range(size)))
+                tracemalloc.start()
+                index = engine.load(path, ids, features, "benchmark", rows, **engine_options)
+                heap = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+
+                found = [index.n_nearest_neighbours(target, k) for target in targets]
+                resident = _mapped_resident(path)
+                recall = sum(len(expected.intersection(ids)) for expected, ids in zip(exact, found)) / (queries * k)
+                print(f"{size:>10} {name:>14} {os.path.getsize(path) / size:>8.1f} {heap / size:>8.1f} "
+                      f"{'-' if resident is None else format(resident / size, '.1f'):>10} {recall:>8.3f}")
+                del index
+
+
+def benchmark_metadata(sizes: list[int]) -> None:
+    """
+    Print the Python heap, in bytes per track, taken by the metadata of a catalog of
+    every size: as one Track object per track with the fields as read from the CSV (as
+    TrackList used to keep it, along with the columns filters look at), and as a
+    TrackStore.
+
+    The catalog has as many distinct artists, albums and genres per track as the
+    Spotify dataset (about 31k artists, 46k albums and 114 genres for 114k tracks).
+    """
+    print(f"{'tracks':>10} {'objects':>10} {'store':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            dataset = os.path.join(directory, "dataset.csv")
+            _write_catalog(dataset, size)
+            columns = load_dataset(dataset)
+            # Every field of Track, as a string per track as read from the CSV
+            strings = {**columns.strings, **columns.interned,
+                       **{name: list(map(str, numbers)) for name, numbers in columns.numbers.items()}}
+            strings["explicit"] = [str(value == "1") for value in strings["explicit"]]
+
+            def as_objects() -> tuple:
+                tracks = {}
+                for track in zip(*(strings[name] for name in _DictTrack.__annotations__)):
+                    tracks[track[0]] = _DictTrack(*track)
+                attributes = TrackAttributes()
+                attributes.extend(strings["track_genre"], strings["explicit"], strings["popularity"],
+                                  strings["duration_ms"])
+                return list(strings["track_id"]), tracks, attributes
+
+            heaps = []
+            for load in (as_objects, lambda: TrackStore(columns)):
+                tracemalloc.start()
+                metadata = load()
+                heaps.append(tracemalloc.get_traced_memory()[0])
+                tracemalloc.stop()
+                del metadata
+            print(f"{size:>10} {heaps[0] / size:>10.1f} {heaps[1] / size:>10.1f}")
+            del columns, strings
+
+
+@dataclass
+class _DictTrack:
+    """Track as it was before it had slots, to measure how much memory it used."""
+    track_id: str
+    artists: str
+    album_name: str
+    track_name: str
+    popularity: int
+    duration_ms: int
+    explicit: bool
+    track_genre: str
+
+
+def _write_catalog(path: str, size: int, seed: int = 111) -> None:
+    """Write a random catalog of size tracks to a CSV file at path, in the format of the dataset."""
+    rng = random.Random(seed)
+    words = ["love", "night", "heart", "dance", "fire", "blue", "summer", "dream", "road", "light",
+             "city", "rain", "gold", "wild", "home", "star", "time", "girl", "world", "baby"]
+
+    def title() -> str:
+        return " ".join(rng.choice(words).capitalize() for _ in range(rng.randint(1, 4)))
+
+    artists = [";".join(f"{title()} {rng.randint(1, 999)}" for _ in range(rng.choice([1, 1, 1, 2, 3])))
+               for _ in range(max(1, size * 31 // 114))]
+    albums = [f"{title()} {rng.randint(1, 9999)}" for _ in range(max(1, size * 46 // 114))]
+    genres = [f"{title().lower()}-{i}" for i in range(114)]
+
+    with open(path, "w", encoding="UTF-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["", "track_id", "artists", "album_name", "track_name", "popularity", "duration_ms",
+                         "explicit", "danceability", "energy", "key", "loudness", "mode", "speechiness",
+                         "acousticness", "instrumentalness", "liveness", "valence", "tempo", "time_signature",
+                         "track_genre"])
+        for i in range(size):
+            writer.writerow([i, f"{i:022x}", rng.choice(artists), rng.choice(albums), title(), rng.randint(0, 100),
+                             rng.randint(30_000, 600_000), rng.choice(["True", "False"]),
+                             *(round(rng.random(), 4) for _ in range(2)), rng.randint(0, 11),
+                             round(-60 * rng.random(), 3), rng.randint(0, 1),
+                             *(round(rng.random(), 4) for _ in range(5)), round(60 + 140 * rng.random(), 3),
+                             rng.choice([3, 4, 4, 4, 5]), rng.choice(genres)])
+
+
+def _drop_cached(path: str) -> None:
+    """Ask the OS to drop the file at path from its page cache, where supported."""
+    if hasattr(os, "posix_fadvise"):
+        file = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(file, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(file)
+
+
+def _mapped_resident(path: str) -> Optional[int]:
+    """
+    Return the number of bytes of the file at path that are memory-mapped into this
+    process and resident, or None where /proc/self/smaps is not available.
+    """
+    try:
+        with open("/proc/self/smaps", "r") as smaps:
+            lines = smaps.read().splitlines()
+    except OSError:
+        return None
+
+    resident = 0
+    mapped = False
+    for line in lines:
+        if line[:1].isdigit() or line[:1] in "abcdef" and "-" in line.split(" ", 1)[0]:
+            mapped = line.rstrip().endswith(path)
+        elif mapped and line.startswith("Rss:"):
+            resident += int(line.split()[1]) * 1024
+    return resident
+
+
+def _sorting_build(ids: list[str], features: np.ndarray) -> dict[str, array]:
+    """
+    Build the node arrays of a _KDTree the way _KDTree originally did: recursively,
+    sorting the points of every subtree on its axis and slicing them in two.
+    """
+    vectors = list(map(tuple, features.T.tolist()))
+    size = len(vectors)
+    nodes = {
+        "point_index": array("q", bytes(8 * size)),
+        "split_axis": array("B", bytes(size)),
+        "split_value": array("d", bytes(8 * size)),
+        "left": array("q", bytes(8 * size)),
+        "right": array("q", bytes(8 * size)),
+    }
+
+    def _build_subtree(points, start, depth) -> int:
+        if not points:
+            return -1
+
+        axis = depth % len(vectors[0])
+        points.sort(key=lambda x: vectors[x][axis])
+        median = len(points) // 2
+        node = start + median
+
+        nodes["point_index"][node] = points[median]
+        nodes["split_axis"][node] = axis
+        nodes["split_value"][node] = vectors[points[median]][axis]
+        nodes["left"][node] = _build_subtree(points[:median], start, depth + 1)
+        nodes["right"][node] = _build_subtree(points[median + 1:], node + 1, depth + 1)
+
+        return node
+
+    _build_subtree(list(range(size)), 0, 0)
+    return nodes
+
+
+class _OriginalKDTree:
+    """
+    KD-Tree as _KDTree originally was, to compare searches against: one object per node,
+    searched recursively, keeping the best points so far in a sorted list.
+    """
+
+    def __init__(self, ids: list[str], features: np.ndarray) -> None:
+        self.root = self._build_tree(list(zip(ids, map(tuple, features.T.tolist()))), 0)
+
+    def _build_tree(self, points: list[tuple[str, tuple[float]]], depth: int) -> Optional[tuple]:
+        """Return the root of the subtree holding points, as (point, label, left, right)."""
+        if not points:
+            return None
+
+        axis = depth % len(points[0][1])
+        points.sort(key=lambda x: x[1][axis])
+        median = len(points) // 2
+        return (points[median][1], points[median][0],
+                self._build_tree(points[:median], depth + 1), self._build_tree(points[median + 1:], depth + 1))
+
+    def n_nearest_neighbours(self, target: tuple[float], n: int) -> list[str]:
+        """Return the ids of the n points closest to target, closest first."""
+        neighbors = []
+
+        def _search(node, depth):
+            if node is None:
+                return
+
+            point, label, left, right = node
+            k = len(target)
+            axis = depth % k
+
+            dist_sq = sum((point[i] - target[i]) ** 2 for i in range(k))
+
+            if len(neighbors) < n:
+                neighbors.append((label, dist_sq))
+                neighbors.sort(key=lambda x: x[1])
+            elif dist_sq < neighbors[-1][1]:
+                neighbors[-1] = (label, dist_sq)
+                neighbors.sort(key=lambda x: x[1])
+
+            next_branch = left if target[axis] < point[axis] else right
+            alt_branch = right if target[axis] < point[axis] else left
+
+            _search(next_branch, depth + 1)
+            if abs(point[axis] - target[axis]) ** 2 < neighbors[-1][1]:
+                _search(alt_branch, depth + 1)
+
+        _search(self.root, 0)
+        return [label for label, x in neighbors]
+
+
+BENCHMARKS = {
+    "build": (benchmark_build, [100_000, 1_000_000, 5_000_000]),
+    "query": (benchmark_query, [100_000, 1_000_000]),
+    "search": (benchmark_search, [5_000, 100_000]),
+    "recall": (benchmark_recall, [10_000, 100_000]),
+    "memory": (benchmark_memory, [100_000, 1_000_000]),
+    "metadata": (benchmark_metadata, [114_000, 1_000_000]),
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"usage: python benchmarks.py {{{','.join(BENCHMARKS)}}} [sizes...]")
+        sys.exit(1)
+
+    benchmark, default_sizes = BENCHMARKS[sys.argv[1]]
+    benchmark([int(size) for size in sys.argv[2:]] or default_sizes)
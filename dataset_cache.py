@@ -0,0 +1,290 @@
+"""
+Compiled, binary form of the Spotify dataset used by TrackList.
+
+Parsing dataset.csv (and calling float() eight times per row) dominates start up time,
+so the first time a dataset is loaded it is compiled into a columnar cache file next
+to it. Later runs memory-map the cache instead of parsing the CSV again.
+
+The cache holds:
+ - the feature columns (every numeric column of the CSV), each as a contiguous array
+   of doubles, back to back so that together they form one (feature, track) matrix
+ - popularity, duration and explicit, each as an array of integers
+ - artists and genres interned: a string table of the distinct values, and an array of
+   the code (index in that table) of every track
+ - a string table (offsets + UTF-8 blob) for each other metadata column
+
+so that TrackStore (see track_store.py) copies its columns straight from the cache,
+without parsing or interning anything.
+
+The cache remembers the size and hash of the CSV it was built from and is rebuilt
+automatically whenever the CSV changes.
+"""
+from __future__ import annotations
+import csv
+import hashlib
+import os
+from array import array
+from typing import Iterable, Iterator, Optional
+
+from storage import open_sections, write_sections
+
+CACHE_VERSION = 4
+
+# CSV column index of every feature stored in the cache, in order. The features tracks
+# are compared by by default (see DEFAULT_FEATURES) come first, so that they form one
+# contiguous (feature, track) matrix.
+FEATURE_COLUMNS = {
+    "danceability": 8,
+    "energy": 9,
+    "loudness": 11,
+    "speechiness": 13,
+    "acousticness": 14,
+    "instrumentalness": 15,
+    "liveness": 16,
+    "valence": 17,
+    "key": 10,
+    "mode": 12,
+    "tempo": 18,
+    "time_signature": 19,
+}
+
+# Features TrackList compares tracks by, unless given other feature sets (see metrics.py)
+DEFAULT_FEATURES = ("danceability", "energy", "loudness", "speechiness", "acousticness",
+                    "instrumentalness", "liveness", "valence")
+
+# CSV column index of every metadata column stored in the cache as a string table, named
+# after the fields of Track
+STRING_COLUMNS = {
+    "track_id": 1,
+    "album_name": 3,
+    "track_name": 4,
+}
+
+# CSV column index and array type code of every metadata column stored as integers,
+# named after the fields of Track (explicit is 1 for "True" and 0 for "False")
+NUMBER_COLUMNS = {
+    "popularity": (5, "q"),
+    "duration_ms": (6, "q"),
+    "explicit": (7, "b"),
+}
+
+# CSV column index of every metadata column stored interned, named after the fields of
+# Track. Many tracks share the same value of these columns.
+INTERNED_COLUMNS = {
+    "artists": 2,
+    "track_genre": 20,
+}
+
+
+class StringTable:
+    """
+    Read-only sequence of strings stored as one UTF-8 blob plus an offsets array.
+
+    attributes:
+     - _offsets : offsets[i]:offsets[i + 1] is the byte range of string i in _blob
+     - _blob : every string encoded in UTF-8, back to back
+
+    representation invariants:
+     - len(self._offsets) >= 1
+    """
+    _offsets: memoryview
+    _blob: memoryview
+
+    def __init__(self, offsets: memoryview, blob: memoryview) -> None:
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], "UTF-8")
+
+    def __iter__(self) -> Iterator[str]:
+        blob = self._blob.tobytes()
+        offsets = self._offsets
+        for i in range(len(offsets) - 1):
+            yield str(blob[offsets[i]:offsets[i + 1]], "UTF-8")
+
+
+class InternedColumn:
+    """
+    Read-only sequence of strings, many of them equal, stored as the table of the
+    distinct strings plus the code of every entry in that table.
+
+    attributes:
+     - values : every distinct string, by code, in order of first appearance
+     - codes : code of every entry
+
+    representation invariants:
+     - 0 <= codes[i] < len(values)
+    """
+    values: StringTable
+    codes: memoryview
+
+    def __init__(self, values: StringTable, codes: memoryview) -> None:
+        self.values = values
+        self.codes = codes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, index: int) -> str:
+        return self.values[self.codes[index]]
+
+    def __iter__(self) -> Iterator[str]:
+        values = list(self.values)
+        return (values[code] for code in self.codes)
+
+
+class TrackColumns:
+    """
+    Columnar view of a dataset, as stored in the cache.
+
+    attributes:
+     - features : maps feature name to a contiguous array of doubles, one per track
+     - matrix : every feature column, back to back, as a contiguous array of doubles
+     - strings : maps the name of every column of STRING_COLUMNS to a StringTable, one
+       entry per track
+     - numbers : maps the name of every column of NUMBER_COLUMNS to an array of
+       integers, one per track
+     - interned : maps the name of every column of INTERNED_COLUMNS to an
+       InternedColumn, one entry per track
+     - digest : hash of the CSV file the columns were built from
+
+    representation invariants:
+     - every column in features, strings, numbers and interned has the same length
+     - the entries of strings["track_id"] are unique
+    """
+    features: dict[str, memoryview]
+    matrix: memoryview
+    strings: dict[str, StringTable]
+    numbers: dict[str, memoryview]
+    interned: dict[str, InternedColumn]
+    digest: str
+
+    def __init__(self, sections: dict[str, memoryview], digest: str) -> None:
+        self.matrix = sections["features"]
+        size = len(self.matrix) // len(FEATURE_COLUMNS)
+        self.features = {name: self.matrix[i * size:(i + 1) * size]
+                         for i, name in enumerate(FEATURE_COLUMNS)}
+        self.strings = {name: StringTable(sections[name + ".offsets"], sections[name])
+                        for name in STRING_COLUMNS}
+        self.numbers = {name: sections[name] for name in NUMBER_COLUMNS}
+        self.interned = {name: InternedColumn(StringTable(sections[name + ".offsets"], sections[name]),
+                                              sections[name + ".codes"])
+                         for name in INTERNED_COLUMNS}
+        self.digest = digest
+
+    def __len__(self) -> int:
+        return len(self.strings["track_id"])
+
+
+def load_dataset(dataset: str, cache_path: Optional[str] = None, digest: Optional[str] = None) -> TrackColumns:
+    """
+    Return the columns of the given dataset, compiling its cache file first if the
+    cache is missing or was built from a different version of the CSV.
+
+    By default the cache lives next to the CSV, at dataset + ".cache". If the digest of
+    the CSV (see file_digest) is already known, e.g. from the TrackColumns of another
+    process, a cache built from it is mapped without reading the CSV again.
+
+    Preconditions:
+        - dataset must be a valid path to a CSV file in the format described in
+          TrackList.__init__.
+    """
+    if cache_path is None:
+        cache_path = dataset + ".cache"
+
+    size = os.path.getsize(dataset)
+    if digest is not None:
+        columns = _open_cache(cache_path, size, digest)
+        if columns is not None:
+            return columns
+
+    digest = file_digest(dataset)
+    columns = _open_cache(cache_path, size, digest)
+    if columns is not None:
+        return columns
+
+    sections = _compile(dataset)
+    meta = {"version": CACHE_VERSION, "source_size": size, "source_digest": digest}
+    try:
+        write_sections(cache_path, meta, sections)
+    except OSError:
+        # We can still run without a cache, it just means the next start is slow too
+        return TrackColumns({name: memoryview(data) for name, data in sections.items()}, digest)
+
+    return TrackColumns(open_sections(cache_path)[1], digest)
+
+
+def _open_cache(cache_path: str, size: int, digest: str) -> Optional[TrackColumns]:
+    """
+    Return the columns in the cache file at cache_path, or None if there is no such file
+    or it was not built from a CSV of the given size and digest by this version.
+    """
+    cached = open_sections(cache_path)
+    if cached is None:
+        return None
+
+    meta, sections = cached
+    if meta.get("version") == CACHE_VERSION and meta.get("source_size") == size \
+            and meta.get("source_digest") == digest:
+        return TrackColumns(sections, digest)
+    return None
+
+
+def file_digest(path: str) -> str:
+    """Return a hex digest of the contents of the file at path."""
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _compile(dataset: str) -> dict[str, array | bytes]:
+    """
+    Parse the CSV at dataset and return the sections of its cache file.
+
+    Tracks are listed once per genre in the dataset; like a dictionary keyed on
+    track_id, each track keeps the position of its first row and the values of its last.
+    """
+    rows = {}
+    with open(dataset, "r", encoding="UTF-8") as data:
+        track_reader = csv.reader(data)
+
+        next(track_reader)
+
+        for track in track_reader:
+            rows[track[1]] = track
+
+    sections = {"features": array("d")}
+    for column in FEATURE_COLUMNS.values():
+        sections["features"].extend(float(row[column]) for row in rows.values())
+
+    for name, column in STRING_COLUMNS.items():
+        sections[name + ".offsets"], sections[name] = encode_strings(row[column] for row in rows.values())
+
+    for name, (column, typecode) in NUMBER_COLUMNS.items():
+        if name == "explicit":
+            sections[name] = array(typecode, (row[column] == "True" for row in rows.values()))
+        else:
+            sections[name] = array(typecode, (int(row[column]) for row in rows.values()))
+
+    for name, column in INTERNED_COLUMNS.items():
+        codes = {}
+        sections[name + ".codes"] = array("i", (codes.setdefault(row[column], len(codes)) for row in rows.values()))
+        sections[name + ".offsets"], sections[name] = encode_strings(codes)
+
+    return sections
+
+
+def encode_strings(strings: Iterable[str]) -> tuple[array, bytes]:
+    """Return the offsets and blob of a StringTable holding the given strings, in order."""
+    offsets = array("q", [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string.encode("UTF-8")
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
@@ -8,11 +8,13 @@ from dataclasses import dataclass
 from typing import Any, Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class Track:
     """
     Represents a musical track with associated metadata.
 
+    Tracks have no __dict__ (see slots), as many of them can be alive at once.
+
     Attributes:
         track_id: A unique identifier for the track.
         artists: The artist or artists performing the track.
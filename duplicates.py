@@ -0,0 +1,292 @@
+"""
+Groups of tracks that are the same song released several times.
+
+The Spotify dataset lists the same song under several track ids, once per album or
+single it was released on (on top of listing each track id once per genre). Two
+tracks are considered the same song when they have the same title and artists once
+normalized (see normalize_title and normalize_artists) and their feature vectors are
+within DUPLICATE_DISTANCE of each other, chaining: if a is a duplicate of b and b of c,
+all three are one group.
+
+Every group has one representative, the first (by row) of its tracks still in the
+TrackList, and a distinct search only ever returns representatives, so it never
+returns the same song twice.
+
+Grouping every track of the dataset takes a few seconds, so the groups are saved (see
+DuplicateGroups.save) and loaded back on later runs, until the dataset changes.
+"""
+from __future__ import annotations
+import re
+import unicodedata
+from array import array
+from typing import Callable, Iterable, Optional, Sequence
+
+import numpy as np
+
+from dataset_cache import StringTable, encode_strings
+from storage import open_sections, write_sections
+
+# Bumped whenever the layout of saved groups, or how tracks are grouped, changes
+_GROUPS_VERSION = 1
+
+# Largest (euclidean) distance between the feature vectors of two releases of one song
+DUPLICATE_DISTANCE = 0.01
+
+# Parts of a title that tell releases apart, e.g. "(Remastered 2011)", "[Live]", "- Radio Edit"
+_TITLE_SUFFIXES = re.compile(r"\s*(\([^)]*\)|\[[^\]]*\]|\s-\s.*$)")
+_NOT_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_title(title: str) -> str:
+    """
+    Return title without case, accents, punctuation or release details.
+
+    >>> normalize_title("Hallelujah - Remastered 2011")
+    'hallelujah'
+    >>> normalize_title("Café del Mar (Radio Edit)")
+    'cafe del mar'
+    """
+    title = _TITLE_SUFFIXES.sub("", title)
+    return simplify(title)
+
+
+def normalize_artists(artists: str) -> str:
+    """
+    Return the artists (separated by ";" in the dataset) without case, accents or
+    punctuation, in a fixed order.
+
+    >>> normalize_artists("Simon & Garfunkel;Paul Simon")
+    'paul simon;simon garfunkel'
+    """
+    return ";".join(sorted(simplify(artist) for artist in artists.split(";")))
+
+
+def simplify(text: str) -> str:
+    """
+    Return text casefolded, without accents and with runs of punctuation and spaces as one space.
+
+    >>> simplify("  Beyoncé -- Crazy in Love!")
+    'beyonce crazy in love'
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _NOT_WORD.sub(" ", text).strip()
+
+
+class DuplicateGroups:
+    """
+    Duplicate groups of the tracks of a TrackList, by row.
+
+    Groups are identified by the first row ever put in them. Only groups that held two or
+    more tracks at some point are stored in members and representative; any other track
+    is alone in its group, and its own representative.
+
+    attributes:
+     - group : group of every row (-1 for rows that were never added or were removed)
+     - members : rows still in each group that held two or more tracks, in order
+     - representative : current representative of each of those groups that is not empty
+     - _songs : normalized title and normalized artists of every song, joined by a newline
+     - _song : song (index in _songs) of every row the groups were first made from, or -1
+     - _first_group : group of every row the groups were first made from, before any
+       removal
+     - _by_song : maps (normalized title, normalized artists) to the groups of that song,
+       or None until it is first needed (see add)
+     - _get_point : returns the feature vector of a row
+
+    representation invariants:
+     - for every group g in members with members[g] != [], representative[g] == members[g][0]
+     - len(_song) == len(_first_group)
+    """
+    group: array
+    members: dict[int, list[int]]
+    representative: dict[int, int]
+    _songs: Sequence[str]
+    _song: Sequence[int]
+    _first_group: Sequence[int]
+    _by_song: Optional[dict[tuple[str, str], list[int]]]
+    _get_point: Callable[[int], Iterable[float]]
+
+    def __init__(self, rows: Iterable[int], titles: Iterable[str], artists: Iterable[str],
+                 get_point: Callable[[int], Iterable[float]]) -> None:
+        """
+        Group the tracks on the given rows, with the given titles and artists.
+
+        Titles and artists are normalized once per distinct value, so passing the same
+        string objects for tracks that share their artists (as TrackStore does) is cheap.
+
+        Preconditions:
+            - rows, titles and artists have the same length, and rows is increasing.
+        """
+        self.group = array("q")
+        self.members = {}
+        self.representative = {}
+        self._song = array("i")
+        self._by_song = {}
+        self._get_point = get_point
+
+        normalized_titles, normalized_artists = {}, {}
+        songs = {}
+        for row, title, artist in zip(rows, titles, artists):
+            normalized_title = normalized_titles.get(title)
+            if normalized_title is None:
+                normalized_title = normalized_titles[title] = normalize_title(title)
+            normalized_artist = normalized_artists.get(artist)
+            if normalized_artist is None:
+                normalized_artist = normalized_artists[artist] = normalize_artists(artist)
+
+            song_rows = songs.setdefault((normalized_title, normalized_artist), [])
+            song_rows.append(row)
+            self._grow(row)
+            self._song.extend([-1] * (row + 1 - len(self._song)))
+            self._song[row] = len(songs) - 1 if len(song_rows) == 1 else self._song[song_rows[0]]
+
+        for song, song_rows in songs.items():
+            if len(song_rows) == 1:
+                self.group[song_rows[0]] = song_rows[0]
+                self._by_song[song] = song_rows
+                continue
+
+            points = np.array([list(get_point(row)) for row in song_rows], dtype=np.float64)
+            groups = self._by_song[song] = []
+            for members in _linked(points, DUPLICATE_DISTANCE):
+                members = [song_rows[i] for i in members]
+                groups.append(members[0])
+                for row in members:
+                    self.group[row] = members[0]
+                if len(members) > 1:
+                    self.members[members[0]] = members
+                    self.representative[members[0]] = members[0]
+
+        self._songs = [f"{title}\n{artists}" for title, artists in songs]
+        self._first_group = array("q", self.group)
+
+    @classmethod
+    def load(cls, path: str, key: str, get_point: Callable[[int], Iterable[float]]) -> Optional[DuplicateGroups]:
+        """
+        Return the groups saved at path, or None if there is no such file or it was saved
+        under a different key, in which case the groups have to be made again.
+        """
+        opened = open_sections(path)
+        if opened is None:
+            return None
+        meta, sections = opened
+        if meta.get("version") != _GROUPS_VERSION or meta.get("key") != key:
+            return None
+
+        groups = cls.__new__(cls)
+        groups.group = array("q")
+        groups.group.frombytes(sections["group"].cast("B"))
+        groups._songs = StringTable(sections["songs.offsets"], sections["songs"])
+        groups._song = sections["song"]
+        groups._first_group = sections["group"]
+        groups._by_song = None
+        groups._get_point = get_point
+
+        # Rows of the groups of two or more tracks, in order, one group after the other
+        group = np.frombuffer(sections["group"], dtype=np.int64)
+        order = np.argsort(group, kind="stable")
+        starts = np.flatnonzero(np.diff(group[order], prepend=-2))
+        sizes = np.diff(starts, append=len(order))
+        groups.members = {}
+        for start, size in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+            members = order[start:start + size].tolist()
+            if group[members[0]] >= 0:
+                groups.members[members[0]] = members
+        groups.representative = {first: first for first in groups.members}
+        return groups
+
+    def save(self, path: str, key: str) -> None:
+        """
+        Save these groups to path, under the given key.
+
+        key should identify the tracks and feature vectors the groups were made from
+        (e.g. the digest of the dataset), so that load can tell when they are out of date.
+
+        Preconditions:
+            - No track was added or removed since the groups were made.
+        """
+        offsets, blob = encode_strings(self._songs)
+        write_sections(path, {"version": _GROUPS_VERSION, "key": key},
+                       {"group": self.group, "song": self._song, "songs.offsets": offsets, "songs": blob})
+
+    def is_representative(self, row: int) -> bool:
+        """Return whether the track on row represents its group."""
+        group = self.group[row]
+        return self.representative.get(group, row) == row
+
+    def add(self, row: int, title: str, artists: str) -> None:
+        """
+        Add the track on row, with the given title and artists, to the group of the same
+        song it is a duplicate of, or to a new group.
+
+        Preconditions:
+            - row is larger than every row added so far.
+        """
+        self._grow(row)
+        song = (normalize_title(title), normalize_artists(artists))
+        point = np.array(list(self._get_point(row)), dtype=np.float64)
+
+        if self._by_song is None:
+            self._by_song = self._songs_by_key()
+        for group in self._by_song.get(song, []):
+            # A group of one track that was removed has no members left
+            members = self.members.get(group, [group] if self.group[group] == group else [])
+            for member in members:
+                if np.sum((np.array(list(self._get_point(member))) - point) ** 2) <= DUPLICATE_DISTANCE ** 2:
+                    self.group[row] = group
+                    self.members[group] = members + [row]
+                    self.representative[group] = self.members[group][0]
+                    return
+
+        self.group[row] = row
+        self._by_song.setdefault(song, []).append(row)
+
+    def remove(self, row: int) -> None:
+        """Remove the track on row from its group, picking a new representative if needed."""
+        group = self.group[row]
+        self.group[row] = -1
+
+        members = self.members.get(group)
+        if members is not None and row in members:
+            members.remove(row)
+            if members:
+                self.representative[group] = members[0]
+            else:
+                del self.representative[group]
+
+    def _songs_by_key(self) -> dict[tuple[str, str], list[int]]:
+        """Return the groups of every song the groups were first made from, by song, from _song."""
+        songs = list(self._songs)
+        by_song = {}
+        for row, (song, group) in enumerate(zip(self._song, self._first_group)):
+            # Groups are listed in order of their first row, as when they were made
+            if group == row:
+                title, artists = songs[song].split("\n")
+                by_song.setdefault((title, artists), []).append(row)
+        return by_song
+
+    def _grow(self, row: int) -> None:
+        """Make room in group for rows up to row."""
+        if len(self.group) <= row:
+            self.group.extend([-1] * (row + 1 - len(self.group)))
+
+
+def _linked(points: np.ndarray, distance: float) -> list[list[int]]:
+    """
+    Return the groups of points (given by index, in order, groups ordered by their
+    first point) linked by chains of points within distance of each other.
+    """
+    difference = points[:, None] - points[None]
+    close = np.einsum("ijk,ijk->ij", difference, difference) <= distance ** 2
+
+    group = list(range(len(points)))
+    for i in range(len(points)):
+        for j in np.flatnonzero(close[i, :i]).tolist():
+            # Merge the group of j into the group of i, keeping the smallest label
+            old, new = max(group[i], group[j]), min(group[i], group[j])
+            group = [new if g == old else g for g in group]
+
+    groups = {}
+    for i, g in enumerate(group):
+        groups.setdefault(g, []).append(i)
+    return list(groups.values())
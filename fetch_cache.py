@@ -0,0 +1,113 @@
+"""
+In-memory cache of values loaded in the background, shared by the artwork and preview
+caches (see artwork_cache.py and preview_cache.py).
+
+Values are loaded on background threads (see FetchCache.fetch), once however many
+times they are asked for while loading ("single flight"), and the last values loaded
+are kept in memory up to a number of bytes, least recently used first out.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+
+class FetchCache:
+    """
+    Cache of values loaded in the background by key (e.g. URL), kept in memory up to a
+    number of bytes.
+
+    This is an abstract class: subclasses load values with _load, and tell how many
+    bytes they take with _bytes.
+
+    attributes:
+     - memory_bytes : largest number of bytes of values kept in memory
+     - size : number of bytes of values in memory
+     - _values : maps key to its value, least recently used first
+     - _pending : maps the key of every value being loaded to its future value
+     - _executor : threads loading values
+     - _lock : held while reading or updating _values, size or _pending
+
+    representation invariants:
+     - size == sum of _bytes(value) for every value in _values.values()
+     - size <= memory_bytes, unless _values holds a single value
+    """
+    memory_bytes: int
+    size: int
+    _values: OrderedDict[str, Any]
+    _pending: dict[str, Future]
+    _executor: ThreadPoolExecutor
+    _lock: threading.Lock
+
+    def __init__(self, memory_bytes: int, workers: int, thread_name_prefix: str) -> None:
+        """
+        Initialize an empty cache loading values on the given number of threads.
+
+        Preconditions:
+            - memory_bytes >= 0
+            - workers >= 1
+        """
+        self.memory_bytes = memory_bytes
+        self.size = 0
+        self._values = OrderedDict()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+
+    def fetch(self, key: str) -> Future:
+        """
+        Return a future of the value of key.
+
+        The future is done right away if the value is in memory. Otherwise it is loaded
+        in the background, and raises whatever _load raised if loading fails.
+        """
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+                future = Future()
+                future.set_result(value)
+                return future
+
+            # Load each value once, however many times it is asked for in the meantime
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self._executor.submit(self._fetch, key)
+            return future
+
+    def get(self, key: str) -> Any:
+        """Return the value of key, waiting for it if needed (see fetch)."""
+        return self.fetch(key).result()
+
+    def prefetch(self, key: str) -> None:
+        """Start loading the value of key in the background, if it is not in memory yet."""
+        self.fetch(key)
+
+    def _fetch(self, key: str) -> Any:
+        """Load the value of key and keep it in memory."""
+        try:
+            value = self._load(key)
+            self._remember(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def _remember(self, key: str, value: Any) -> None:
+        """Keep value in memory, dropping the least recently used ones to make room."""
+        with self._lock:
+            if key in self._values:
+                self.size -= self._bytes(self._values.pop(key))
+            self._values[key] = value
+            self.size += self._bytes(value)
+            while self.size > self.memory_bytes and len(self._values) > 1:
+                self.size -= self._bytes(self._values.popitem(last=False)[1])
+
+    def _load(self, key: str) -> Any:
+        """Return the value of key, loaded from wherever it comes from. Called on a background thread."""
+        raise NotImplementedError
+
+    def _bytes(self, value: Any) -> int:
+        """Return the number of bytes of memory taken by value."""
+        raise NotImplementedError
@@ -0,0 +1,323 @@
+"""
+Filters for similarity searches: only return tracks of some genres, explicit or clean
+tracks, tracks within a popularity or duration range, tracks not in a given set, or
+only one release of every song (see duplicates.py).
+
+Filters are checked while searching rather than on the results, so a search for k
+tracks always returns k tracks that pass (as long as there are that many). _KDTree also
+keeps a summary of every subtree (which genres it holds, its popularity and duration
+ranges, whether it holds explicit and clean tracks), so it can skip whole subtrees in
+which no track passes.
+"""
+from __future__ import annotations
+from array import array
+from typing import Collection, Iterable, Optional, Sequence
+
+import numpy as np
+
+from datatypes import Track
+from duplicates import DuplicateGroups
+
+# Bits per word of a genre bitmask
+_WORD = 64
+
+
+class TrackAttributes:
+    """
+    The metadata filters look at, for every row of a TrackList, in columns.
+
+    attributes:
+     - genres : name of every genre, by code
+     - genre_codes : maps genre name to its code
+     - genre : genre code of every row
+     - explicit : 1 for every explicit row, 0 for every other
+     - popularity : popularity of every row
+     - duration_ms : duration of every row
+
+    representation invariants:
+     - len(genre) == len(explicit) == len(popularity) == len(duration_ms)
+     - genre_codes[genres[i]] == i
+    """
+    genres: list[str]
+    genre_codes: dict[str, int]
+    genre: array
+    explicit: array
+    popularity: array
+    duration_ms: array
+
+    def __init__(self) -> None:
+        self.genres = []
+        self.genre_codes = {}
+        self.genre = array("i")
+        self.explicit = array("b")
+        self.popularity = array("q")
+        self.duration_ms = array("q")
+
+    def __len__(self) -> int:
+        return len(self.genre)
+
+    def extend(self, genres: Iterable[str], explicit: Iterable[str], popularity: Iterable[str],
+               duration_ms: Iterable[str]) -> None:
+        """
+        Append rows, given as one iterable per column of values as written in the
+        dataset (e.g. "True" for explicit, "73" for popularity).
+        """
+        self.genre.extend(map(self._genre_code, genres))
+        self.explicit.extend(value == "True" for value in map(str, explicit))
+        self.popularity.extend(map(int, popularity))
+        self.duration_ms.extend(map(int, duration_ms))
+
+    def extend_columns(self, genres: Sequence[str], genre: memoryview, explicit: memoryview,
+                       popularity: memoryview, duration_ms: memoryview) -> None:
+        """
+        Append rows, given as typed columns as stored in the dataset cache (see
+        dataset_cache.TrackColumns): the code of the genre of every row in genres, 1 for
+        every explicit row and 0 for every other, and the popularity and duration of
+        every row. Columns are copied as they are, without converting every value, when
+        the codes of genres are already the ones of this object.
+        """
+        codes = [self._genre_code(name) for name in genres]
+        if codes == list(range(len(codes))):
+            self.genre.frombytes(genre.cast("B"))
+        else:
+            self.genre.extend(codes[code] for code in genre)
+        self.explicit.frombytes(explicit.cast("B"))
+        self.popularity.frombytes(popularity.cast("B"))
+        self.duration_ms.frombytes(duration_ms.cast("B"))
+
+    def _genre_code(self, name: str) -> int:
+        """Return the code of the genre with the given name, adding it if it is new."""
+        code = self.genre_codes.get(name)
+        if code is None:
+            code = self.genre_codes[name] = len(self.genres)
+            self.genres.append(name)
+        return code
+
+    def append(self, track: Track) -> None:
+        """Append the row of the given track."""
+        self.extend([track.track_genre], [track.explicit], [track.popularity], [track.duration_ms])
+
+
+class TrackFilter:
+    """
+    Conditions tracks must meet to be returned by a similarity search. Conditions left
+    as None are not checked.
+
+    attributes:
+     - genres : names of the accepted genres
+     - explicit : True for explicit tracks only, False for clean tracks only
+     - popularity : (lowest, highest) accepted popularity, inclusive
+     - duration_ms : (shortest, longest) accepted duration, inclusive
+     - excluded_ids : ids of tracks never to return
+     - distinct : whether to only accept the representative of every duplicate group
+    """
+    genres: Optional[frozenset[str]]
+    explicit: Optional[bool]
+    popularity: Optional[tuple[int, int]]
+    duration_ms: Optional[tuple[int, int]]
+    excluded_ids: Collection[str]
+    distinct: bool
+
+    def __init__(self, genres: Optional[Iterable[str]] = None, explicit: Optional[bool] = None,
+                 popularity: Optional[tuple[int, int]] = None, duration_ms: Optional[tuple[int, int]] = None,
+                 excluded_ids: Collection[str] = frozenset(), distinct: bool = False) -> None:
+        self.genres = None if genres is None else frozenset(genres)
+        self.explicit = explicit
+        self.popularity = popularity
+        self.duration_ms = duration_ms
+        self.excluded_ids = excluded_ids
+        self.distinct = distinct
+
+    def is_empty(self) -> bool:
+        """Return whether every track passes this filter."""
+        return self.genres is None and self.explicit is None and self.popularity is None \
+            and self.duration_ms is None and not self.excluded_ids and not self.distinct
+
+    def key(self) -> tuple:
+        """
+        Return a hashable key telling this filter apart from others, for caching the
+        results of searches. excluded_ids are not part of the key.
+        """
+        genres = None if self.genres is None else tuple(sorted(self.genres))
+        return genres, self.explicit, self.popularity, self.duration_ms, self.distinct
+
+    def bind(self, attributes: TrackAttributes, rows: dict[str, int],
+             duplicates: Optional[DuplicateGroups] = None) -> BoundFilter:
+        """
+        Return this filter, ready to check the tracks of the TrackList with the given
+        attributes, map from id to row and (if distinct is set) duplicate groups.
+        """
+        return BoundFilter(self, attributes, rows, duplicates)
+
+
+class BoundFilter:
+    """
+    A TrackFilter checking the tracks of one TrackList.
+
+    A BoundFilter holds the ids of the tracks that fail the filter (as in
+    `track_id in bound_filter`), so it can be given to search engines as their
+    excluded ids. Tracks that are not in the TrackList (anymore) always fail.
+
+    attributes:
+     - track_filter : the conditions checked
+     - attributes : metadata of every row of the TrackList
+     - rows : maps the id of every track in the TrackList to its row
+     - duplicates : duplicate groups of the TrackList, if distinct is set
+     - genre_mask : for every word of a genre bitmask, the bits of the accepted genres,
+       or None if genres are not checked
+    """
+    track_filter: TrackFilter
+    attributes: TrackAttributes
+    rows: dict[str, int]
+    duplicates: Optional[DuplicateGroups]
+    genre_mask: Optional[list[int]]
+
+    def __init__(self, track_filter: TrackFilter, attributes: TrackAttributes, rows: dict[str, int],
+                 duplicates: Optional[DuplicateGroups] = None) -> None:
+        self.track_filter = track_filter
+        self.attributes = attributes
+        self.rows = rows
+        self.duplicates = duplicates
+
+        self.genre_mask = None
+        if track_filter.genres is not None:
+            mask = 0
+            for name in track_filter.genres:
+                if name in attributes.genre_codes:
+                    mask |= 1 << attributes.genre_codes[name]
+            self.genre_mask = [(mask >> (_WORD * word)) & (2 ** _WORD - 1)
+                               for word in range(_words(len(attributes.genres)))]
+
+    def __contains__(self, track_id: str) -> bool:
+        """Return whether the track associated with track_id fails the filter."""
+        row = self.rows.get(track_id)
+        return row is None or track_id in self.track_filter.excluded_ids or not self.accepts(row)
+
+    def accepts(self, row: int) -> bool:
+        """Return whether the track on the given row passes the conditions on its metadata."""
+        track_filter, attributes = self.track_filter, self.attributes
+        if track_filter.genres is not None and attributes.genres[attributes.genre[row]] not in track_filter.genres:
+            return False
+        if track_filter.explicit is not None and bool(attributes.explicit[row]) != track_filter.explicit:
+            return False
+        if track_filter.popularity is not None \
+                and not track_filter.popularity[0] <= attributes.popularity[row] <= track_filter.popularity[1]:
+            return False
+        if track_filter.duration_ms is not None \
+                and not track_filter.duration_ms[0] <= attributes.duration_ms[row] <= track_filter.duration_ms[1]:
+            return False
+        if track_filter.distinct and not self.duplicates.is_representative(row):
+            return False
+        return True
+
+    def node_rows(self, labels: list[str], point_index: Iterable[int]) -> np.ndarray:
+        """
+        Return the row of the track held by every node of a tree, or -1 for tracks no
+        longer in the TrackList, given the ids of the tree's points and the index (into
+        labels) of the point held by every node.
+        """
+        rows = self.rows
+        label_rows = np.array([rows.get(label, -1) for label in labels], dtype=np.int64)
+        return label_rows[np.asarray(point_index, dtype=np.int64)]
+
+
+class SubtreeSummaries:
+    """
+    Summary of the metadata of every subtree of a binary tree whose nodes each hold one
+    track, used to skip subtrees in which no track passes a filter.
+
+    Summaries only ever over-approximate their subtree: a subtree is only skipped if no
+    track in it passes, but a subtree that is not skipped may still have none.
+
+    attributes:
+     - attributes : the metadata the summaries were computed from
+     - words : number of words of every genre bitmask
+     - genre_bits : bitmask of the genres in every subtree, words consecutive words per node
+     - explicit : bit 0 is set if the subtree holds a clean track, bit 1 if it holds an explicit one
+     - popularity_min, popularity_max : popularity range of every subtree
+     - duration_min, duration_max : duration range of every subtree
+    """
+    attributes: TrackAttributes
+    words: int
+    genre_bits: memoryview
+    explicit: memoryview
+    popularity_min: memoryview
+    popularity_max: memoryview
+    duration_min: memoryview
+    duration_max: memoryview
+
+    def __init__(self, attributes: TrackAttributes, node_rows: np.ndarray, root: int, left: Iterable[int],
+                 right: Iterable[int]) -> None:
+        """
+        Compute the summaries of a tree, given the row of the track held by every node
+        (or -1 for a node whose track should not count) and the children of every node.
+        """
+        self.attributes = attributes
+        self.words = _words(len(attributes.genres))
+        size = len(node_rows)
+        left = np.asarray(left, dtype=np.int64)
+        right = np.asarray(right, dtype=np.int64)
+
+        live = node_rows >= 0
+        rows = np.where(live, node_rows, 0)
+        genre = np.frombuffer(attributes.genre, dtype=np.int32)[rows] if size else np.zeros(0, np.int32)
+        genre_bits = np.zeros((size, self.words), np.uint64)
+        genre_bits[live, genre[live] // _WORD] = np.left_shift(np.uint64(1), (genre[live] % _WORD).astype(np.uint64))
+        explicit = np.where(live, np.left_shift(1, np.frombuffer(attributes.explicit, dtype=np.int8)[rows]), 0)
+        explicit = explicit.astype(np.uint8)
+        empty = np.iinfo(np.int64)
+        popularity = np.frombuffer(attributes.popularity, dtype=np.int64)[rows]
+        popularity_min = np.where(live, popularity, empty.max)
+        popularity_max = np.where(live, popularity, empty.min)
+        duration = np.frombuffer(attributes.duration_ms, dtype=np.int64)[rows]
+        duration_min = np.where(live, duration, empty.max)
+        duration_max = np.where(live, duration, empty.min)
+
+        # Combine the children into their parents, deepest level first
+        levels = []
+        level = np.array([root] if root >= 0 else [], dtype=np.int64)
+        while level.size:
+            levels.append(level)
+            children = np.concatenate([left[level], right[level]])
+            level = children[children >= 0]
+        for level in reversed(levels):
+            for child in (left[level], right[level]):
+                has_child = child >= 0
+                parent, child = level[has_child], child[has_child]
+                genre_bits[parent] |= genre_bits[child]
+                explicit[parent] |= explicit[child]
+                popularity_min[parent] = np.minimum(popularity_min[parent], popularity_min[child])
+                popularity_max[parent] = np.maximum(popularity_max[parent], popularity_max[child])
+                duration_min[parent] = np.minimum(duration_min[parent], duration_min[child])
+                duration_max[parent] = np.maximum(duration_max[parent], duration_max[child])
+
+        # Searches look these up one node at a time, which is faster on memoryviews
+        self.genre_bits = memoryview(genre_bits.ravel())
+        self.explicit = memoryview(explicit)
+        self.popularity_min = memoryview(popularity_min)
+        self.popularity_max = memoryview(popularity_max)
+        self.duration_min = memoryview(duration_min)
+        self.duration_max = memoryview(duration_max)
+
+    def excludes(self, node: int, bound_filter: BoundFilter) -> bool:
+        """Return whether no track in the subtree of node passes the conditions of bound_filter."""
+        track_filter = bound_filter.track_filter
+        if bound_filter.genre_mask is not None:
+            first = node * self.words
+            if not any(self.genre_bits[first + word] & mask
+                       for word, mask in enumerate(bound_filter.genre_mask[:self.words])):
+                return True
+        if track_filter.explicit is not None and not self.explicit[node] & (2 if track_filter.explicit else 1):
+            return True
+        if track_filter.popularity is not None and (self.popularity_max[node] < track_filter.popularity[0]
+                                                    or self.popularity_min[node] > track_filter.popularity[1]):
+            return True
+        if track_filter.duration_ms is not None and (self.duration_max[node] < track_filter.duration_ms[0]
+                                                     or self.duration_min[node] > track_filter.duration_ms[1]):
+            return True
+        return False
+
+
+def _words(bits: int) -> int:
+    """Return the number of words needed to hold the given number of bits (at least one)."""
+    return max(1, -(-bits // _WORD))
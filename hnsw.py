@@ -0,0 +1,266 @@
+"""
+Approximate nearest neighbour search with a hierarchical navigable small world graph
+(HNSW, Malkov & Yashunin, 2016), usable by TrackList in place of _KDTree.
+
+Every point is a node of the bottom layer of the graph, linked to up to 2 * m close
+points. Each point is also in the layers above with probability 1 / m per layer, so
+upper layers hold exponentially fewer points, linked to up to m close points. A search
+walks greedily down from the single point of the top layer, then explores the bottom
+layer from there, keeping the ef_search closest points found so far. Larger values
+of ef_search (and of m and ef_construction, at build time) give better recall for
+slower searches.
+
+Building the graph is slow: points are inserted one at a time, each with a search of
+the graph built so far, in Python. With the default parameters it takes about 1.5 ms
+per point (5.5 s for 5,000 random points, 31 s for 20,000), so a few minutes for the
+whole Spotify dataset. That is paid once, the first time engine="hnsw" is used, as the graph
+is then saved (see SearchIndex.save). The tracks added to a TrackList afterwards are
+indexed by _KDTree instead (see TrackList._load_index), so adding tracks never rebuilds
+a graph.
+"""
+from __future__ import annotations
+import heapq
+import math
+from typing import Container, Mapping, Optional, Sequence
+
+import numpy as np
+
+from search_index import SearchIndex
+
+# Bumped whenever the layout of saved graphs changes
+_GRAPH_VERSION = 2
+
+# No point is put on more than this many layers above the bottom one
+_MAX_LEVEL = 16
+
+# Searches explore up to this many of their closest candidates at once, computing the
+# distances to all of their neighbours in one go
+_EXPAND_BATCH = 16
+
+
+class HNSW(SearchIndex):
+    """ Hierarchical navigable small world graph, with the same interface as _KDTree
+
+    attributes:
+     - m : number of links of a point on the upper layers (twice that on the bottom one)
+     - ef_construction : number of candidates considered when linking a new point
+     - ef_search : number of candidates kept while searching, at least n for n results
+     - seed : seed used to pick the layers of every point
+     - links : bottom layer links of every point, padded with -1
+     - upper_slot : index in upper_links of every point that is on upper layers, or -1
+     - upper_links : links of those points on every upper layer, padded with -1
+     - entry : point the searches start from, the only point of the top layer
+     - top_level : number of upper layers
+
+    representation invariants:
+     - links.shape == (len(ids), 2 * m)
+     - upper_links.shape[1:] == (_MAX_LEVEL, m)
+    """
+    m: int
+    ef_construction: int
+    ef_search: int
+    seed: int
+    links: np.ndarray
+    upper_slot: np.ndarray
+    upper_links: np.ndarray
+    entry: int
+    top_level: int
+
+    _VERSION = _GRAPH_VERSION
+
+    def __init__(self, ids: Sequence[str], features: np.ndarray, rows: Optional[Mapping[str, int]] = None,
+                 m: int = 12, ef_construction: int = 64, ef_search: int = 48, seed: int = 111) -> None:
+        """
+        Initialize the graph with the provided data, see SearchIndex.build and
+        SearchIndex.load.
+
+        Preconditions:
+            - features must be a matrix with one line per feature and one column per point.
+            - m, ef_construction and ef_search must be positive integers.
+        """
+        super().__init__(ids, features, rows)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+
+    def _build_parameters(self) -> list:
+        return [self.m, self.ef_construction, self.seed]
+
+    def _attach(self, arrays: dict[str, Sequence]) -> None:
+        self.links = np.frombuffer(arrays["links"], dtype=np.int32).reshape(len(self), 2 * self.m)
+        self.upper_slot = np.frombuffer(arrays["upper_slot"], dtype=np.int32)
+        self.upper_links = np.frombuffer(arrays["upper_links"], dtype=np.int32).reshape(-1, _MAX_LEVEL, self.m)
+        self.entry, self.top_level = np.frombuffer(arrays["entry"], dtype=np.int64).tolist()
+
+    def _arrays(self) -> dict[str, Sequence]:
+        return {
+            "links": self.links,
+            "upper_slot": self.upper_slot,
+            "upper_links": self.upper_links,
+            "entry": np.array([self.entry, self.top_level], dtype=np.int64),
+        }
+
+    def _neighbours(self, point: int, layer: int) -> np.ndarray:
+        """Return the links of point on the given layer, padded with -1."""
+        if layer == 0:
+            return self.links[point]
+        else:
+            return self.upper_links[self.upper_slot[point], layer - 1]
+
+    def _search_layer(self, query: np.ndarray, entries: list[tuple[float, int]], ef: int,
+                      layer: int) -> list[tuple[float, int]]:
+        """
+        Return the (squared distance, point) pairs of the ef points closest to query found
+        by exploring the given layer from entries, closest first.
+
+        Up to _EXPAND_BATCH of the closest candidates are explored at once: their links
+        are looked up, filtered and measured with a few numpy calls, instead of a few per
+        candidate.
+        """
+        points = self.points
+        links = self.links if layer == 0 else self.upper_links[:, layer - 1]
+        push, pop = heapq.heappush, heapq.heappop
+        visited = np.zeros(len(points), bool)
+        visited[[point for _, point in entries]] = True
+        candidates = list(entries)
+        heapq.heapify(candidates)
+        found = [(-dist_sq, point) for dist_sq, point in entries]
+        heapq.heapify(found)
+        while len(found) > ef:
+            pop(found)
+        bound = -found[0][0] if len(found) == ef else math.inf
+
+        while candidates and candidates[0][0] <= bound:
+            batch = [pop(candidates)[1]]
+            while candidates and len(batch) < _EXPAND_BATCH and candidates[0][0] <= bound:
+                batch.append(pop(candidates)[1])
+
+            unseen = links[batch if layer == 0 else self.upper_slot[batch]].ravel()
+            unseen = unseen[unseen >= 0]
+            unseen = np.unique(unseen[~visited[unseen]])
+            if not unseen.size:
+                continue
+            visited[unseen] = True
+
+            difference = points[unseen] - query
+            distances = np.einsum("ij,ij->i", difference, difference)
+            close = distances < bound
+            for other, other_dist_sq in zip(unseen[close].tolist(), distances[close].tolist()):
+                if other_dist_sq < bound:
+                    push(candidates, (other_dist_sq, other))
+                    push(found, (-other_dist_sq, other))
+                    if len(found) > ef:
+                        pop(found)
+                    if len(found) == ef:
+                        bound = -found[0][0]
+
+        return sorted((-dist_sq, point) for dist_sq, point in found)
+
+    def _select(self, found: list[tuple[float, int]], count: int) -> list[int]:
+        """
+        Pick up to count points of found (sorted closest first) to link a new point to.
+
+        A point is skipped when it is closer to an already picked point than to the new
+        point, so links spread out in every direction instead of all going to one cluster.
+        """
+        candidates = [point for _, point in found]
+        difference = self.points[candidates][:, None] - self.points[candidates]
+        # closer[i, j]: candidate i is closer to candidate j than to the new point
+        closer = np.einsum("ijk,ijk->ij", difference, difference) < np.array([dist_sq for dist_sq, _ in found])[:, None]
+
+        chosen = []
+        skipped = np.zeros(len(candidates), bool)
+        for i, point in enumerate(candidates):
+            if skipped[i]:
+                continue
+            chosen.append(point)
+            if len(chosen) == count:
+                break
+            skipped |= closer[:, i]
+        return chosen
+
+    def _link(self, point: int, other: int, layer: int) -> None:
+        """
+        Add a link from other to point on the given layer. If other already has as many
+        links as it can hold, keep only its closest ones.
+        """
+        linked = self._neighbours(other, layer)
+        free = np.flatnonzero(linked < 0)
+        if free.size:
+            linked[free[0]] = point
+            return
+
+        candidates = np.append(linked, point)
+        difference = self.points[candidates] - self.points[other]
+        closest = np.argsort(np.einsum("ij,ij->i", difference, difference), kind="stable")
+        linked[:] = candidates[closest[:len(linked)]]
+
+    def _build(self) -> dict[str, np.ndarray]:
+        """Build the arrays of the graph by inserting the points one at a time, in order."""
+        points = self.points
+        size = len(points)
+        rng = np.random.default_rng(self.seed)
+        levels = np.minimum((-np.log(1.0 - rng.random(size)) / math.log(self.m)).astype(np.int64), _MAX_LEVEL)
+
+        upper = np.flatnonzero(levels > 0)
+        self.links = np.full((size, 2 * self.m), -1, np.int32)
+        self.upper_slot = np.full(size, -1, np.int32)
+        self.upper_slot[upper] = np.arange(len(upper))
+        self.upper_links = np.full((len(upper), _MAX_LEVEL, self.m), -1, np.int32)
+
+        entry, top_level = 0, int(levels[0]) if size else 0
+        for point in range(1, size):
+            query = points[point]
+            level = int(levels[point])
+
+            difference = points[entry] - query
+            entries = [(float(difference @ difference), entry)]
+            for layer in range(top_level, level, -1):
+                entries = self._search_layer(query, entries, 1, layer)
+
+            for layer in range(min(level, top_level), -1, -1):
+                entries = self._search_layer(query, entries, self.ef_construction, layer)
+                chosen = self._select(entries, 2 * self.m if layer == 0 else self.m)
+                for other in chosen:
+                    self._link(other, point, layer)
+                    self._link(point, other, layer)
+
+            if level > top_level:
+                entry, top_level = point, level
+
+        return {
+            "links": self.links,
+            "upper_slot": self.upper_slot,
+            "upper_links": self.upper_links,
+            "entry": np.array([entry, top_level], dtype=np.int64),
+        }
+
+    def _search(self, target: tuple[float], n: int, excluded: Container[str] = frozenset()) -> list[tuple[float, int]]:
+        """
+        Return the squared distance and row (in self.points) of the n points closest to
+        target that the graph search finds, closest first, skipping the points whose id
+        is in excluded. Ties are broken by index.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        if not len(self):
+            return []
+
+        query = np.asarray(target, dtype=np.float64)
+        difference = self.points[self.entry] - query
+        entries = [(float(difference @ difference), self.entry)]
+        for layer in range(self.top_level, 0, -1):
+            entries = self._search_layer(query, entries, 1, layer)
+
+        # Excluded points take up room in the search, widen it until enough are left
+        ef = max(self.ef_search, n)
+        while True:
+            found = self._search_layer(query, entries, ef, 0)
+            if excluded:
+                found = [(dist_sq, index) for dist_sq, index in found if self.ids[index] not in excluded]
+            if len(found) >= n or ef >= len(self):
+                return found[:n]
+            ef *= 2
@@ -0,0 +1,282 @@
+"""
+Shared HTTP client for every web request the app makes: iTunes searches (see
+itunes.py), artwork and song previews (see main.py).
+
+All requests go through one requests.Session, so connections to a host are kept alive
+and reused instead of opening a new TLS connection per request. Every request has a
+timeout, so a server that stops answering cannot stall the app, and requests that fail
+in a way that may not happen again (connection errors, timeouts, 429 and 5xx answers)
+are retried after a jittered, exponentially growing delay. The time taken by every
+attempt is recorded in a latency histogram per endpoint (see HttpClient.latency_report).
+
+TokenBucket limits how often requests are sent, for services with a quota.
+"""
+from __future__ import annotations
+import bisect
+import random
+import threading
+import time
+from typing import Any, Callable, Optional, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeout of every request, in seconds
+DEFAULT_TIMEOUT = (3.05, 10.0)
+
+# Answers worth retrying, as the server may well give a different one next time
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Upper bound (in seconds) of every bucket of a latency histogram but the last, which
+# holds every slower request
+_LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """
+    Histogram of the time taken by requests to one endpoint.
+
+    attributes:
+     - counts : number of requests that took at most _LATENCY_BOUNDS[i] seconds (and more
+       than the bound before), with one more bucket for slower requests
+     - total : sum of the time taken by every request, in seconds
+
+    representation invariants:
+     - len(counts) == len(_LATENCY_BOUNDS) + 1
+    """
+    counts: list[int]
+    total: float
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(_LATENCY_BOUNDS) + 1)
+        self.total = 0.0
+
+    def __len__(self) -> int:
+        """Return the number of requests recorded."""
+        return sum(self.counts)
+
+    def record(self, seconds: float) -> None:
+        """Record a request that took the given time."""
+        self.counts[bisect.bisect_left(_LATENCY_BOUNDS, seconds)] += 1
+        self.total += seconds
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Return the upper bound of the bucket holding the given fraction of the fastest
+        requests (e.g. 0.5 for the median), or infinity if it is the last bucket.
+
+        Preconditions:
+            - 0 < fraction <= 1
+            - len(self) > 0
+        """
+        wanted = fraction * len(self)
+        seen = 0
+        for bound, count in zip(_LATENCY_BOUNDS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float("inf")
+
+
+class TokenBucket:
+    """
+    Rate limiter letting through rate requests per second on average, and bursts of up
+    to capacity requests at once.
+
+    Tokens are reserved in order: a request that finds the bucket empty takes a token
+    that will only be there later, and waits for it, so waiting requests go in the
+    order they came.
+
+    attributes:
+     - rate : number of tokens added per second
+     - capacity : largest number of tokens the bucket holds
+     - tokens : number of tokens in the bucket when it was last updated, negative when
+       tokens are owed to waiting requests
+     - updated : time.monotonic() when tokens was last updated
+     - _lock : held while updating tokens
+
+    representation invariants:
+     - rate > 0
+     - tokens <= capacity
+    """
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    _lock: threading.Lock
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Initialize a full bucket.
+
+        Preconditions:
+            - rate > 0
+            - capacity >= 1
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token from the bucket, waiting until there is one."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HttpClient:
+    """
+    HTTP client with connection pooling, timeouts, retries and latency histograms.
+
+    attributes:
+     - session : session every request is sent with, keeping connections alive
+     - timeout : default (connect, read) timeout of every request, in seconds
+     - retries : number of times a failed request is tried again
+     - backoff : longest delay before the first retry, in seconds, doubled for every
+       retry after it
+     - max_backoff : longest delay before any retry, in seconds
+     - sleep : called with the delay before every retry, in seconds (time.sleep unless
+       given, e.g. to test retries without waiting)
+     - histograms : maps every endpoint (host and first part of the path, e.g.
+       "itunes.apple.com/search") to the latency of its requests
+     - _lock : held while updating histograms
+
+    representation invariants:
+     - retries >= 0
+     - 0 <= backoff <= max_backoff
+    """
+    session: requests.Session
+    timeout: Union[float, tuple[float, float]]
+    retries: int
+    backoff: float
+    max_backoff: float
+    sleep: Callable[[float], None]
+    histograms: dict[str, LatencyHistogram]
+    _lock: threading.Lock
+
+    def __init__(self, timeout: Union[float, tuple[float, float]] = DEFAULT_TIMEOUT, retries: int = 3,
+                 backoff: float = 0.25, max_backoff: float = 4.0, pool_size: int = 20,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        """
+        Initialize a client keeping up to pool_size connections alive per host.
+
+        Preconditions:
+            - retries >= 0
+            - 0 <= backoff <= max_backoff
+            - pool_size >= 1
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, params: Optional[dict[str, Any]] = None,
+            timeout: Union[None, float, tuple[float, float]] = None) -> requests.Response:
+        """
+        Send a GET request for url, with the given query parameters (encoded for the URL
+        by requests) and timeout (by default, self.timeout), and return the response.
+
+        Requests are retried up to self.retries times while they fail with a connection
+        error, a timeout or one of RETRY_STATUSES. If the last attempt still gets one of
+        RETRY_STATUSES, its response is returned; callers should check status_code.
+
+        Raise requests.RequestException if the last attempt fails without a response.
+        """
+        endpoint = _endpoint(url)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=timeout or self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, time.perf_counter() - start)
+                if attempt == self.retries:
+                    raise
+                retry_after = None
+            else:
+                self._record(endpoint, time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+
+            self._wait(attempt, retry_after)
+            attempt += 1
+
+    def _wait(self, attempt: int, retry_after: Optional[str] = None) -> None:
+        """
+        Sleep before retrying after the given (0 for the first) failed attempt: a random
+        time up to backoff * 2 ** attempt ("full jitter", so that many clients failing at
+        once do not all retry at once), or as long as the server asked in its
+        Retry-After header, capped to max_backoff.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        self.sleep(delay)
+
+    def _record(self, endpoint: str, seconds: float) -> None:
+        """Record an attempt at a request to endpoint that took the given time."""
+        with self._lock:
+            if endpoint not in self.histograms:
+                self.histograms[endpoint] = LatencyHistogram()
+            self.histograms[endpoint].record(seconds)
+
+    def latency_report(self) -> str:
+        """Return a table of the number, mean, median and 95th percentile latency (in ms) of requests, by endpoint."""
+        lines = [f"{'endpoint':<50} {'requests':>8} {'mean':>8} {'p50':>8} {'p95':>8}"]
+        with self._lock:
+            for endpoint, histogram in sorted(self.histograms.items()):
+                count = len(histogram)
+                lines.append(f"{endpoint:<50} {count:>8} {histogram.total / count * 1000:>8.1f} "
+                             f"{histogram.percentile(0.5) * 1000:>8.0f} {histogram.percentile(0.95) * 1000:>8.0f}")
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        """Close every connection kept alive."""
+        self.session.close()
+
+
+_client: Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    """Return the client shared by the whole app, creating it on the first call."""
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def get(url: str, params: Optional[dict[str, Any]] = None,
+        timeout: Union[None, float, tuple[float, float]] = None) -> requests.Response:
+    """Send a GET request with the shared client, see HttpClient.get."""
+    return get_client().get(url, params, timeout)
+
+
+def _endpoint(url: str) -> str:
+    """
+    Return the host and first part of the path of url, to group requests by. Artwork
+    and previews each have their own path, so grouping by whole path would give every
+    file its own histogram.
+    """
+    parts = urlsplit(url)
+    return parts.netloc + "/" + parts.path.lstrip("/").split("/", 1)[0]
@@ -1,31 +1,136 @@
-"""iTunes API"""
+"""iTunes API
+
+Search results are cached on disk (see summary_cache.py). To fill the cache ahead of
+time for the tracks whose ids are listed (one per line) in a file, run:
+
+    python itunes.py warm dataset.csv track_ids.txt
+
+Searches go through a token bucket (see http_client.TokenBucket) set to the quota of
+the iTunes Search API, about 20 searches per minute, letting a burst of that many
+through at once. get_track_summaries looks many songs up at once, and
+fetch_track_summary looks one up in the background.
+"""
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional, Sequence
+
 import requests
 from tkinter import PhotoImage
 from io import BytesIO
 
+import http_client
+from dataset_cache import load_dataset
+from summary_cache import SummaryCache, get_cache, summary_key
+
+SEARCH_URL = "https://itunes.apple.com/search"
+
+# Every search takes a token from this bucket: about 20 searches per minute
+SEARCH_LIMITER = http_client.TokenBucket(rate=20 / 60, capacity=20)
+
+# Threads looking songs up for get_track_summaries, as many as the searches the quota
+# lets through at once
+_LOOKUP_WORKERS = 20
+_lookups = ThreadPoolExecutor(_LOOKUP_WORKERS, thread_name_prefix="itunes")
+
+# Maps the key (see summary_cache.summary_key) of every song being searched for to the
+# future result of the search, so that a song asked for again in the meantime is not
+# searched for twice
+_in_flight: dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
 
-def get_track_summary(artist: str, title: str) -> dict:
+def get_track_summary(artist: str, title: str, cache: Optional[SummaryCache] = None) -> dict:
     """Returns a dictionary with song details based on title and artist search.
-    Returns an empty dictionary if there is an error finding the song."""
+    Returns an empty dictionary if there is an error finding the song.
 
-    keys = ["trackName", "artistName", "collectionName", "previewUrl", "artworkUrl100"]
+    Results (including songs not found) are kept in cache, by default the one shared by
+    the app, and only searched for again once they expire. Errors reaching iTunes are
+    not cached."""
+    if cache is None:
+        cache = get_cache()
+
+    summary = cache.get(artist, title)
+    if summary is not None:
+        return summary
+
+    # Only one search per song at a time, any other caller waits for its result
+    key = summary_key(artist, title)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        searching = future is None
+        if searching:
+            future = _in_flight[key] = Future()
+    if not searching:
+        return future.result()
+
+    try:
+        # A search that finished between the first look at the cache and now has put its
+        # result there already
+        summary = cache.get(artist, title)
+        if summary is None:
+            summary = _search(artist, title)
+            if summary is not None:
+                cache.put(artist, title, summary)
+        future.set_result({} if summary is None else summary)
+    except BaseException as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+    return future.result()
+
+
+def fetch_track_summary(artist: str, title: str, cache: Optional[SummaryCache] = None) -> Future:
+    """Return a future of the result of get_track_summary for the song, looked up in the
+    background on one of _LOOKUP_WORKERS threads (as long as the search quota allows)."""
+    return _lookups.submit(get_track_summary, artist, title, cache)
+
+
+def get_track_summaries(pairs: Sequence[tuple[str, str]], cache: Optional[SummaryCache] = None) -> list[dict]:
+    """Return the result of get_track_summary for every (artist, title) pair, in order.
 
-    query = f"{artist} {title}".replace(" ", "+")
-    url = f"https://itunes.apple.com/search?term={query}&entity=song&limit=1"
+    Songs not cached are searched for at the same time, on _LOOKUP_WORKERS threads (as
+    long as the search quota allows), and every song is only searched for once."""
+    if cache is None:
+        cache = get_cache()
 
-    response = requests.get(url)
-    if response.status_code == 200:
+    futures = {}
+    for artist, title in pairs:
+        key = summary_key(artist, title)
+        if key not in futures:
+            futures[key] = fetch_track_summary(artist, title, cache)
+
+    return [futures[summary_key(artist, title)].result() for artist, title in pairs]
+
+
+def _search(artist: str, title: str) -> Optional[dict]:
+    """Search iTunes for the song, and return its details, {} if it was not found, or
+    None if iTunes could not be reached or gave an error."""
+
+    keys = ["trackName", "artistName", "collectionName", "previewUrl", "artworkUrl100"]
+
+    SEARCH_LIMITER.acquire()
+    try:
+        response = http_client.get(SEARCH_URL, params={"term": f"{artist} {title}", "entity": "song", "limit": 1})
+        if response.status_code != 200:
+            return None
         results = response.json().get("results", [])
-        if results:
-            track_data = results[0]
-            if all(key in track_data for key in keys):
-                return {
-                    "name": track_data['trackName'],
-                    "artist": track_data['artistName'],
-                    "album_name": track_data['collectionName'],
-                    "audio_url": track_data['previewUrl'],
-                    "artwork": track_data['artworkUrl100']
-                }
+    except (requests.RequestException, ValueError):  # No answer, or not JSON
+        return None
+
+    if results:
+        track_data = results[0]
+        if all(key in track_data for key in keys):
+            return {
+                "name": track_data['trackName'],
+                "artist": track_data['artistName'],
+                "album_name": track_data['collectionName'],
+                "audio_url": track_data['previewUrl'],
+                "artwork": track_data['artworkUrl100']
+            }
 
     return {}
 
@@ -46,3 +151,46 @@ def get_track_summary(artist: str, title: str) -> dict:
 # query = get_track_summary("Kanye West", "My beautiful dark twisted fantasy")
 # print(query)
 #
+
+
+def warm(dataset: str, track_ids: Iterable[str], cache: Optional[SummaryCache] = None) -> None:
+    """
+    Search iTunes for every track of dataset whose id is in track_ids and is not
+    cached yet, so that later sessions find them in cache (by default, the one shared by
+    the app). Print how many were searched for, found and not found.
+    """
+    if cache is None:
+        cache = get_cache()
+
+    columns = load_dataset(dataset)
+    strings = columns.strings
+    rows = {track_id: row for row, track_id in enumerate(strings["track_id"])}
+
+    counts = {"cached": 0, "found": 0, "not found": 0, "failed": 0, "unknown id": 0}
+    for track_id in track_ids:
+        if track_id not in rows:
+            counts["unknown id"] += 1
+            continue
+
+        artist, title = columns.interned["artists"][rows[track_id]], strings["track_name"][rows[track_id]]
+        if cache.get(artist, title) is not None:
+            counts["cached"] += 1
+            continue
+
+        summary = _search(artist, title)
+        if summary is None:
+            counts["failed"] += 1
+        else:
+            cache.put(artist, title, summary)
+            counts["found" if summary else "not found"] += 1
+
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "warm":
+        print("usage: python itunes.py warm dataset.csv track_ids.txt")
+        sys.exit(1)
+
+    with open(sys.argv[3], "r", encoding="UTF-8") as ids:
+        warm(sys.argv[2], [line.strip() for line in ids if line.strip()])
@@ -5,22 +5,27 @@ It uses CustomTkinter for UI components, retrieves song information via an exter
 and organizes songs into a tree-based playlist structure.
 """
 from __future__ import annotations
-import requests
-import io
-from io import BytesIO
-import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable
 
 
 from tkinter import *
 import customtkinter as ctk
 
-from itunes import get_track_summary
+from artwork_cache import THUMBNAIL_SIZE, get_artwork_cache
+from http_client import get_client
+from itunes import fetch_track_summary
+from preview_cache import get_preview_cache
 from datatypes import *
 from tracks import *
 
-from PIL import Image
 import pyglet
 
+# Number of pending songs looked up on iTunes ahead of being shown
+LOOKAHEAD = 8
+
 
 class MusicFrame(ctk.CTkFrame):
     """
@@ -28,9 +33,15 @@ class MusicFrame(ctk.CTkFrame):
 
     Attributes:
      - _confirm: boolean to confirm if user accepts or denies the song
+     - _loading: URL of the preview waited for before it can play, if any
+     - photo: artwork of the current song, None until it is fetched
+     - _artwork: URL of the artwork of the current song
     """
 
     _confirm: Optional[bool]
+    _loading: Optional[str]
+    photo: Optional[ctk.CTkImage]
+    _artwork: Optional[str]
 
     def __init__(self, master, **kwargs):
         """
@@ -48,8 +59,10 @@ class MusicFrame(ctk.CTkFrame):
         self.player = None
         self.current_url = None
         self.is_playing = False
-        self.player_thread = None
         self.current_song_info = None
+        self._loading = None
+        self.photo = None
+        self._artwork = None
 
         # Rest of your existing initialization code
         self.rowconfigure(0, weight=1)
@@ -110,6 +123,8 @@ class MusicFrame(ctk.CTkFrame):
             return
 
         url = self.current_song_info["audio_url"]
+        if url == self._loading:
+            return  # Already starting to play
 
         # Toggle between play and pause states
         if url != self.current_url or self.player is None:
@@ -133,49 +148,59 @@ class MusicFrame(ctk.CTkFrame):
             self.song_link.configure(text="pause")
 
     def play_audio(self, url):
-        """Load and play audio from the given URL"""
+        """
+        Play the preview at the given URL, as soon as it is downloaded and decoded (see
+        preview_cache.py) if it is not already.
 
-        def audio_thread():
-            print(f"Playing audio from: {url}")
+        The preview is waited for by polling from the tkinter event loop, so the player
+        is created on the main thread and the UI never blocks.
+        """
+        print(f"Playing audio from: {url}")
+        cache = get_preview_cache()
+        start = time.perf_counter()
+        future = cache.fetch(url)
+        was_ready = future.done()
+        self._loading = url
+
+        def start_player():
+            if self._loading != url:
+                return  # Stopped, or another song was asked for, in the meantime
+            if not future.done():
+                self.after(10, start_player)
+                return
 
+            self._loading = None
             try:
-                # Download the M4A file
-                response = requests.get(url)
-                audio_data = io.BytesIO(response.content)
-
-                # Save to a temporary file
-                with open("temp_audio.m4a", "wb") as f:
-                    f.write(audio_data.getbuffer())
-
-                # Load and play the audio
-                self.player = pyglet.media.Player()
-                source = pyglet.media.load("temp_audio.m4a", streaming=False)
-                self.player.queue(source)
-                self.player.play()
-                self.is_playing = True
-
-                # Setup pyglet event handling that doesn't block tkinter
-                def update_player():
-                    if not self.is_playing:
-                        return
-
-                    pyglet.clock.tick()
-                    # Schedule the next update using tkinter's after method
-                    self.after(33, update_player)  # ~30 fps
-
-                # Start the update cycle
-                update_player()
+                source = future.result()
             except Exception as e:
                 print(f"Error playing audio: {e}")
                 self.is_playing = False
+                self.song_link.configure(text="play")
+                return
+
+            self.player = pyglet.media.Player()
+            self.player.queue(source)
+            self.player.play()
+            self.is_playing = True
+            cache.record_first_sound(time.perf_counter() - start, was_ready)
+
+            # Setup pyglet event handling that doesn't block tkinter
+            def update_player():
+                if not self.is_playing:
+                    return
+
+                pyglet.clock.tick()
+                # Schedule the next update using tkinter's after method
+                self.after(33, update_player)  # ~30 fps
+
+            # Start the update cycle
+            update_player()
 
-        # Run in a separate thread to avoid blocking the UI
-        self.player_thread = threading.Thread(target=audio_thread)
-        self.player_thread.daemon = True
-        self.player_thread.start()
+        start_player()
 
     def stop_audio(self):
         """Stop the current audio playback"""
+        self._loading = None
         if self.player:
             self.player.pause()
             self.player.delete()
@@ -184,14 +209,18 @@ class MusicFrame(ctk.CTkFrame):
         print("Stopped playback")
         self.song_link.configure(text="play")
 
-    def _update_current_song(self, title: str, image: PhotoImage, artists: str) -> None:
-        """ Update the widget to display information about the new song"""
+    def _update_current_song(self, title: str, artwork: str, artists: str) -> None:
+        """ Update the widget to display information about the new song, and its artwork once fetched"""
 
         self.song_title.configure(text=title)
         self.song_title.grid(row=1, column=0, columnspan=3, sticky="ew")
 
-        self.song_image.configure(image=image)
+        # The artwork of the song before is shown until this one is fetched, usually
+        # right away as it is prefetched
+        self.photo = None
+        self._artwork = artwork
         self.song_image.grid(row=2, column=1)
+        get_tk_photo(artwork, self, partial(self._show_photo, artwork))
 
         self.song_artist.configure(text=artists)
         self.song_artist.grid(row=3, column=0, columnspan=3, sticky="ew")
@@ -199,8 +228,14 @@ class MusicFrame(ctk.CTkFrame):
         # Reset play/pause button text when displaying a new song
         self.song_link.configure(text="play")
 
-    def user_input(self, title: str, image, artists: str, song_info=None) -> bool:
-        """ Return if user likes/dislikes the song"""
+    def _show_photo(self, artwork: str, photo: ctk.CTkImage) -> None:
+        """ Show the artwork fetched from the given URL, unless another song is shown by now"""
+        if artwork == self._artwork:
+            self.photo = photo
+            self.song_image.configure(image=photo)
+
+    def user_input(self, title: str, artwork: str, artists: str, song_info=None) -> bool:
+        """ Return if user likes/dislikes the song, showing the artwork at the given URL"""
 
         # Store the song info for the play button to use
         self.current_song_info = song_info
@@ -208,7 +243,7 @@ class MusicFrame(ctk.CTkFrame):
         # Stop any currently playing audio
         self.stop_audio()
 
-        self._update_current_song(title, image, artists)
+        self._update_current_song(title, artwork, artists)
 
         # waiting for user to press button
         while self._confirm is None:
@@ -520,19 +555,52 @@ class PlaylistTree():
         return items
 
 
-def get_tk_photo(url: str) -> ctk.CTkImage:
-    """Fetch an image from a URL and return a CustomTkinter-compatible CTkImage."""
-    response = requests.get(url)
-    img_data = BytesIO(response.content)
-    image = Image.open(img_data)
+def get_tk_photo(url: str, widget: ctk.CTkFrame, show: Callable[[ctk.CTkImage], None]) -> None:
+    """Fetch an image from a URL and call show with it as a CustomTkinter-compatible CTkImage.
+
+    The image comes from the artwork cache (see artwork_cache.py), already decoded and
+    resized if it was shown or prefetched before. Otherwise it is waited for by polling
+    from the event loop of widget, so show is called on the main thread and the UI
+    never blocks."""
+    future = get_artwork_cache().fetch(url)
+
+    def show_when_ready():
+        if not future.done():
+            widget.after(10, show_when_ready)
+            return
+        try:
+            image = future.result()
+        except Exception as e:
+            print(f"Error loading artwork: {e}")
+            return
+        show(ctk.CTkImage(light_image=image, size=THUMBNAIL_SIZE))
+
+    show_when_ready()
+
+
+def _prefetch_artwork(lookup: Future) -> None:
+    """Start fetching the artwork of the song looked up, if itunes found it."""
+    summary = lookup.result()
+    if summary != {}:
+        get_artwork_cache().prefetch(summary["artwork"])
+
+
+def _prefetch_preview(lookup: Future) -> None:
+    """Start fetching the preview of the song looked up, if itunes found it."""
+    summary = lookup.result()
+    if summary != {}:
+        get_preview_cache().prefetch(summary["audio_url"])
 
-    ctk_image = ctk.CTkImage(light_image=image, size=(100, 100))
-    return ctk_image
 
 if __name__ == "__main__":
     tk = TrackList("dataset.csv")
     pending_songs = []
     filter = set()
+    # ids of every song in the playlist or waiting to be recommended, never recommended again
+    queued = set()
+
+    # maps the id of every pending song being looked up on iTunes to its future summary
+    lookups = {}
 
     # mutable object To easy quit out of app
     app_ongoing = [True]
@@ -542,42 +610,63 @@ if __name__ == "__main__":
     first_id = input("Enter the starting track id: ")
     first_track = tk.get_track(first_id)
     playlist = PlaylistTree(first_track.track_id, first_track, None)
-    temp_list = tk.find_multiple_similar(first_track.track_id, 5)
+    queued.add(first_track.track_id)
+    temp_list = tk.find_multiple_similar(first_track.track_id, 5, excluded=queued, distinct=True)
     for item in temp_list:
         pending_songs.append((first_track, item))
         filter.add(item.track_name)
+        queued.add(item.track_id)
 
     app = App(playlist, app_ongoing)
     app.update()
 
     while app_ongoing[0]:
-        root_song, curr_song = pending_songs.pop(0)
-
-        song_info = get_track_summary(curr_song.artists, curr_song.track_name)
-
-        while song_info == {}:         #recommend new song if itunes cannot find this one
-
+        song_info = {}
+        while song_info == {} and pending_songs:         #recommend new song if itunes cannot find this one
+            # Look the next few songs up in the background, so songs itunes cannot find
+            # cost no extra round trips, and their artwork is ready by the time they are shown
+            for _, song in pending_songs[:LOOKAHEAD]:
+                if song.track_id not in lookups:
+                    lookups[song.track_id] = fetch_track_summary(song.artists, song.track_name)
+                    lookups[song.track_id].add_done_callback(_prefetch_artwork)
+
+            # Only wait for the song shown next, keeping the window responsive meanwhile
             root_song, curr_song = pending_songs.pop(0)
-            song_info = get_track_summary(curr_song.artists, curr_song.track_name)
-
-        song_photo = get_tk_photo(song_info["artwork"])
-
-        confirmation = app.music_frame.user_input(curr_song.track_name, song_photo, curr_song.artists, song_info)
+            lookup = lookups.pop(curr_song.track_id)
+            while not lookup.done():
+                app.update()
+            song_info = lookup.result()
+
+        if song_info == {}:  # No pending song left that itunes can find
+            break
+
+        # Get the preview of this song ready in case it is played, and that of the next
+        # song while this one is listened to
+        get_preview_cache().prefetch(song_info["audio_url"])
+        if pending_songs and pending_songs[0][1].track_id in lookups:
+            lookups[pending_songs[0][1].track_id].add_done_callback(_prefetch_preview)
+
+        confirmation = app.music_frame.user_input(curr_song.track_name, song_info["artwork"], curr_song.artists,
+                                                  song_info)
+        # The artwork is left out of the playlist if it is still being fetched
+        song_photo = app.music_frame.photo
         if confirmation:
             playlist.add_song_to_parent(curr_song.track_id, curr_song, song_photo, root_song.track_id)
 
-            new_songs = tk.find_multiple_similar(curr_song.track_id, 7)
+            new_songs = tk.find_multiple_similar(curr_song.track_id, 7, excluded=queued, distinct=True)
 
             for song in new_songs[:3]:
                 if song not in playlist and song.track_name not in filter:
                     playlist.add_song_to_parent(song.track_id, song, None, curr_song.track_id)
                     filter.add(song.track_name)
+                    queued.add(song.track_id)
                     app.playlist.update()
 
             for song in new_songs[3:]:
                 if song not in playlist and song.track_name not in filter:
                     pending_songs.append((curr_song, song))
                     filter.add(song.track_name)
+                    queued.add(song.track_id)
 
         app.visualizer.display_graph()
 
@@ -586,6 +675,8 @@ if __name__ == "__main__":
         if len(pending_songs) < 3:
             app_ongoing[0] = False
 
+    print(get_preview_cache().first_sound_report())
+    print(get_client().latency_report())
     print("-" * 120)
     print("Final Playlist: ")
     i = 0
@@ -0,0 +1,201 @@
+"""
+Feature spaces tracks are compared in.
+
+The features of the dataset are on very different scales: loudness spans about -60 to
+0 dB while the seven other features are between 0 and 1, so with plain euclidean
+distance loudness decides almost every search. A FeatureSpace maps every feature vector
+to a new vector such that the euclidean distance between mapped vectors is the distance
+wanted:
+ - "euclidean" : every feature optionally standardized (to mean 0 and standard
+   deviation 1 over the dataset) and multiplied by a weight
+ - "cosine" : the same, then scaled to length 1, so that euclidean distance grows with
+   the angle between vectors (|a - b| ** 2 == 2 - 2 * cos(a, b))
+ - "mahalanobis" : vectors whitened with the covariance of the dataset, so correlated
+   features are not counted twice, then multiplied by the weights
+
+TrackList maps the whole feature matrix once, when it is loaded, and every search
+engine is built over (and searches) the mapped vectors, so no search pays for the
+metric.
+
+A FeatureSet names the features (columns of the dataset, see
+dataset_cache.FEATURE_COLUMNS) tracks are compared by, along with the metric they are
+compared with. A TrackList can be given several, and searches pick one by name.
+"""
+from __future__ import annotations
+from typing import Optional, Sequence
+
+import numpy as np
+
+from dataset_cache import DEFAULT_FEATURES, FEATURE_COLUMNS
+
+METRICS = ("euclidean", "cosine", "mahalanobis")
+
+# Variances below this are treated as this, so constant features do not divide by zero
+_MIN_VARIANCE = 1e-12
+
+
+class FeatureSpace:
+    """
+    Mapping from the feature vectors of a dataset to the vectors tracks are compared by.
+
+    A vector x is mapped to (x - center) @ projection, then scaled to length 1 for the
+    "cosine" metric.
+
+    attributes:
+     - metric : one of METRICS
+     - standardize : whether features are standardized ("euclidean" and "cosine" only)
+     - weights : weight of every feature, or None for all 1
+     - center : vector subtracted from every vector
+     - projection : matrix every centered vector is multiplied by
+
+    representation invariants:
+     - metric in METRICS
+     - projection.shape == (len(center), len(center))
+     - weights is None or len(weights) == len(center)
+    """
+    metric: str
+    standardize: bool
+    weights: Optional[tuple[float, ...]]
+    center: np.ndarray
+    projection: np.ndarray
+
+    def __init__(self, features: np.ndarray, metric: str = "euclidean", standardize: bool = False,
+                 weights: Optional[Sequence[float]] = None) -> None:
+        """
+        Fit the space to features, a matrix with one line per feature and one column per
+        track of the dataset.
+
+        Preconditions:
+            - metric in METRICS
+            - weights is None or holds one number per feature.
+
+        Raise ValueError if metric is not one of METRICS.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(METRICS)}")
+
+        self.metric = metric
+        self.standardize = standardize
+        self.weights = None if weights is None else tuple(float(weight) for weight in weights)
+
+        dimension, size = features.shape
+        self.center = np.zeros(dimension)
+        self.projection = np.eye(dimension)
+
+        if metric == "mahalanobis" and size > 1:
+            # ZCA whitening: the inverse square root of the covariance
+            self.center = features.mean(axis=1)
+            variances, vectors = np.linalg.eigh(np.cov(features))
+            self.projection = (vectors / np.sqrt(np.maximum(variances, _MIN_VARIANCE))) @ vectors.T
+        elif standardize and size > 0:
+            self.center = features.mean(axis=1)
+            self.projection = np.diag(1 / np.sqrt(np.maximum(features.var(axis=1), _MIN_VARIANCE)))
+
+        if self.weights is not None:
+            self.projection = self.projection * np.array(self.weights)
+
+    def is_identity(self) -> bool:
+        """Return whether vectors are compared as they are."""
+        return self.metric == "euclidean" and not self.standardize and self.weights is None
+
+    def transform(self, points: np.ndarray) -> np.ndarray:
+        """Return the given points (one line per point) mapped into this space."""
+        points = np.asarray(points, dtype=np.float64)
+        if self.is_identity():
+            return points
+
+        mapped = (points - self.center) @ self.projection
+        if self.metric == "cosine":
+            lengths = np.sqrt(np.einsum("ij,ij->i", mapped, mapped))
+            mapped /= np.where(lengths > 0, lengths, 1)[:, None]
+        return mapped
+
+    def transform_columns(self, features: np.ndarray) -> np.ndarray:
+        """
+        Return the given matrix with one line per feature and one column per point,
+        mapped into this space, as a C-contiguous matrix of the same layout.
+        """
+        if self.is_identity():
+            return features
+        return np.ascontiguousarray(self.transform(features.T).T)
+
+    def transform_point(self, point: Sequence[float]) -> tuple[float, ...]:
+        """Return the given feature vector mapped into this space."""
+        if self.is_identity():
+            return tuple(point)
+        return tuple(self.transform(np.array([point], dtype=np.float64))[0].tolist())
+
+
+class FeatureSet:
+    """
+    Named choice of the features tracks are compared by, and of how they are compared
+    (see FeatureSpace).
+
+    attributes:
+     - name : name searches pick this feature set by
+     - features : names of the features compared, as in dataset_cache.FEATURE_COLUMNS
+     - metric : one of METRICS
+     - standardize : whether features are standardized ("euclidean" and "cosine" only)
+     - weights : weight of every feature, in the order of features, or None for all 1
+
+    representation invariants:
+     - len(features) > 0
+     - weights is None or len(weights) == len(features)
+    """
+    name: str
+    features: tuple[str, ...]
+    metric: str
+    standardize: bool
+    weights: Optional[tuple[float, ...]]
+
+    def __init__(self, name: str, features: Sequence[str], metric: str = "euclidean", standardize: bool = False,
+                 weights: Optional[Sequence[float]] = None) -> None:
+        """
+        Raise ValueError if a feature is not a column of the dataset, metric is not one
+        of METRICS, or weights does not hold one weight per feature.
+        """
+        unknown = [feature for feature in features if feature not in FEATURE_COLUMNS]
+        if unknown or not features:
+            raise ValueError(f"Unknown features {unknown}, expected some of {', '.join(FEATURE_COLUMNS)}")
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(METRICS)}")
+        if weights is not None and len(weights) != len(features):
+            raise ValueError(f"Expected {len(features)} weights, got {len(weights)}")
+
+        self.name = name
+        self.features = tuple(features)
+        self.metric = metric
+        self.standardize = standardize
+        self.weights = None if weights is None else tuple(float(weight) for weight in weights)
+
+    def __repr__(self) -> str:
+        return f"FeatureSet({self.name!r}, {self.features}, {self.metric!r}, {self.standardize}, {self.weights})"
+
+    def fit(self, features: np.ndarray) -> FeatureSpace:
+        """
+        Return the feature space of this feature set, fit to features, a matrix with one
+        line per feature of this set and one column per track.
+        """
+        return FeatureSpace(features, self.metric, self.standardize, self.weights)
+
+    def key(self) -> str:
+        """
+        Return a string identifying the features of this set and how they are compared
+        (but not its name), for telling saved indexes apart.
+        """
+        return f"{','.join(self.features)}:{self.metric}:{int(self.standardize)}:{self.weights}"
+
+
+# Name of the feature set a TrackList searches by, unless asked for another
+DEFAULT_FEATURE_SET = "default"
+
+# Ready-made feature sets, to be given to TrackList
+FEATURE_SETS = {
+    feature_set.name: feature_set for feature_set in [
+        FeatureSet(DEFAULT_FEATURE_SET, DEFAULT_FEATURES),
+        # Tempo is in beats per minute and key goes up to 11, so features are standardized
+        FeatureSet("all", tuple(FEATURE_COLUMNS), standardize=True),
+        FeatureSet("rhythm", ("danceability", "energy", "tempo", "time_signature"), standardize=True),
+        FeatureSet("mood", ("valence", "energy", "acousticness", "mode"), standardize=True),
+    ]
+}
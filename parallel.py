@@ -0,0 +1,134 @@
+"""
+Runs batch similarity queries (see TrackList.find_multiple_similar_batch) on several
+processes at once.
+
+Worker processes do not receive a copy of the TrackList. Each one memory-maps the
+dataset cache (see dataset_cache.py) read-only, given the digest of the CSV the
+TrackList loaded so that it is not hashed again, so every worker searches the same
+physical copy of the feature matrix, and only the queries and the results travel
+between processes. Tracks added to the TrackList since it was loaded are searched by
+the TrackList itself. (When tracks are compared by other features than the default
+ones, or in a feature space other than the raw features, see metrics.py, every worker
+builds its own copy of the matrix of those features, the first time it is searched.)
+
+Every worker already keeps a core busy, so when running many workers, set
+OPENBLAS_NUM_THREADS=1 (or OMP_NUM_THREADS=1) to stop numpy from also splitting its
+matrix products over several threads inside each worker.
+"""
+from __future__ import annotations
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Optional, Sequence
+
+import numpy as np
+
+from dataset_cache import load_dataset
+from dataset_cache import TrackColumns
+from metrics import FeatureSet, FeatureSpace
+from tracks import TrackList, _block_nearest, _feature_matrix
+
+# Columns of the dataset, set up once in every worker process
+_worker_columns: Optional[TrackColumns] = None
+
+# Maps the name of every feature set searched by a worker to its feature matrix and
+# squared norms
+_worker_matrices: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+
+class QueryPool:
+    """
+    Pool of worker processes answering batch similarity queries over one TrackList.
+
+    Queries are split into chunks of chunk_size seeds, which are handed out to the
+    workers as they become free.
+
+    Usage:
+        with QueryPool(tracks, workers=32) as pool:
+            rows, distances = pool.find_multiple_similar_batch(track_ids, 7)
+
+    attributes:
+     - tracks : the TrackList queries are answered for
+     - chunk_size : number of seeds handed to a worker at a time
+     - _executor : the worker processes
+    """
+    tracks: TrackList
+    chunk_size: int
+    _executor: ProcessPoolExecutor
+
+    def __init__(self, tracks: TrackList, workers: Optional[int] = None, chunk_size: int = 1024) -> None:
+        """
+        Start a pool of workers (by default, one per CPU) for the given TrackList.
+
+        Preconditions:
+            - workers is None or a positive integer.
+            - chunk_size must be a positive integer.
+        """
+        self.tracks = tracks
+        self.chunk_size = chunk_size
+        self._executor = ProcessPoolExecutor(workers or os.cpu_count(), initializer=_attach,
+                                             initargs=(tracks.dataset, tracks._columns.digest))
+
+    def __enter__(self) -> QueryPool:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        self._executor.shutdown()
+
+    def find_multiple_similar_batch(self, track_ids: Sequence[str], count: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as TrackList.find_multiple_similar_batch, with the work spread over the pool.
+
+        Preconditions:
+            - every id in track_ids must exist in the dataset.
+            - count must be a positive integer.
+        """
+        return self.tracks.find_multiple_similar_batch(track_ids, count, pool=self)
+
+    def search(self, queries: np.ndarray, count: int, removed_rows: np.ndarray, feature_set: FeatureSet,
+               space: FeatureSpace) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the rows and squared distances of the count rows of the dataset closest to
+        each query, skipping removed_rows, as _block_nearest does, comparing the features
+        of feature_set mapped into space.
+
+        Preconditions:
+            - queries must be a matrix with one line per query and one column per feature.
+            - count must be a positive integer.
+        """
+        chunks = [queries[i:i + self.chunk_size] for i in range(0, len(queries), self.chunk_size)]
+        if not chunks:
+            return np.zeros((0, count), np.int64), np.zeros((0, count))
+
+        results = list(self._executor.map(_search_chunk, chunks, repeat(count), repeat(removed_rows),
+                                          repeat(feature_set), repeat(space)))
+
+        return (np.concatenate([similar_rows for similar_rows, _ in results]),
+                np.concatenate([distances for _, distances in results]))
+
+
+def _attach(dataset: str, digest: str) -> None:
+    """Memory-map the columns of dataset, whose CSV has the given digest, in this worker process."""
+    global _worker_columns
+
+    _worker_columns = load_dataset(dataset, digest=digest)
+
+
+def _search_chunk(queries: np.ndarray, count: int, removed_rows: np.ndarray, feature_set: FeatureSet,
+                  space: FeatureSpace) -> tuple[np.ndarray, np.ndarray]:
+    """Search the dataset for the given chunk of queries, in a worker."""
+    if feature_set.name not in _worker_matrices:
+        features = space.transform_columns(_feature_matrix(_worker_columns, feature_set.features))
+        _worker_matrices[feature_set.name] = features, np.einsum("ij,ij->j", features, features)
+    features, norms = _worker_matrices[feature_set.name]
+
+    removed = None
+    if len(removed_rows) > 0:
+        removed = np.zeros(features.shape[1], bool)
+        removed[removed_rows] = True
+
+    return _block_nearest(queries, features, count, norms, removed)
@@ -0,0 +1,110 @@
+"""
+Cache of decoded song previews (see MusicFrame.play_audio in main.py).
+
+Previews are downloaded and decoded from memory, without going through a file, on
+background threads (see fetch_cache.FetchCache), so the preview of a song can be fetched
+while the user still listens to the one before it, and playing it only has to wait for
+what is not ready yet. The last previews fetched are kept decoded, up to a number of
+bytes of samples, least recently used first out.
+
+The time from asking for a preview to it starting to play is recorded in a latency
+histogram (see PreviewCache.first_sound_report), along with how often the preview was
+already decoded by then.
+"""
+from __future__ import annotations
+import os
+import threading
+from concurrent.futures import Future
+from io import BytesIO
+from typing import Optional
+from urllib.parse import urlsplit
+
+import pyglet
+
+import http_client
+from fetch_cache import FetchCache
+
+# Largest number of bytes of decoded samples kept in memory (a 30 second stereo preview
+# at 44.1 kHz takes about 5 MB)
+DEFAULT_MEMORY_BYTES = 64 << 20
+
+# Threads downloading and decoding previews
+_WORKERS = 2
+
+
+class PreviewCache(FetchCache):
+    """
+    Cache of decoded previews, by URL, in memory.
+
+    attributes:
+     - first_sound : time from asking for a preview to it starting to play
+     - ready : number of previews that were decoded by the time they were asked to play
+
+    representation invariants:
+     - ready <= len(first_sound)
+    """
+    first_sound: http_client.LatencyHistogram
+    ready: int
+
+    def __init__(self, memory_bytes: int = DEFAULT_MEMORY_BYTES) -> None:
+        super().__init__(memory_bytes, _WORKERS, "preview")
+        self.first_sound = http_client.LatencyHistogram()
+        self.ready = 0
+
+    def fetch(self, url: str) -> Future:
+        """
+        Return a future of the preview at url, decoded.
+
+        The future is done right away if the preview is in memory. Otherwise it is
+        downloaded and decoded in the background. The future raises
+        requests.RequestException if the download fails, or the error of the pyglet
+        decoder (e.g. pyglet.media.MediaDecodeException) if it cannot be decoded.
+        """
+        return super().fetch(url)
+
+    def record_first_sound(self, seconds: float, was_ready: bool) -> None:
+        """
+        Record a preview that started playing the given time after it was asked for,
+        and whether it was already decoded when it was asked for.
+        """
+        self.first_sound.record(seconds)
+        self.ready += was_ready
+
+    def first_sound_report(self) -> str:
+        """Return the number, mean, median and 95th percentile time to first sound (in ms) of previews played."""
+        count = len(self.first_sound)
+        if count == 0:
+            return "No previews played"
+        return (f"{count} previews played ({self.ready} ready), time to first sound: "
+                f"mean {self.first_sound.total / count * 1000:.1f} ms, "
+                f"p50 {self.first_sound.percentile(0.5) * 1000:.0f} ms, "
+                f"p95 {self.first_sound.percentile(0.95) * 1000:.0f} ms")
+
+    def _load(self, url: str) -> pyglet.media.StaticSource:
+        """Download and decode the preview at url."""
+        response = http_client.get(url)
+        response.raise_for_status()
+
+        # The file name only tells pyglet which decoder to try first
+        filename = os.path.basename(urlsplit(url).path) or "preview.m4a"
+        return pyglet.media.load(filename, file=BytesIO(response.content), streaming=False)
+
+    def _bytes(self, source: pyglet.media.StaticSource) -> int:
+        """Return the number of bytes taken by the samples of a decoded preview."""
+        if source.audio_format is None:
+            return 0
+        return int(source.duration * source.audio_format.bytes_per_second)
+
+
+_cache: Optional[PreviewCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_preview_cache() -> PreviewCache:
+    """Return the cache shared by the whole app, creating it on the first call."""
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = PreviewCache()
+        return _cache
@@ -0,0 +1,221 @@
+"""
+Base class of the search engines TrackList can be built with (see tracks._ENGINES).
+
+Every engine indexes a set of points, each with a track id, and is saved to disk as a
+few named arrays (see storage.py) that are memory-mapped back in on later runs. What
+differs between engines is the arrays they build and how they search them; keeping the
+points, looking them up by id, saving, loading and turning search results into track
+ids is the same for all of them, and lives here.
+
+The points are given as a matrix with one line per feature and one column per point,
+such as the (memory-mapped) feature matrix of a TrackList, and are not copied. The ids
+and the {id: row} mapping can be shared with the TrackList too, so loading an index
+does not create a Python object per point.
+"""
+from __future__ import annotations
+from typing import Any, Container, Iterator, Mapping, Optional, Sequence
+
+import numpy as np
+
+from storage import open_sections, write_sections
+
+# Points are compared against a target this many at a time by within
+_SCAN_BLOCK = 4096
+
+
+class SearchIndex:
+    """ Points with track ids, searched for the closest ones to a target vector
+
+    Subclasses build their arrays in _build, set them up for searching in _attach (from
+    the arrays just built, or memory-mapped from a saved index) and search them in
+    _search. An index is created with build, or with load from where it was saved.
+
+    attributes:
+     - ids : id of the point on every row of points, possibly followed by other ids
+     - rows : maps id to its row of points, possibly along with other ids mapped to rows
+       of at least len(points)
+     - points : matrix of vector points, one row per point
+
+    representation invariants:
+     - len(ids) >= len(points)
+     - rows[ids[i]] == i for every i < len(points) whose id is in rows
+    """
+    ids: Sequence[str]
+    rows: Mapping[str, int]
+    points: np.ndarray
+
+    # Bumped whenever the arrays saved by the engine change
+    _VERSION = 1
+
+    def __init__(self, ids: Sequence[str], features: np.ndarray, rows: Optional[Mapping[str, int]] = None) -> None:
+        """
+        Initialize an index over the points in the columns of features, with the given ids,
+        not ready to be searched until its arrays are attached (see build and load).
+
+        rows maps every id to its column, and is built from ids if not given. ids and rows
+        are kept as they are, not copied, so they may be shared with (and grow along with)
+        the TrackList they come from.
+
+        Preconditions:
+            - features must be a matrix with one line per feature and one column per point.
+            - len(ids) >= features.shape[1]
+        """
+        self.ids = ids
+        self.points = np.asarray(features, dtype=np.float64).T
+        self.rows = dict(zip(ids, range(len(self.points)))) if rows is None else rows
+
+    @classmethod
+    def build(cls, ids: Sequence[str], features: np.ndarray, rows: Optional[Mapping[str, int]] = None,
+              **options) -> SearchIndex:
+        """
+        Return a new index over the given points (see __init__), built with the given
+        options (the keyword arguments of the engine's __init__).
+        """
+        index = cls(ids, features, rows, **options)
+        index._attach(index._build())
+        return index
+
+    @classmethod
+    def load(cls, path: str, ids: Sequence[str], features: np.ndarray, key: str,
+             rows: Optional[Mapping[str, int]] = None, **options) -> Optional[SearchIndex]:
+        """
+        Return the index saved at path for the given points (see __init__), with its
+        arrays memory-mapped from the file. Return None if there is no such file or it was
+        saved under a different key or build parameters, in which case the index has to
+        be rebuilt.
+
+        Preconditions:
+            - ids and features must hold the same points in the same order as the ones
+              used to build the saved index, whenever key matches.
+        """
+        opened = open_sections(path)
+        if opened is None:
+            return None
+
+        meta, arrays = opened
+        index = cls(ids, features, rows, **options)
+        if meta.get("version") != cls._VERSION or meta.get("key") != key or meta.get("size") != len(index) \
+                or meta.get("build") != index._build_parameters():
+            return None
+
+        index._attach(arrays)
+        return index
+
+    def save(self, path: str, key: str) -> None:
+        """
+        Save the arrays of this index to path, under the given key.
+
+        key should identify the data the index was built from (e.g. the digest of the
+        dataset), so that load can tell when a saved index is out of date.
+        """
+        meta = {"version": self._VERSION, "key": key, "size": len(self), "build": self._build_parameters()}
+        write_sections(path, meta, self._arrays())
+
+    def _build_parameters(self) -> list:
+        """Return the options the saved arrays depend on, which a loaded index must have been built with."""
+        return []
+
+    def _build(self) -> dict[str, np.ndarray]:
+        """Build and return the arrays of this index, by name."""
+        raise NotImplementedError
+
+    def _attach(self, arrays: dict[str, Any]) -> None:
+        """Set this index up to search the given arrays, as returned by _build or memory-mapped from a file."""
+        raise NotImplementedError
+
+    def _arrays(self) -> dict[str, Any]:
+        """Return the arrays of this index to save, by name."""
+        raise NotImplementedError
+
+    def _search(self, target: tuple[float], n: int, excluded: Container[str] = frozenset()) -> list[tuple[float, int]]:
+        """
+        Return the squared distance and row (in self.points) of the n points closest to
+        target found by the search, closest first, skipping the points whose id is in
+        excluded. Ties are broken by row.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        raise NotImplementedError
+
+    def get_point(self, id) -> tuple[float]:
+        """
+        Retrieve the feature vector associated with the given track ID.
+
+        Preconditions:
+            - id must be a non-empty string.
+        """
+        row = self.rows.get(id)
+        if row is not None and row < len(self.points):
+            return tuple(self.points[row].tolist())
+        else:
+            return None
+
+    def nearest_neighbour(self, target) -> str:
+        """
+        Find and return the track ID of the closest point to the target vector found by the search.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+        """
+        return self.n_nearest_neighbours(target, 1)[0]
+
+    def n_nearest_neighbours(self, target: tuple[float], n: int) -> list[str]:
+        """
+        Find and return the track IDs of the n closest points to the target vector found
+        by the search.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        return [self.ids[row] for x, row in self._search(target, n)]
+
+    def nearest_with_distances(self, target: tuple[float], n: int,
+                               excluded: Container[str] = frozenset()) -> list[tuple[float, str]]:
+        """
+        Return the squared distance and track ID of the n closest points to the target
+        vector found by the search, closest first, skipping the track IDs in excluded.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        return [(dist_sq, self.ids[row]) for dist_sq, row in self._search(target, n, excluded)]
+
+    def within(self, target: tuple[float], radius: float,
+               excluded: Container[str] = frozenset()) -> Iterator[tuple[float, str]]:
+        """
+        Yield the squared distance and track ID of every point within radius of the target
+        vector, in order of row, skipping the track IDs in excluded.
+
+        Points are compared against target with numpy, _SCAN_BLOCK at a time, as the
+        results are consumed. Engines that can skip whole regions of the space (see
+        _KDTree.within) override this.
+
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - radius >= 0
+        """
+        # One line per feature, which is how a TrackList lays out its feature matrix
+        features = self.points.T
+        query = np.asarray(target, dtype=np.float64)[:, None]
+        limit = radius * radius
+        for first in range(0, len(self), _SCAN_BLOCK):
+            difference = features[:, first:first + _SCAN_BLOCK] - query
+            distances = np.einsum("ij,ij->j", difference, difference)
+            close = np.flatnonzero(distances <= limit)
+            for row, dist_sq in zip((close + first).tolist(), distances[close].tolist()):
+                label = self.ids[row]
+                if not excluded or label not in excluded:
+                    yield dist_sq, label
+
+    def items(self) -> Iterator[tuple[str, tuple[float]]]:
+        """Return an iterator over the (track ID, feature vector) pairs in the index."""
+        return zip(self.ids[:len(self.points)], map(tuple, self.points.tolist()))
+
+    def __len__(self) -> int:
+        """Return the number of points in the index."""
+        return len(self.points)
+
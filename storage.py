@@ -0,0 +1,103 @@
+"""
+Helpers to read and write the binary files we use to cache data between runs.
+
+A file holds a small JSON header followed by named sections of raw array data:
+
+    MAGIC | header length (8 bytes) | JSON header | section | section | ...
+
+Every section starts on an 8 byte boundary so it can be viewed as an array of
+doubles or 64-bit integers without copying. Files are opened with a read-only
+mmap, so opening one is cheap no matter how large it is, and the pages are shared
+by every process that opens the same file.
+"""
+from __future__ import annotations
+import json
+import mmap
+import os
+import struct
+from typing import Any, Optional
+
+MAGIC = b"TLSTORE1"
+_ALIGNMENT = 8
+
+
+def write_sections(path: str, meta: dict[str, Any], sections: dict[str, Any]) -> None:
+    """
+    Write meta and sections to the file at path.
+
+    The file is written to a temporary name first and then moved into place, so a
+    reader never sees a half written file.
+
+    Preconditions:
+        - meta must be JSON serializable.
+        - every value in sections must support the buffer protocol and be C-contiguous
+          (array.array, bytes, numpy arrays, ...).
+    """
+    views = {name: memoryview(data) for name, data in sections.items()}
+
+    entries = []
+    offset = 0
+    for name, view in views.items():
+        entries.append({
+            "name": name,
+            "format": view.format,
+            "offset": offset,
+            "count": view.nbytes // view.itemsize,
+        })
+        offset += _padded(view.nbytes)
+
+    header = json.dumps({"meta": meta, "sections": entries}).encode("UTF-8")
+    header += b" " * (_padded(len(header)) - len(header))
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(MAGIC)
+            file.write(struct.pack("<Q", len(header)))
+            file.write(header)
+            for view in views.values():
+                if view.nbytes:
+                    file.write(view.cast("B"))
+                file.write(b"\0" * (_padded(view.nbytes) - view.nbytes))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def open_sections(path: str) -> Optional[tuple[dict[str, Any], dict[str, memoryview]]]:
+    """
+    Open the file at path and return its meta dictionary along with a memoryview for
+    every section. Return None if the file does not exist or is not one of our files.
+
+    The memoryviews point directly into a read-only mmap of the file.
+    """
+    try:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < len(MAGIC) + 8:
+                return None
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        return None
+
+    header_length = struct.unpack_from("<Q", buffer, len(MAGIC))[0]
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[start:start + header_length]).decode("UTF-8"))
+    start += header_length
+
+    whole = memoryview(buffer)
+    sections = {}
+    for entry in header["sections"]:
+        view = whole[start + entry["offset"]:]
+        size = struct.calcsize(entry["format"])
+        sections[entry["name"]] = view[:entry["count"] * size].cast(entry["format"])
+
+    return header["meta"], sections
+
+
+def _padded(size: int) -> int:
+    """Return size rounded up to the next multiple of the section alignment."""
+    return -(-size // _ALIGNMENT) * _ALIGNMENT
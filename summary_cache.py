@@ -0,0 +1,144 @@
+"""
+Persistent cache of iTunes search results (see itunes.get_track_summary).
+
+The same songs are looked up again in every session, so every result is kept in an
+SQLite database, including "not found" results (so songs that are not on iTunes are
+not searched for again every time they come up). Found and not found results expire
+after different times (FOUND_TTL and NOT_FOUND_TTL), as a song that was missing may
+be added to iTunes later.
+
+Results are keyed on the artists and title once normalized (see summary_key), so
+searches differing only in case, accents, punctuation or the order of the artists share
+one entry.
+
+The database is opened in write-ahead log mode, so any number of processes can read it
+while one writes to it.
+"""
+from __future__ import annotations
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from duplicates import normalize_artists, simplify
+
+# Where the shared cache is kept, relative to the working directory
+DEFAULT_PATH = "itunes_cache.sqlite3"
+
+# Number of seconds found and not found results are kept for
+FOUND_TTL = 30 * 24 * 60 * 60
+NOT_FOUND_TTL = 24 * 60 * 60
+
+# Number of seconds to wait for another process to finish writing before giving up
+_BUSY_TIMEOUT = 5.0
+
+
+def summary_key(artist: str, title: str) -> str:
+    """
+    Return the key the search result for the given artists and title is cached under.
+
+    >>> summary_key("Simon & Garfunkel", "Mrs. Robinson")
+    'simon garfunkel\\tmrs robinson'
+    >>> summary_key("simon & GARFUNKEL", "Mrs Robinson!")
+    'simon garfunkel\\tmrs robinson'
+    """
+    return f"{normalize_artists(artist)}\t{simplify(title)}"
+
+
+class SummaryCache:
+    """
+    Cache of iTunes search results in an SQLite database.
+
+    Every thread gets its own connection to the database, as SQLite connections cannot
+    be shared between threads.
+
+    attributes:
+     - path : path of the database file
+     - found_ttl : number of seconds found results are kept for
+     - not_found_ttl : number of seconds not found results are kept for
+     - _local : holds the connection of every thread
+    """
+    path: str
+    found_ttl: float
+    not_found_ttl: float
+    _local: threading.local
+
+    def __init__(self, path: str = DEFAULT_PATH, found_ttl: float = FOUND_TTL,
+                 not_found_ttl: float = NOT_FOUND_TTL) -> None:
+        self.path = path
+        self.found_ttl = found_ttl
+        self.not_found_ttl = not_found_ttl
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of this thread to the database, opening it if needed."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS summaries "
+                               "(key TEXT PRIMARY KEY, summary TEXT, fetched REAL NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, artist: str, title: str) -> Optional[dict]:
+        """
+        Return the cached search result for the given artists and title: the summary of
+        the song, {} if it was not found, or None if there is no result (or it expired).
+
+        Errors reading the database are treated as no result.
+        """
+        try:
+            row = self._connection().execute("SELECT summary, fetched FROM summaries WHERE key = ?",
+                                             (summary_key(artist, title),)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+
+        summary, fetched = row
+        ttl = self.not_found_ttl if summary is None else self.found_ttl
+        if time.time() - fetched > ttl:
+            return None
+        return {} if summary is None else json.loads(summary)
+
+    def put(self, artist: str, title: str, summary: dict) -> None:
+        """
+        Cache the search result for the given artists and title: the summary of the song,
+        or {} if it was not found.
+
+        Errors writing the database are ignored, the result is only not cached.
+        """
+        try:
+            self._connection().execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+                                       (summary_key(artist, title), json.dumps(summary) if summary else None,
+                                        time.time()))
+        except sqlite3.Error:
+            pass
+
+    def purge_expired(self) -> int:
+        """Remove every expired result from the database and return how many were removed."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "DELETE FROM summaries WHERE fetched < CASE WHEN summary IS NULL THEN ? ELSE ? END",
+            (now - self.not_found_ttl, now - self.found_ttl))
+        return cursor.rowcount
+
+    def __len__(self) -> int:
+        """Return the number of results in the database, expired or not."""
+        return self._connection().execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+
+_cache: Optional[SummaryCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> SummaryCache:
+    """Return the cache shared by the whole app, at DEFAULT_PATH, creating it on the first call."""
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = SummaryCache()
+        return _cache
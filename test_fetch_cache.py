@@ -0,0 +1,67 @@
+"""
+Tests for the cache shared by the artwork and preview caches (see fetch_cache.py), run
+with pytest.
+"""
+from __future__ import annotations
+import threading
+
+import pytest
+
+from fetch_cache import FetchCache
+
+
+class _StringCache(FetchCache):
+    """Cache of key * 10, one byte per character, counting how often each key is loaded."""
+
+    def __init__(self, memory_bytes: int, release: threading.Event) -> None:
+        super().__init__(memory_bytes, 4, "test")
+        self.loads = {}
+        self.release = release
+
+    def _load(self, key: str) -> str:
+        self.loads[key] = self.loads.get(key, 0) + 1
+        self.release.wait(5)
+        if key == "broken":
+            raise OSError("cannot load")
+        return key * 10
+
+    def _bytes(self, value: str) -> int:
+        return len(value)
+
+
+def test_loads_each_key_once_while_in_flight() -> None:
+    release = threading.Event()
+    cache = _StringCache(100, release)
+
+    futures = [cache.fetch("a") for _ in range(5)]
+    release.set()
+
+    assert {future.result() for future in futures} == {"a" * 10}
+    assert cache.get("a") == "a" * 10 and cache.loads == {"a": 1}
+
+
+def test_drops_least_recently_used_past_memory_bytes() -> None:
+    release = threading.Event()
+    release.set()
+    cache = _StringCache(25, release)
+
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+
+    assert list(cache._values) == ["a", "c"] and cache.size == 20
+    cache.get("b")
+    assert cache.loads == {"a": 1, "b": 2, "c": 1}
+
+
+def test_failed_loads_are_tried_again() -> None:
+    release = threading.Event()
+    release.set()
+    cache = _StringCache(100, release)
+
+    for _ in range(2):
+        with pytest.raises(OSError):
+            cache.get("broken")
+
+    assert cache.loads == {"broken": 2} and cache.size == 0 and not cache._pending
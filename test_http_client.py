@@ -0,0 +1,122 @@
+"""
+Tests for the shared HTTP client (see http_client.py), run with pytest against a stub
+server on localhost.
+"""
+from __future__ import annotations
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+from http_client import HttpClient
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests by path:
+     - /flaky : 503 to the first server.failures requests, then 200
+     - /slow : 200 after server.delay seconds
+     - /echo : 200 with the query parameters as JSON
+    and records the client port of every request in server.ports.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        server = self.server
+        parts = urlsplit(self.path)
+        with server.lock:
+            server.ports.append(self.client_address[1])
+            server.requests += 1
+            count = server.requests
+
+        if parts.path == "/flaky" and count <= server.failures:
+            self._answer(503, b"busy")
+        elif parts.path == "/slow":
+            time.sleep(server.delay)
+            self._answer(200, b"late")
+        else:
+            self._answer(200, json.dumps(parse_qs(parts.query)).encode("UTF-8"))
+
+    def _answer(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    stub.daemon_threads = True
+    stub.lock = threading.Lock()
+    stub.ports = []
+    stub.requests = 0
+    stub.failures = 0
+    stub.delay = 0.0
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def url(server, path: str) -> str:
+    """Return the URL of path on the stub server."""
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_retries_with_backoff(server) -> None:
+    server.failures = 2
+    delays = []
+    client = HttpClient(retries=3, backoff=0.25, max_backoff=4.0, sleep=delays.append)
+
+    response = client.get(url(server, "/flaky"))
+
+    assert response.status_code == 200 and server.requests == 3
+    assert len(delays) == 2 and all(0 <= delay <= 0.25 * 2 ** attempt for attempt, delay in enumerate(delays))
+    assert len(client.histograms[f"127.0.0.1:{server.server_address[1]}/flaky"]) == 3
+
+
+def test_returns_last_answer_once_out_of_retries(server) -> None:
+    server.failures = 10
+    client = HttpClient(retries=2, sleep=lambda seconds: None)
+
+    assert client.get(url(server, "/flaky")).status_code == 503
+    assert server.requests == 3
+
+
+def test_timeout_is_retried_then_raised(server) -> None:
+    server.delay = 0.5
+    client = HttpClient(timeout=0.1, retries=1, backoff=0.0)
+
+    start = time.perf_counter()
+    with pytest.raises(requests.Timeout):
+        client.get(url(server, "/slow"))
+
+    assert server.requests == 2 and time.perf_counter() - start < 0.5
+
+
+def test_connections_are_reused(server) -> None:
+    client = HttpClient()
+    for _ in range(5):
+        assert client.get(url(server, "/echo")).status_code == 200
+
+    assert len(server.ports) == 5 and len(set(server.ports)) == 1
+    client.close()
+
+
+def test_query_parameters_are_encoded(server) -> None:
+    client = HttpClient()
+    params = {"term": "Beyoncé & JAY-Z Crazy in Love?", "entity": "song", "limit": 1}
+
+    response = client.get(url(server, "/echo"), params=params)
+
+    assert response.json() == {name: [str(value)] for name, value in params.items()}
+    assert "/echo" in client.latency_report()
@@ -0,0 +1,252 @@
+"""
+Tests for the search indexes of TrackList (see tracks.py), run with pytest.
+"""
+from __future__ import annotations
+import csv
+import random
+import time
+
+import pytest
+
+from dataset_cache import DEFAULT_FEATURES
+from datatypes import Track
+from filters import SubtreeSummaries, TrackFilter
+from tracks import _ENGINES, TrackList
+
+# Number of tracks in the generated dataset
+DATASET_SIZE = 40
+
+# Tracks added at once, a full buffer of _DynamicIndex, so that they are carried into a level
+ADDED = 128
+
+# Number of tracks in the dataset searches are checked against _BruteForce on
+GROUND_TRUTH_SIZE = 400
+
+# Engines returning exactly what _BruteForce does; the others must find at least
+# MIN_RECALL of the same tracks
+EXACT_ENGINES = ("kdtree", "bucket_kdtree")
+MIN_RECALL = 0.9
+
+
+def write_dataset(path: str, size: int = DATASET_SIZE, seed: int = 111) -> None:
+    """Write a dataset of size tracks with random features to a CSV file at path."""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="UTF-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["", "track_id", "artists", "album_name", "track_name", "popularity", "duration_ms",
+                         "explicit", "danceability", "energy", "key", "loudness", "mode", "speechiness",
+                         "acousticness", "instrumentalness", "liveness", "valence", "tempo", "time_signature",
+                         "track_genre"])
+        for i in range(size):
+            writer.writerow([i, f"track{i}", f"Artist {i % 7}", f"Album {i % 5}", f"Song {i}", rng.randint(0, 100),
+                             rng.randint(30_000, 600_000), rng.choice(["True", "False"]),
+                             *(round(rng.random(), 4) for _ in range(12)), rng.choice(["pop", "rock"])])
+
+
+def wait_for_compaction(track_list: TrackList) -> None:
+    """Wait until the index of the default feature set is done compacting in the background."""
+    algorithm = track_list._feature_index().algorithm
+    deadline = time.monotonic() + 30
+    while algorithm._compacting:
+        assert time.monotonic() < deadline, "compaction did not finish"
+        time.sleep(0.01)
+
+
+def nearest(track_list: TrackList, track_id: str, count: int, track_filter: TrackFilter) -> list[tuple[float, str]]:
+    """Return the squared distance and id of the count tracks closest to track_id that pass track_filter."""
+    algorithm = track_list._feature_index().algorithm
+    bound = None if track_filter.is_empty() else track_filter.bind(track_list._store, track_list._rows)
+    return algorithm.nearest_with_distances(algorithm.get_point(track_id), count, bound)
+
+
+@pytest.fixture
+def dataset(tmp_path) -> str:
+    path = str(tmp_path / "dataset.csv")
+    write_dataset(path)
+    return path
+
+
+@pytest.fixture
+def large_dataset(tmp_path) -> str:
+    path = str(tmp_path / "large.csv")
+    write_dataset(path, GROUND_TRUTH_SIZE, seed=112)
+    return path
+
+
+@pytest.mark.parametrize("engine", list(_ENGINES))
+def test_search_after_removing_every_added_track(dataset, engine) -> None:
+    track_list = TrackList(dataset, engine=engine)
+    added = [f"added{i}" for i in range(ADDED)]
+    for track_id in added:
+        track_list.add_track(Track(track_id, "Artist", "Album", "Song", 50, 200_000, False, "pop"),
+                             [0.5] * len(DEFAULT_FEATURES))
+    for track_id in added:
+        track_list.remove_track(track_id)
+    wait_for_compaction(track_list)
+
+    parts, buffer = track_list._feature_index().algorithm._state
+    assert parts[1:] == (None,) and buffer == ()
+
+    found = [track.track_id for track in track_list.find_multiple_similar("track0", 5)]
+    assert len(found) == 5 and not set(found) & set(added)
+    assert len(list(track_list._feature_index().algorithm.within((0.5,) * len(DEFAULT_FEATURES), 10.0))) \
+        == DATASET_SIZE
+
+
+@pytest.mark.parametrize("engine", list(_ENGINES))
+def test_search_after_removing_every_dataset_track(dataset, engine) -> None:
+    track_list = TrackList(dataset, engine=engine)
+    track_list.add_track(Track("added", "Artist", "Album", "Song", 50, 200_000, False, "pop"),
+                         [0.5] * len(DEFAULT_FEATURES))
+    for row in range(DATASET_SIZE):
+        track_list.remove_track(f"track{row}")
+    wait_for_compaction(track_list)
+
+    assert track_list._feature_index().algorithm._state[0][0] is None
+    assert [track.track_id for track in track_list.find_multiple_similar("added", 5)] == ["added"]
+
+
+@pytest.mark.parametrize("engine", list(_ENGINES))
+def test_within_finds_every_point_in_radius(dataset, engine) -> None:
+    track_list = TrackList(dataset, engine=engine)
+    track_list.remove_track("track1")
+    algorithm = track_list._feature_index().algorithm
+    target = algorithm.get_point("track0")
+
+    found = sorted((track_id, dist_sq) for dist_sq, track_id in algorithm.within(target, 0.9))
+    expected = []
+    for row in range(DATASET_SIZE):
+        track_id = track_list.get_track_id(row)
+        point = algorithm.get_point(track_id)
+        if point is not None and sum((p - t) ** 2 for p, t in zip(point, target)) <= 0.9 ** 2:
+            expected.append(track_id)
+
+    assert [track_id for track_id, _ in found] == sorted(expected)
+    assert "track0" in expected and "track1" not in expected and len(expected) < DATASET_SIZE - 1
+
+
+def test_distinct_search_with_saved_duplicate_groups(dataset) -> None:
+    found = []
+    for _ in range(2):
+        # The first TrackList makes and saves the groups, the second loads them
+        track_list = TrackList(dataset)
+        track_list.add_track(Track("again", "Artist 0", "Single", "Song 0 - Remastered", 50, 200_000, False, "pop"),
+                             track_list._feature_index().algorithm.get_point("track0"))
+        track_list.remove_track("track1")
+        found.append([track.track_id for track in track_list.find_multiple_similar("again", DATASET_SIZE,
+                                                                                  distinct=True)])
+
+    assert found[0] == found[1]
+    # track0 represents the song, so its later release is left out
+    assert found[0][0] == "track0" and "again" not in found[0] and "track1" not in found[0]
+    assert len(found[0]) == DATASET_SIZE - 1
+
+
+@pytest.mark.parametrize("engine", [engine for engine in _ENGINES if engine != "brute_force"])
+@pytest.mark.parametrize("filtered", [False, True])
+def test_search_matches_brute_force(large_dataset, engine, filtered) -> None:
+    track_list = TrackList(large_dataset, engine=engine)
+    truth = TrackList(large_dataset, engine="brute_force")
+    rng = random.Random(5)
+
+    found = expected = 0
+    for _ in range(40):
+        track_id = f"track{rng.randrange(GROUND_TRUTH_SIZE)}"
+        excluded = {f"track{rng.randrange(GROUND_TRUTH_SIZE)}" for _ in range(40)}
+        track_filter = TrackFilter(["pop"], popularity=(20, 90), excluded_ids=excluded) if filtered \
+            else TrackFilter(excluded_ids=excluded if rng.random() < 0.5 else frozenset())
+        count = rng.choice([1, 7, 30])
+
+        result = nearest(track_list, track_id, count, track_filter)
+        exact = nearest(truth, track_id, count, track_filter)
+        assert len(result) == len(exact)
+        if engine in EXACT_ENGINES:
+            assert [label for _, label in result] == [label for _, label in exact]
+            assert [dist_sq for dist_sq, _ in result] == pytest.approx([dist_sq for dist_sq, _ in exact],
+                                                                       rel=1e-12, abs=1e-15)
+        found += len({label for _, label in result} & {label for _, label in exact})
+        expected += len(exact)
+
+    assert found / expected >= MIN_RECALL
+
+
+def test_filtered_search_matches_naive_scan(large_dataset, monkeypatch) -> None:
+    # Only tracks with a low danceability (the first feature) are jazz, and popularity
+    # grows with danceability, so both are confined to some subtrees of the KD-trees
+    with open(large_dataset, encoding="UTF-8", newline="") as file:
+        rows = list(csv.reader(file))
+    for row in rows[1:]:
+        danceability = float(row[8])
+        row[5] = str(round(danceability * 100))
+        if danceability < 0.1:
+            row[20] = "jazz"
+    with open(large_dataset, "w", encoding="UTF-8", newline="") as file:
+        csv.writer(file).writerows(rows)
+    genre = {row[1]: row[20] for row in rows[1:]}
+    popularity = {row[1]: int(row[5]) for row in rows[1:]}
+    assert 0 < list(genre.values()).count("jazz") < 0.2 * GROUND_TRUTH_SIZE
+
+    filters = [
+        (TrackFilter(["jazz"]), lambda track_id: genre[track_id] == "jazz"),
+        (TrackFilter(["jazz", "rock"], excluded_ids={"track3", "track4"}),
+         lambda track_id: genre[track_id] != "pop" and track_id not in {"track3", "track4"}),
+        (TrackFilter(popularity=(0, 15)), lambda track_id: popularity[track_id] <= 15),
+        (TrackFilter(["pop"], popularity=(60, 70)),
+         lambda track_id: genre[track_id] == "pop" and 60 <= popularity[track_id] <= 70),
+        (TrackFilter(["blues"]), lambda track_id: False),
+    ]
+
+    # Count the subtrees skipped by their summaries, to check that pruning is exercised
+    excludes = SubtreeSummaries.excludes
+    skipped = []
+
+    def counting_excludes(summaries: SubtreeSummaries, node: int, bound_filter) -> bool:
+        if excludes(summaries, node, bound_filter):
+            skipped.append(node)
+            return True
+        return False
+    monkeypatch.setattr(SubtreeSummaries, "excludes", counting_excludes)
+
+    for engine in EXACT_ENGINES:
+        track_list = TrackList(large_dataset, engine=engine)
+        algorithm = track_list._feature_index().algorithm
+        points = {track_id: algorithm.get_point(track_id) for track_id in genre}
+        for track_filter, passes in filters:
+            for query in ("track0", "track1", "track2"):
+                target = points[query]
+                expected = sorted((sum((p - t) ** 2 for p, t in zip(point, target)), track_id)
+                                  for track_id, point in points.items() if passes(track_id))
+                for count in (1, 10, 50):
+                    found = nearest(track_list, query, count, track_filter)
+                    assert [track_id for _, track_id in found] == [track_id for _, track_id in expected[:count]]
+                    assert [dist_sq for dist_sq, _ in found] == \
+                        pytest.approx([dist_sq for dist_sq, _ in expected[:count]], rel=1e-12, abs=1e-15)
+
+    assert skipped
+
+
+def test_similarity_cache_reuses_prefix_until_tracks_change(dataset) -> None:
+    track_list = TrackList(dataset)
+    cache = track_list.similarity_cache
+
+    first = [track.track_id for track in track_list.find_multiple_similar("track0", 10)]
+    assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+    assert [track.track_id for track in track_list.find_multiple_similar("track0", 4)] == first[:4]
+    assert cache.hits == 1
+
+    # Adding a track clears the cache, so the repeated query finds it
+    track_list.add_track(Track("twin", "Artist", "Album", "Song", 50, 200_000, False, "pop"),
+                         track_list._feature_index().algorithm.get_point("track0"))
+    assert len(cache) == 0
+    found = [track.track_id for track in track_list.find_multiple_similar("track0", 4)]
+    assert sorted(found[:2]) == ["track0", "twin"] and found[2:] == first[1:3]
+    assert cache.hits == 1
+
+    # And so does removing one, which must not be found anymore
+    generation = cache.generation
+    track_list.remove_track("twin")
+    assert [track.track_id for track in track_list.find_multiple_similar("track0", 4)] == first[:4]
+
+    # Results computed before the last change are not cached
+    cache.put(("track0", "stale", "", None), 4, first[:4], generation)
+    assert cache.get(("track0", "stale", "", None), 4) is None
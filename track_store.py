@@ -0,0 +1,113 @@
+"""
+Compact storage of the metadata of every track of a TrackList.
+
+Holding one Track object per track costs several hundred bytes each: the object itself,
+its dictionary, and a separate string object for every field, although most tracks
+share their artists and genre with many others. A TrackStore keeps the metadata in
+columns instead:
+ - track names and album names are read from the memory-mapped string tables of the
+   dataset cache (see dataset_cache.py), so they take no memory until used
+ - artists and genres are interned: every distinct value is stored once, and every
+   track holds its (4 byte) code
+ - popularity, duration and explicit are typed arrays
+
+The dataset cache already holds the codes and typed columns, which are copied as they
+are, so loading the metadata of the dataset parses and interns nothing.
+
+Track objects are only created when asked for (see TrackStore.track), and are not kept.
+"""
+from __future__ import annotations
+from array import array
+from typing import Sequence
+
+from dataset_cache import TrackColumns
+from datatypes import Track
+from filters import TrackAttributes
+
+# Columns of free text, read from the dataset's string tables
+_TEXT_COLUMNS = ("album_name", "track_name")
+
+
+class TrackStore(TrackAttributes):
+    """
+    Metadata of every row of a TrackList, in columns, from which Track objects are
+    created on demand. The rows of the dataset come first, followed by the tracks added
+    since.
+
+    attributes:
+     - ids : id of the track on every row
+     - artists : the distinct artists, by code
+     - artist_codes : maps artists to their code
+     - artist : artists code of every row
+     - _dataset_size : number of rows of the dataset
+     - _dataset_text : string table of every text column, for the rows of the dataset
+     - _added_text : values of every text column, for the rows added since
+
+    representation invariants:
+     - len(ids) == len(artist) == len(self)
+     - artist_codes[artists[i]] == i
+     - len(added_text[name]) == len(ids) - _dataset_size for every name in _TEXT_COLUMNS
+    """
+    ids: list[str]
+    artists: list[str]
+    artist_codes: dict[str, int]
+    artist: array
+    _dataset_size: int
+    _dataset_text: dict[str, Sequence[str]]
+    _added_text: dict[str, list[str]]
+
+    def __init__(self, columns: TrackColumns) -> None:
+        """Initialize the store with the rows of the dataset with the given columns."""
+        super().__init__()
+        strings, numbers = columns.strings, columns.numbers
+
+        self.ids = list(strings["track_id"])
+        genres = columns.interned["track_genre"]
+        self.extend_columns(list(genres.values), genres.codes, numbers["explicit"], numbers["popularity"],
+                            numbers["duration_ms"])
+
+        artists = columns.interned["artists"]
+        self.artists = list(artists.values)
+        self.artist_codes = dict(zip(self.artists, range(len(self.artists))))
+        self.artist = array("i")
+        self.artist.frombytes(artists.codes.cast("B"))
+
+        self._dataset_size = len(self.ids)
+        self._dataset_text = {name: strings[name] for name in _TEXT_COLUMNS}
+        self._added_text = {name: [] for name in _TEXT_COLUMNS}
+
+    def add(self, track: Track) -> int:
+        """Append a row for the given track and return it."""
+        self.ids.append(track.track_id)
+        self.append(track)
+        code = self.artist_codes.get(track.artists)
+        if code is None:
+            code = self.artist_codes[track.artists] = len(self.artists)
+            self.artists.append(track.artists)
+        self.artist.append(code)
+        for name in _TEXT_COLUMNS:
+            self._added_text[name].append(getattr(track, name))
+        return len(self.ids) - 1
+
+    def text(self, name: str, row: int) -> str:
+        """
+        Return the value of the given text column ("album_name" or "track_name") on row.
+
+        Preconditions:
+            - name in _TEXT_COLUMNS
+            - 0 <= row < len(self)
+        """
+        if row < self._dataset_size:
+            return self._dataset_text[name][row]
+        return self._added_text[name][row - self._dataset_size]
+
+    def track(self, row: int) -> Track:
+        """
+        Return a new Track object holding the metadata of the given row.
+
+        Preconditions:
+            - 0 <= row < len(self)
+        """
+        return Track(self.ids[row], self.artists[self.artist[row]], self.text("album_name", row),
+                     self.text("track_name", row), self.popularity[row], self.duration_ms[row],
+                     bool(self.explicit[row]), self.genres[self.genre[row]])
@@ -3,9 +3,57 @@ Contains one Object, the TrackList object
 TrackList is used to interact with a dataset.
 """
 from __future__ import annotations
-import csv
+import heapq
+import math
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Collection, Container, Iterable, Iterator, Mapping, Optional, \
+    Sequence, Union
 
+import numpy as np
+
+from dataset_cache import DEFAULT_FEATURES, TrackColumns, load_dataset
 from datatypes import Track
+from duplicates import DuplicateGroups
+from filters import BoundFilter, SubtreeSummaries, TrackFilter
+from hnsw import HNSW
+from metrics import DEFAULT_FEATURE_SET, FeatureSet, FeatureSpace
+from quantize import QuantizedIndex
+from search_index import SearchIndex
+from track_store import TrackStore
+
+if TYPE_CHECKING:
+    from parallel import QueryPool
+
+# Bumped whenever the layout of the indexes saved by the engines below changes
+_INDEX_VERSION = 3
+
+# Type of every node array of a _KDTree
+_NODE_DTYPES = {
+    "point_index": np.int64,
+    "split_axis": np.uint8,
+    "split_value": np.float64,
+    "left": np.int64,
+    "right": np.int64,
+}
+
+# Ranges of at most this many points are split level by level when building a _KDTree,
+# in batches of up to _SMALL_BATCH points
+_SMALL_RANGE = 256
+_SMALL_BATCH = 1 << 16
+
+# Points are first compared to the bound of a search by math.dist, and only those within
+# the bound times this (well above its rounding error) have their exact squared distance
+# computed, so results are the same as comparing exact distances only
+_DISTANCE_SLACK = 1 + 1e-9
+
+# Batch searches compare blocks of this many queries against this many points at a time
+_QUERY_BLOCK = 128
+_POINT_BLOCK = 4096
+
+# Similarity matrices are computed in blocks of this many by this many tracks
+_PAIR_BLOCK = 256
 
 
 class TrackList:
@@ -20,367 +68,1676 @@ class TrackList:
     self.find_similar(track_id) : Return Track object that is closes to the Track associated with ID
     self.find_multiple_similar(track_id, count) Return list of size 'count' of Track objects close
                                             close to the Track associated with ID
+    self.find_multiple_similar_batch(track_ids, count) Return matrices of the rows and distances
+                                            of the 'count' tracks closest to each of track_ids
+    self.get_similarity(track_id1, track_id2) Return how similar two tracks are, from 1 (same features) towards 0
+    self.similarity_matrix(track_ids) Return the similarity between every pair of track_ids, as a matrix
+    self.find_within(track_id, radius) Yield every Track within distance 'radius' of the Track
+                                            associated with ID, with its distance
 
 
     attributes:
-     - _tracks : maps id to Track objects (Track objects hold metadata about the song such as artist, track name and album)
-     - _algorithm : Search algorithm used to find similar tracks to input ID
+     - dataset : path of the CSV file the tracks were loaded from
+     - _store : metadata of every row (such as artist, track name and album), that Track
+       objects are created from and searches can be filtered on
+     - _ids : id of the track on each row of the dataset, followed by the tracks added since
+       (the ids of _store)
+     - _rows : maps the id of every track in the dataset (not removed) to its row
+     - feature_sets : maps name to every feature set tracks can be compared by
+     - _indexes : maps the name of every feature set searched so far to its index
+     - _columns : columns of the dataset, memory-mapped from its cache
+     - _index_path : path the index of the default feature set is saved to
+     - _engine_options : keyword arguments of the engine
+     - _added_features : features of the tracks added with add_track, by name, in order
+     - _removed_rows : rows of the tracks removed with remove_track
+     - _duplicates : duplicate groups of the tracks, loaded (or made and saved, at dataset +
+       ".duplicates") on the first distinct search, or None
+     - engine : name of the search algorithm, one of the keys of _ENGINES
+     - similarity_cache : results of recent find_similar / find_multiple_similar calls
+     - _lock : held while loading the index of a feature set, or adding or removing tracks
     """
 
-    _tracks: dict[str, Track]
-    _algorithm: _KDTree
-
-    def __init__(self, dataset: str) -> None:
+    dataset: str
+    _store: TrackStore
+    _ids: list[str]
+    _rows: dict[str, int]
+    feature_sets: dict[str, FeatureSet]
+    _indexes: dict[str, _FeatureIndex]
+    _columns: TrackColumns
+    _index_path: str
+    _engine_options: dict[str, Any]
+    _added_features: list[dict[str, float]]
+    _removed_rows: set[int]
+    _duplicates: Optional[DuplicateGroups]
+    engine: str
+    similarity_cache: _SimilarityCache
+    _lock: threading.Lock
+
+    def __init__(self, dataset: str, index_path: Optional[str] = None, engine: str = "kdtree",
+                 engine_options: Optional[dict[str, Any]] = None, cache_size: int = 4096,
+                 metric: str = "euclidean", standardize: bool = False,
+                 weights: Optional[Sequence[float]] = None, feature_sets: Iterable[FeatureSet] = ()) -> None:
         """
         Load track data from a CSV file and initialize the search algorithm.
 
+        engine picks the search algorithm, one of the keys of _ENGINES:
+         - "kdtree" : _KDTree, one point per node
+         - "bucket_kdtree" : _BucketKDTree, numpy arrays with buckets of points in the leaves
+         - "hnsw" : hnsw.HNSW, a graph that finds most (not always all) of the closest
+           tracks in a fraction of the time
+         - "pq" : quantize.QuantizedIndex, compressed feature vectors for very large
+           datasets, with the closest candidates re-ranked exactly
+         - "brute_force" : _BruteForce, compares against every track with numpy
+
+        engine_options holds keyword arguments for the engine, such as leaf_size for
+        "bucket_kdtree", m, ef_construction and ef_search for "hnsw" (see
+        benchmarks.py recall for how they trade recall for speed), or codec ("pq" or
+        "float32") and rerank for "pq".
+
+        Tracks are compared in the feature space (see metrics.py) given by metric (one of
+        metrics.METRICS), standardize and weights (one per feature, in the order below).
+        The feature matrix is mapped into that space once, here, and every distance and
+        similarity returned (and the radius of find_within) is measured in it. By default
+        the raw features are compared with euclidean distance.
+
+        These are the features of the default feature set (named
+        metrics.DEFAULT_FEATURE_SET). feature_sets adds other sets of features (such as
+        those of metrics.FEATURE_SETS) that searches can compare tracks by instead, by
+        passing the name of the set as their feature_set argument. Every feature set has
+        its own index, built (or loaded) the first time it is searched and saved next to
+        the one of the default set, at dataset + "." + name + "." + engine (or index_path
+        + "." + name). All feature sets share the same tracks and metadata.
+
+        The results of the last cache_size distinct searches excluding no track (by
+        track, feature set and filters) are kept in self.similarity_cache, so asking
+        again (for as many similar tracks or fewer) does not search the index again.
+
+        The index built over the dataset is saved to index_path (by default
+        dataset + "." + engine) and memory-mapped from there on later runs, as long as the
+        dataset has not changed since.
+
         Preconditions:
             - dataset must be a valid path to a CSV file.
             - The CSV file must have a header row followed by data rows.
             - Expected CSV columns (by index) include:
                 8: danceability,
                 9: energy,
+                10: key,
                 11: loudness,
+                12: mode,
                 13: speechiness,
                 14: acousticness,
                 15: instrumentalness,
                 16: livevness,
-                17: valence
-        """
+                17: valence,
+                18: tempo,
+                19: time_signature
 
-        self._tracks = {}
+        The CSV is compiled into a binary cache (see dataset_cache.py) the first time it
+        is loaded, later runs read the cache instead of parsing the CSV again.
 
-        # Contains points used in kd tree for search algorithm, in the form {name: (points)}
-        track_points = {}
-
-        with open(dataset, "r", encoding="UTF-8") as data:
-            track_reader = csv.reader(data)
+        Raise ValueError if metric is not one of metrics.METRICS or weights does not hold
+        one weight per default feature.
+        """
 
-            next(track_reader)
+        self.dataset = dataset
 
-            for track in track_reader:
+        # Parsed columns of the dataset, loaded from (or compiled into) its binary cache
+        self._columns = load_dataset(dataset)
 
-                track_point = (
-                    float(track[8]), # danceability
-                    float(track[9]), # energy
-                    float(track[11]), # loudness
-                    float(track[13]), # speechiness
-                    float(track[14]), # acousticness
-                    float(track[15]), # instrumentalness
-                    float(track[16]), # livevness
-                    float(track[17]) # valence
-                    )
+        self._store = TrackStore(self._columns)
+        self._ids = self._store.ids
+        self._rows = dict(zip(self._ids, range(len(self._ids))))
+        self._duplicates = None
 
-                track_points[track[1]] = track_point
+        self.feature_sets = {DEFAULT_FEATURE_SET: FeatureSet(DEFAULT_FEATURE_SET, DEFAULT_FEATURES, metric,
+                                                             standardize, weights)}
+        self.feature_sets.update((feature_set.name, feature_set) for feature_set in feature_sets)
+        self._indexes = {}
+        self._index_path = f"{dataset}.{engine}" if index_path is None else index_path
+        self._engine_options = {} if engine_options is None else engine_options
+        self._added_features = []
+        self._removed_rows = set()
+        self.engine = engine
+        self.similarity_cache = _SimilarityCache(cache_size)
+        self._lock = threading.Lock()
 
-                #Left out key, mode, tempo and time signature as currently we do not need it.
-                new_track = Track(
-                    track_id = track[1],
-                    artists = track[2],
-                    album_name = track[3],
-                    track_name = track[4],
-                    popularity = track[5],
-                    duration_ms = track[6],
-                    explicit = track[7],
-                    track_genre = track[20],
-                    )
+        # The default feature set is searched by almost every TrackList, load it right away
+        self._feature_index()
 
-                self._tracks[track[1]] = new_track
+    def _feature_index(self, feature_set: Optional[str] = None) -> _FeatureIndex:
+        """
+        Return the index of the feature set with the given name (by default, the default
+        feature set), loading it if this is the first time it is asked for.
 
-        self._algorithm = _KDTree(track_points)
+        Raise ValueError if there is no feature set with this name.
+        """
+        name = DEFAULT_FEATURE_SET if feature_set is None else feature_set
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        if name not in self.feature_sets:
+            raise ValueError(f"Unknown feature set {name!r}, expected one of {', '.join(self.feature_sets)}")
+
+        with self._lock:
+            if name not in self._indexes:
+                self._indexes[name] = self._load_index(self.feature_sets[name])
+            return self._indexes[name]
+
+    def _load_index(self, feature_set: FeatureSet) -> _FeatureIndex:
+        """
+        Return the index of the given feature set, built over the dataset (or loaded from
+        where it was saved) and then updated with the tracks added and removed since.
+        """
+        columns = self._columns
+        raw_features = _feature_matrix(columns, feature_set.features)
+        space = feature_set.fit(raw_features)
+        features = space.transform_columns(raw_features)
+
+        if feature_set.name == DEFAULT_FEATURE_SET:
+            index_path = self._index_path
+        elif self._index_path == f"{self.dataset}.{self.engine}":
+            index_path = f"{self.dataset}.{feature_set.name}.{self.engine}"
+        else:
+            index_path = f"{self._index_path}.{feature_set.name}"
+
+        key = self._data_key(feature_set, space)
+
+        # The index shares the ids and rows of this TrackList, and searches the columns of
+        # features in place
+        engine_class = _ENGINES[self.engine]
+        rebuild_engine = _REBUILD_ENGINES.get(self.engine, self.engine)
+        rebuild = partial(_ENGINES[rebuild_engine].build,
+                          **(self._engine_options if rebuild_engine == self.engine else {}))
+        base = engine_class.load(index_path, self._ids, features, key, self._rows, **self._engine_options)
+        if base is None:
+            base = engine_class.build(self._ids, features, self._rows, **self._engine_options)
+            try:
+                base.save(index_path, key)
+            except OSError:
+                pass  # Not being able to save only means the tree is rebuilt next time
+
+        # Removed tracks are no longer in self._rows, so the base index cannot find them to
+        # remove them: they start out removed instead
+        size = features.shape[1]
+        removed = {self._ids[row] for row in self._removed_rows if row < size}
+        index = _FeatureIndex(feature_set, space, features,
+                              _DynamicIndex(base, rebuild, removed))
+        for row, values in enumerate(self._added_features, size):
+            index.add(self._ids[row], values)
+        for row in self._removed_rows:
+            if row >= size:
+                index.algorithm.remove(self._ids[row])
+        return index
+
+    def _data_key(self, feature_set: FeatureSet, space: FeatureSpace) -> str:
+        """
+        Return the key identifying the dataset and the features of the given feature set
+        (mapped into space) that an index, or anything else saved, was made from.
+        """
+        # Anything made from other features, or in another feature space, is out of date too
+        if feature_set.features != DEFAULT_FEATURES or not space.is_identity():
+            return f"{self._columns.digest}:{feature_set.key()}"
+        return self._columns.digest
 
     def get_track(self, track_id: str) -> Track:
         """
         Retrieve the Track object associated with the given track_id if found. Else, return None.
+
+        Track objects are created from the metadata kept in self._store on every call, so
+        two calls for the same track return equal, but different, objects.
         """
-        if track_id in self._tracks:
-            return self._tracks[track_id]
+        if track_id in self._rows:
+            return self._store.track(self._rows[track_id])
         else:
             return None
 
-    def get_similarity(self, track_id1: str, track_id2: str) -> float:
-        raise NotImplementedError
+    def get_similarity(self, track_id1: str, track_id2: str, feature_set: Optional[str] = None) -> float:
+        """
+        Return how similar the tracks associated with track_id1 and track_id2 are, from 1
+        for tracks with the same features down towards 0 as their features grow apart.
+
+        The similarity is 1 / (1 + d), where d is the (euclidean) distance between the
+        feature vectors of the two tracks, the distance every search ranks tracks by.
+        Tracks are compared by the given feature set (by default, the default one).
+
+        Preconditions:
+            - track_id1 and track_id2 must exist in the dataset.
+        """
+        index = self._feature_index(feature_set)
+        point1 = index.point(self._rows[track_id1])
+        point2 = index.point(self._rows[track_id2])
+
+        return 1 / (1 + math.dist(point1, point2))
 
-    def find_similar(self, track_id: str) -> Track:
+    def similarity_matrix(self, track_ids: Sequence[str], path: Optional[str] = None,
+                          feature_set: Optional[str] = None) -> np.ndarray:
         """
-        Find and return the Track object most similar to the track associated with track_id.
+        Return the matrix of the similarity (see get_similarity) between every pair of
+        tracks in track_ids, with one line and one column per track, in order, compared by
+        the given feature set (by default, the default one).
+
+        The matrix is computed _PAIR_BLOCK by _PAIR_BLOCK tracks at a time, so apart from
+        the matrix itself only a few megabytes are used however many tracks there are. If
+        path is given, the matrix is written to a .npy file at path as it is computed and
+        returned memory-mapped from it, so it does not have to fit in memory and can be
+        opened by other programs with numpy.load(path, mmap_mode="r").
 
         Preconditions:
-            - track_id must exist in the dataset.
+            - every id in track_ids must exist in the dataset.
+        """
+        index = self._feature_index(feature_set)
+        points = np.array([index.point(self._rows[track_id]) for track_id in track_ids], dtype=np.float64)
+        points = points.reshape(len(track_ids), index.features.shape[0])
+        size = len(points)
+
+        if path is None:
+            matrix = np.empty((size, size))
+        else:
+            matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(size, size))
+
+        # The matrix is symmetric, so only the blocks on or above the diagonal are computed
+        for first in range(0, size, _PAIR_BLOCK):
+            block = points[first:first + _PAIR_BLOCK]
+            for other in range(first, size, _PAIR_BLOCK):
+                difference = block[:, None] - points[None, other:other + _PAIR_BLOCK]
+                similarity = 1 / (1 + np.sqrt(np.einsum("ijk,ijk->ij", difference, difference)))
+                matrix[first:first + _PAIR_BLOCK, other:other + _PAIR_BLOCK] = similarity
+                matrix[other:other + _PAIR_BLOCK, first:first + _PAIR_BLOCK] = similarity.T
+
+        if path is not None:
+            matrix.flush()
+        return matrix
+
+    def find_similar(self, track_id: str, feature_set: Optional[str] = None) -> Track:
         """
-        point = self._algorithm.get_point(track_id)
+        Find and return the Track object most similar to the track associated with track_id,
+        compared by the given feature set (by default, the default one).
 
-        similar_id = self._algorithm.nearest_neighbour(point)
+        Preconditions:
+            - track_id must exist in the dataset.
+        """
+        similar_id = self._similar_ids(track_id, 1, feature_set)[0]
 
         return self.get_track(similar_id)
 
-    def find_multiple_similar(self, track_id: str, count: int) -> list[Track]:
+    def find_multiple_similar(self, track_id: str, count: int, genres: Optional[Iterable[str]] = None,
+                              explicit: Optional[bool] = None, popularity: Optional[tuple[int, int]] = None,
+                              duration_ms: Optional[tuple[int, int]] = None,
+                              excluded: Collection[str] = frozenset(), distinct: bool = False,
+                              feature_set: Optional[str] = None) -> list[Track]:
         """
         Find and return a list of Track objects that are most similar to the track associated with track_id.
 
+        The search can be limited to tracks of the given genres, to explicit (or clean)
+        tracks, to tracks with popularity and duration_ms within the given (inclusive)
+        ranges, and to tracks whose id is not in excluded. If distinct is True, only one
+        release of every song is returned (see duplicates.py). Tracks are filtered during
+        the search, so count tracks are returned as long as that many pass.
+
+        Tracks are compared by the given feature set (by default, the default one).
+
         Preconditions:
             - track_id must exist in the dataset.
             - count must be a positive integer.
         """
-        point = self._algorithm.get_point(track_id)
-
-        similar_ids = self._algorithm.n_nearest_neighbours(point, count)
+        track_filter = TrackFilter(genres, explicit, popularity, duration_ms, excluded, distinct)
+        if excluded:
+            # Every query excludes different tracks, so its results are not worth caching
+            duplicates = self._duplicate_groups() if distinct else None
+            algorithm = self._feature_index(feature_set).algorithm
+            point = algorithm.get_point(track_id)
+            similar_ids = algorithm.n_nearest_neighbours(
+                point, count, track_filter.bind(self._store, self._rows, duplicates))
+        else:
+            similar_ids = self._similar_ids(track_id, count, feature_set, track_filter)
 
         return [self.get_track(id) for id in similar_ids]
 
-    def add_track(self, Track):
-        raise NotImplementedError
+    def _duplicate_groups(self) -> DuplicateGroups:
+        """
+        Return the duplicate groups of the tracks, loading them (or making and saving
+        them) if this is the first call.
+
+        Groups are made from every track of the dataset; the tracks added and removed
+        since are then added to and removed from them.
+        """
+        if self._duplicates is None:
+            index = self._feature_index()
+            path = f"{self.dataset}.duplicates"
+            key = self._data_key(index.feature_set, index.space)
+            size = len(self._columns)
+
+            duplicates = DuplicateGroups.load(path, key, self._row_point)
+            if duplicates is None:
+                store = self._store
+                rows = range(size)
+                duplicates = DuplicateGroups(rows, [store.text("track_name", row) for row in rows],
+                                             [store.artists[store.artist[row]] for row in rows], self._row_point)
+                try:
+                    duplicates.save(path, key)
+                except OSError:
+                    pass  # Not being able to save only means the groups are made again next time
+
+            for row in sorted(self._removed_rows):
+                if row < size:
+                    duplicates.remove(row)
+            for row in range(size, len(self._ids)):
+                if row not in self._removed_rows:
+                    duplicates.add(row, self._store.text("track_name", row),
+                                   self._store.artists[self._store.artist[row]])
+            self._duplicates = duplicates
+        return self._duplicates
+
+    def _row_point(self, row: int) -> tuple[float]:
+        """Return the feature vector, in the default feature set, of the track on the given row."""
+        return self._feature_index().point(row)
+
+    def _similar_ids(self, track_id: str, count: int, feature_set: Optional[str] = None,
+                     track_filter: Optional[TrackFilter] = None) -> list[str]:
+        """
+        Return the ids of the count tracks most similar to the track associated with
+        track_id that pass track_filter (if given), compared by the given feature set,
+        from self.similarity_cache if possible.
+
+        Preconditions:
+            - track_id must exist in the dataset.
+            - count must be a positive integer.
+            - track_filter must not exclude any id (see TrackFilter.key).
+        """
+        algorithm = self._feature_index(feature_set).algorithm
+        if track_filter is not None and track_filter.is_empty():
+            track_filter = None
+        key = (track_id, self.engine, DEFAULT_FEATURE_SET if feature_set is None else feature_set,
+               None if track_filter is None else track_filter.key())
+        similar_ids = self.similarity_cache.get(key, count)
+        if similar_ids is not None:
+            return similar_ids
+
+        generation = self.similarity_cache.generation
+        point = algorithm.get_point(track_id)
+        if track_filter is None:
+            similar_ids = algorithm.n_nearest_neighbours(point, count)
+        else:
+            duplicates = self._duplicate_groups() if track_filter.distinct else None
+            similar_ids = algorithm.n_nearest_neighbours(point, count,
+                                                         track_filter.bind(self._store, self._rows, duplicates))
+        self.similarity_cache.put(key, count, similar_ids, generation)
+
+        return similar_ids
+
+    def find_within(self, track_id: str, radius: float,
+                    feature_set: Optional[str] = None) -> Iterator[tuple[Track, float]]:
+        """
+        Yield every track within (euclidean) distance radius of the track associated with
+        track_id, including itself, along with its distance, compared by the given
+        feature set (by default, the default one).
+
+        Tracks are yielded as the search finds them, not sorted by distance, so even very
+        large results are never held in memory all at once.
 
+        Preconditions:
+            - track_id must exist in the dataset.
+            - radius >= 0
+        """
+        algorithm = self._feature_index(feature_set).algorithm
+        point = algorithm.get_point(track_id)
+
+        for dist_sq, similar_id in algorithm.within(point, radius):
+            track = self.get_track(similar_id)
+            if track is not None:  # Removed while the search was running
+                yield track, math.sqrt(dist_sq)
+
+    def find_multiple_similar_batch(self, track_ids: Sequence[str], count: int,
+                                    pool: Optional[QueryPool] = None,
+                                    feature_set: Optional[str] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the count tracks most similar to each track in track_ids, all at once.
 
-class KDNode:
-    """ One Node in a KD-Tree
+        Return two matrices with one line per track in track_ids, closest tracks first:
+         - the row of each similar track, to be looked up with self.get_track_id
+         - the (euclidean) distance of each similar track
+
+        Like find_multiple_similar, each track is its own closest match, and removed
+        tracks are never returned. Rather than searching the index once per track, this
+        compares blocks of tracks against the whole feature matrix at once, which is much
+        faster for large batches. If pool (a parallel.QueryPool) is given, the blocks are
+        spread over its worker processes. Tracks are compared by the given feature set
+        (by default, the default one).
+
+        Preconditions:
+            - every id in track_ids must exist in the dataset.
+            - count must be a positive integer.
+        """
+        index = self._feature_index(feature_set)
+        rows = np.array([self._rows[track_id] for track_id in track_ids], dtype=np.int64)
+        dimension, size = index.features.shape
+        added = np.array(index.added_points, dtype=np.float64).reshape(-1, dimension).T
+
+        queries = np.empty((len(rows), dimension))
+        in_dataset = rows < size
+        queries[in_dataset] = index.features[:, rows[in_dataset]].T
+        queries[~in_dataset] = added[:, rows[~in_dataset] - size].T
+
+        removed = np.zeros(size + len(index.added_points), bool)
+        removed[list(self._removed_rows)] = True
+
+        if pool is None:
+            similar_rows, distances = _block_nearest(queries, index.features, count, index.norms, removed[:size])
+        else:
+            similar_rows, distances = pool.search(queries, count, np.flatnonzero(removed[:size]), index.feature_set,
+                                                  index.space)
+
+        if index.added_points:
+            added_rows, added_distances = _block_nearest(queries, added, count, removed=removed[size:])
+            similar_rows, distances = _merge_nearest(similar_rows, distances, added_rows + size,
+                                                     added_distances, count)
+
+        return similar_rows, np.sqrt(distances)
+
+    def get_track_id(self, row: int) -> str:
+        """
+        Return the id of the track on the given row of the dataset, as returned by
+        find_multiple_similar_batch.
+
+        Preconditions:
+            - 0 <= row < number of tracks in the dataset
+        """
+        return self._ids[row]
+
+    def get_row(self, track_id: str) -> int:
+        """
+        Return the row of the dataset holding the track with the given id.
+
+        Preconditions:
+            - track_id must exist in the dataset.
+        """
+        return self._rows[track_id]
+
+    def add_track(self, track: Track, point: Union[Sequence[float], Mapping[str, float]]) -> None:
+        """
+        Add a new track, with the given features, to the dataset.
+
+        point either maps the name of every feature used by a feature set of this
+        TrackList to its value, or holds the values of dataset_cache.DEFAULT_FEATURES, in
+        that order (which is enough as long as no other feature set uses other features).
+
+        The track can be found by every search (including ones already running in other
+        threads) as soon as this returns, without rebuilding the index.
+
+        Raise ValueError if a track with the same id is already in the dataset, or point
+        is missing features used by a feature set.
+        """
+        if track.track_id in self._rows:
+            raise ValueError(f"Track {track.track_id} is already in the dataset")
+
+        values = dict(point) if isinstance(point, Mapping) else dict(zip(DEFAULT_FEATURES, point))
+        missing = {feature for feature_set in self.feature_sets.values()
+                   for feature in feature_set.features if feature not in values}
+        if missing:
+            raise ValueError(f"Track {track.track_id} is missing features {', '.join(sorted(missing))}")
+
+        with self._lock:
+            self._rows[track.track_id] = self._store.add(track)
+            self._added_features.append(values)
+            for index in self._indexes.values():
+                index.add(track.track_id, values)
+        if self._duplicates is not None:
+            self._duplicates.add(self._rows[track.track_id], track.track_name, track.artists)
+        self.similarity_cache.clear()
+
+    def remove_track(self, track_id: str) -> None:
+        """
+        Remove the track associated with track_id from the dataset.
+
+        The track stops showing up in searches (including ones already running in other
+        threads) as soon as this returns. It stays in the index, marked as removed, until
+        enough tracks are removed for the index to be compacted in the background.
+
+        Raise ValueError if there is no track with this id in the dataset.
+        """
+        if track_id not in self._rows:
+            raise ValueError(f"Track {track_id} is not in the dataset")
+
+        with self._lock:
+            for index in self._indexes.values():
+                index.algorithm.remove(track_id)
+            row = self._rows.pop(track_id)
+            self._removed_rows.add(row)
+        if self._duplicates is not None:
+            self._duplicates.remove(row)
+        self.similarity_cache.clear()
+
+
+class _FeatureIndex:
+    """ Everything TrackList needs to search its tracks by one feature set
 
     attributes:
-     - point : tuple holding values of a song as vector points
-     - label : id of the song references
-     - left : KDNode to the 'left' compared with a specific dimension
-     - right : KDNode to the 'right' compared with a specific dimension
+     - feature_set : the features compared, and how
+     - space : feature space the features are compared in
+     - features : matrix with one line per feature of feature_set and one column per row
+       of the dataset, mapped into space
+     - norms : squared norm of the features of every row of the dataset
+     - added_points : feature vectors (mapped into space) of the tracks added with
+       TrackList.add_track, in order
+     - algorithm : search algorithm used to find similar tracks
+    """
+    feature_set: FeatureSet
+    space: FeatureSpace
+    features: np.ndarray
+    norms: np.ndarray
+    added_points: list[tuple[float]]
+    algorithm: _DynamicIndex
+
+    def __init__(self, feature_set: FeatureSet, space: FeatureSpace, features: np.ndarray,
+                 algorithm: _DynamicIndex) -> None:
+        self.feature_set = feature_set
+        self.space = space
+        self.features = features
+        self.norms = np.einsum("ij,ij->j", features, features)
+        self.added_points = []
+        self.algorithm = algorithm
+
+    def add(self, track_id: str, values: Mapping[str, float]) -> None:
+        """Add the track with the given id and features (by name) to the index."""
+        point = self.space.transform_point([values[feature] for feature in self.feature_set.features])
+        self.added_points.append(point)
+        self.algorithm.insert(track_id, point)
+
+    def point(self, row: int) -> tuple[float]:
+        """Return the feature vector of the track on the given row."""
+        size = self.features.shape[1]
+        if row < size:
+            return tuple(self.features[:, row].tolist())
+        return self.added_points[row - size]
+
+
+def _feature_matrix(columns: TrackColumns, features: Sequence[str]) -> np.ndarray:
     """
-    def __init__(self, point:tuple[float], label:str=None, left:KDNode=None, right:KDNode=None):
+    Return the matrix with one line per feature (in the given order) and one column per
+    row of the dataset with the given columns, without copying the features if they are
+    stored in that order.
+    """
+    names = list(columns.features)
+    first = names.index(features[0])
+    size = len(columns)
+    matrix = np.frombuffer(columns.matrix, dtype=np.float64).reshape(len(names), size)
+
+    if names[first:first + len(features)] == list(features):
+        return matrix[first:first + len(features)]
+    return matrix[[names.index(feature) for feature in features]]
+
+
+class _SimilarityCache:
+    """ Bounded cache of similarity search results, evicting the least recently used
+
+    Entries are keyed by (track id, engine, feature set name, filter key) and hold the ids
+    of the most similar tracks (passing the filter, see TrackFilter.key), for the largest
+    count asked for so far. A search for a smaller count is answered with
+    the start of that list, which is the same result for the exact engines (ties are
+    always broken the same way).
+
+    Searches run without holding the lock, so clear (called on every insert and removal)
+    bumps generation, and put ignores results computed before the last clear.
+
+    attributes:
+     - capacity : largest number of entries kept
+     - hits : number of get calls answered from the cache
+     - misses : number of get calls that were not
+     - generation : number of times the cache was cleared
+     - _entries : maps key to (count, similar ids), least recently used first
+     - _lock : held while reading or updating the entries
+    """
+    capacity: int
+    hits: int
+    misses: int
+    generation: int
+    _entries: OrderedDict[tuple[str, str, str, Optional[tuple]], tuple[int, list[str]]]
+    _lock: threading.Lock
+
+    def __init__(self, capacity: int) -> None:
         """
-        Initialize a KDNode with the given point, label, and optional child nodes.
+        Initialize an empty cache holding up to capacity entries.
+
+        Preconditions:
+            - capacity >= 0
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple[str, str, str, Optional[tuple]], count: int) -> Optional[list[str]]:
+        """Return the count most similar ids cached for key, or None if they are not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < count:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1][:count]
+
+    def put(self, key: tuple[str, str, str, Optional[tuple]], count: int, similar_ids: list[str], generation: int) -> None:
         """
-        self.point = point
-        self.label = label
-        self.left = left
-        self.right = right
+        Cache the count most similar ids for key, unless more are already cached or the
+        cache was cleared since generation.
+        """
+        with self._lock:
+            if generation != self.generation or self.capacity == 0:
+                return
+
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < count:
+                self._entries[key] = (count, similar_ids)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
 
-class _KDTree:
+    def clear(self) -> None:
+        """Remove every entry, keeping the hit and miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+
+class _KDTree(SearchIndex):
     """ KD-Tree implementation to attempt to search for similar points
 
+    The tree is stored as flat arrays, where node i is described by the i-th entry of
+    each array, so a built tree can be saved to disk and memory-mapped back in later
+    instead of being rebuilt (see save and load).
+
     attributes:
-     - data : Dictionary mapping id to vector points
-     - root : First node of the Tree
+     - root : index of the first node of the Tree, or -1 if the Tree is empty
+     - point_index : row (in points) of the point held by each node
+     - split_axis : dimension each node compares on
+     - split_value : coordinate of each node's point along its split axis
+     - left : index of each node's 'left' child, or -1
+     - right : index of each node's 'right' child, or -1
+     - summaries : metadata of every subtree used by filtered searches, computed on the
+       first one, or None
+     - _nodes : the node arrays as lists, and the points in node order as one flat
+       memoryview, made on the first search (see _node_lists), or None
+
+    representation invariants:
+     - Nodes are laid out in 'median order': the subtree holding the points of
+       positions lo..hi - 1 has its root at node lo + (hi - lo) // 2, so
+       self.root == len(self) // 2 for a non-empty Tree.
     """
-    def __init__(self, data):
+    root: int
+    point_index: Sequence[int]
+    split_axis: Sequence[int]
+    split_value: Sequence[float]
+    left: Sequence[int]
+    right: Sequence[int]
+    summaries: Optional[SubtreeSummaries]
+    _nodes: Optional[tuple[memoryview, list[int], list[int], list[float], list[int], list[int]]]
+
+    _VERSION = _INDEX_VERSION
+
+    def __init__(self, ids: Sequence[str], features: np.ndarray, rows: Optional[Mapping[str, int]] = None) -> None:
         """
-        Initialize the KD-Tree with the provided data.
+        Initialize the KD-Tree with the provided data, see SearchIndex.build and
+        SearchIndex.load.
 
         Preconditions:
-            - data must be a dictionary mapping track IDs (str) to non-empty tuples of floats.
+            - features must be a matrix with one line per feature and one column per point.
+        """
+        super().__init__(ids, features, rows)
+        self.root = len(self) // 2 if len(self) else -1
+        # Lines of a C-contiguous features matrix are not copied
+        self.summaries = None
+        self._nodes = None
+
+    def _attach(self, arrays: dict[str, Sequence]) -> None:
+        self.point_index = memoryview(arrays["point_index"])
+        self.split_axis = memoryview(arrays["split_axis"])
+        self.split_value = memoryview(arrays["split_value"])
+        self.left = memoryview(arrays["left"])
+        self.right = memoryview(arrays["right"])
+
+    def _arrays(self) -> dict[str, Sequence]:
+        return {
+            "point_index": self.point_index,
+            "split_axis": self.split_axis,
+            "split_value": self.split_value,
+            "left": self.left,
+            "right": self.right,
+        }
+
+    def _build(self) -> dict[str, np.ndarray]:
         """
-        self.data = data
-        points = [(key, value) for key, value in data.items()]
-        self.root = self._build_tree(points, depth=0)
+        Build the node arrays of the KD-Tree from self.points, in O(n log n) time.
 
-    def get_point(self, id) -> tuple[float]:
+        The points are never sorted as a whole or copied into sublists. The tree is built
+        in place on a single array of point indices, where every subtree owns a contiguous
+        range: selecting the median of a range along its split axis (np.argpartition)
+        moves the smaller points to its left and the larger points to its right, which
+        are the ranges of the two child subtrees.
+
+        Large ranges are split one at a time. Small ranges are far too numerous for that,
+        so batches of small ranges are split level by level, ordering every range of a
+        level at once with a single sort keyed on (range, coordinate).
         """
-        Retrieve the feature vector associated with the given track ID.
+        size = len(self)
+        nodes = {name: np.zeros(size, dtype) for name, dtype in _NODE_DTYPES.items()}
+        if size == 0:
+            return nodes
+
+        points = self.points
+        k = points.shape[1]  # Dimension of data
+        order = nodes["point_index"]
+        order[:] = np.arange(size)
+        split_axis, left, right = nodes["split_axis"], nodes["left"], nodes["right"]
+
+        ranges = [(0, size, 0)]
+        small_ranges = []
+        while ranges:
+            start, end, depth = ranges.pop()
+            if end - start <= _SMALL_RANGE:
+                small_ranges.append((start, end, depth))
+                continue
+
+            axis = depth % k
+            median = (end - start) // 2
+            segment = order[start:end]
+            segment[:] = segment[np.argpartition(points[segment, axis], median)]
+
+            node = start + median
+            split_axis[node] = axis
+            left[node] = start + (node - start) // 2
+            right[node] = node + 1 + (end - node - 1) // 2
+            ranges.append((start, node, depth + 1))
+            ranges.append((node + 1, end, depth + 1))
+
+        small_ranges = np.array(small_ranges, dtype=np.int64)
+        batch = max(1, _SMALL_BATCH // _SMALL_RANGE)
+        for first in range(0, len(small_ranges), batch):
+            start, end, depth = small_ranges[first:first + batch].T
+            while start.size:
+                non_empty = end > start
+                start, end, depth = start[non_empty], end[non_empty], depth[non_empty]
+                lengths = end - start
+                offsets = np.cumsum(lengths) - lengths
+                owner = np.repeat(np.arange(start.size), lengths)
+                positions = np.arange(lengths.sum()) + np.repeat(start - offsets, lengths)
+
+                axis = depth % k
+                values = points[order[positions], np.repeat(axis, lengths)]
+                order[positions] = order[positions[np.lexsort((values, owner))]]
+
+                node = start + lengths // 2
+                split_axis[node] = axis
+                left[node] = np.where(node > start, start + (node - start) // 2, -1)
+                right[node] = np.where(end > node + 1, node + 1 + (end - node - 1) // 2, -1)
+
+                start, end, depth = (np.concatenate(pair) for pair in
+                                     ((start, node + 1), (node, end), (depth + 1, depth + 1)))
+
+        nodes["split_value"] = points[order, split_axis]
+        return nodes
+
+    def _node_lists(self) -> tuple[memoryview, list[int], list[int], list[float], list[int], list[int]]:
+        """
+        Return the points in node order, as one flat memoryview of their coordinates, and
+        the point_index, split_axis, split_value, left and right arrays as lists.
+
+        Searches read these one element at a time, which is several times faster on a list
+        than on a memoryview (let alone a numpy array), so they are converted on the first
+        search (costing about 200 bytes per point) rather than on load.
+        """
+        if self._nodes is None:
+            order = np.asarray(self.point_index)
+            self._nodes = (memoryview(np.ascontiguousarray(self.points[order]).reshape(-1)), order.tolist(),
+                           np.asarray(self.split_axis).tolist(), np.asarray(self.split_value).tolist(),
+                           np.asarray(self.left).tolist(), np.asarray(self.right).tolist())
+        return self._nodes
+
+    def _search(self, target: tuple[float], n: int, excluded: Container[str] = frozenset(),
+                summaries: Optional[SubtreeSummaries] = None,
+                track_filter: Optional[BoundFilter] = None) -> list[tuple[float, int]]:
+        """
+        Return the squared distance and row (in self.points) of the n points closest
+        to target, closest first, skipping the points whose id is in excluded. Ties are
+        broken by index.
+
+        The best points so far are kept in a bounded max-heap, and the Tree is walked with
+        an explicit stack rather than recursion, so neither large n nor deep trees are a
+        problem. From every node the search carries on into its nearer child, and only
+        the farther child is put on the stack. excluded is only checked for points close
+        enough to make the heap.
+
+        If summaries and track_filter are given, subtrees in which no track passes
+        track_filter are skipped (excluded must then include the tracks that fail it).
 
         Preconditions:
-            - id must be a non-empty string.
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
         """
-        if id in self.data:
-            return self.data[id]
-        else:
-            return None
+        points, point_index, split_axis, split_value, left, right = self._node_lists()
+        dimension = len(target)
+
+        # Max-heap of the best points so far, as (-distance, -index)
+        best = []
+        bound = math.inf
+
+        # Subtrees still to visit, with a lower bound on their distance to target
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, lower = stack.pop()
+            while node != -1 and lower <= bound:
+                if summaries is not None and summaries.excludes(node, track_filter):
+                    break
+
+                start = node * dimension
+                point = points[start:start + dimension]
+                distance = math.dist(point, target)
+                if distance * distance <= bound * _DISTANCE_SLACK:
+                    dist_sq = sum((p - t) ** 2 for p, t in zip(point, target))
+                    index = point_index[node]
+                    if dist_sq <= bound and (not excluded or self.ids[index] not in excluded):
+                        if len(best) < n:
+                            heapq.heappush(best, (-dist_sq, -index))
+                        elif (-dist_sq, -index) > best[0]:
+                            heapq.heapreplace(best, (-dist_sq, -index))
+                        if len(best) == n:
+                            bound = -best[0][0]
+
+                gap = target[split_axis[node]] - split_value[node]
+                node, far = (left[node], right[node]) if gap < 0 else (right[node], left[node])
+                if far != -1:
+                    gap *= gap
+                    stack.append((far, gap if gap > lower else lower))
+
+        return sorted((-dist_sq, -index) for dist_sq, index in best)
+
+    def within(self, target: tuple[float], radius: float,
+               excluded: Container[str] = frozenset()) -> Iterator[tuple[float, str]]:
+        """
+        Yield the squared distance and track ID of every point within radius of the target
+        vector, as they are found (not sorted by distance), skipping the track IDs in excluded.
+
+        Every subtree covers a box of the space, and the search keeps the distance from
+        target to that box along each axis, so subtrees whose box is further than radius
+        are skipped as a whole.
 
-    def _build_tree(self, points, depth):
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - radius >= 0
+        """
+        points, point_index, split_axis, split_value, left, right = self._node_lists()
+        dimension = len(target)
+        limit = radius * radius
+
+        # Nodes still to visit, with the squared distance from target to their box, and
+        # the distance to that box along each axis
+        stack = [(self.root, 0.0, (0.0,) * len(target))]
+        while stack:
+            node, lower, offsets = stack.pop()
+            if node == -1 or lower > limit:
+                continue
+
+            start = node * dimension
+            point = points[start:start + dimension]
+            distance = math.dist(point, target)
+            if distance * distance <= limit * _DISTANCE_SLACK:
+                dist_sq = sum((p - t) ** 2 for p, t in zip(point, target))
+                index = point_index[node]
+                if dist_sq <= limit and (not excluded or self.ids[index] not in excluded):
+                    yield dist_sq, self.ids[index]
+
+            axis = split_axis[node]
+            gap = target[axis] - split_value[node]
+            near, far = (left[node], right[node]) if gap < 0 else (right[node], left[node])
+            stack.append((far, lower - offsets[axis] ** 2 + gap * gap, offsets[:axis] + (abs(gap),) + offsets[axis + 1:]))
+            stack.append((near, lower, offsets))
+
+    def filtered_nearest_with_distances(self, target: tuple[float], n: int, excluded: Container[str],
+                                        track_filter: BoundFilter) -> list[tuple[float, str]]:
         """
-        Recursively build the KD-Tree from the list of (track_id, feature_vector) tuples.
+        Same as nearest_with_distances, skipping the subtrees of the KD-Tree in which no
+        track passes track_filter.
 
         Preconditions:
-            - points must be a list of tuples where each tuple contains a track ID (str) and a feature vector (tuple of floats).
-            - depth must be a non-negative integer.
+            - every track that fails track_filter must be in excluded.
         """
-        if not points:
-            return None
+        summaries = self.summaries
+        if summaries is None or summaries.attributes is not track_filter.attributes:
+            summaries = SubtreeSummaries(track_filter.attributes, track_filter.node_rows(self.ids, self.point_index),
+                                         self.root, self.left, self.right)
+            self.summaries = summaries
 
-        k = len(points[0][1])  # Dimension of data
-        axis = depth % k
+        return [(dist_sq, self.ids[index])
+                for dist_sq, index in self._search(target, n, excluded, summaries, track_filter)]
 
-        points.sort(key=lambda x: x[1][axis])
-        median = len(points) // 2
 
-        return KDNode(
-            point=points[median][1],
-            label=points[median][0],
-            left=self._build_tree(points[:median], depth + 1),
-            right=self._build_tree(points[median + 1:], depth + 1)
-        )
+class _BucketKDTree(SearchIndex):
+    """ Array-backed KD-Tree whose leaves hold buckets of points, with the same interface
+    as _KDTree
 
-    def nearest_neighbour(self, target) -> str:
+    Instead of one tuple per point, all points are kept in one contiguous matrix, ordered
+    so that the points of every leaf are next to each other. Searches compute the
+    distances to all points of a leaf as one vectorized block, and split each inner node
+    on its widest dimension.
+
+    attributes:
+     - leaf_size : largest number of points held by one leaf
+     - leaf_points : matrix of vector points, one row per point, in leaf order
+     - order : row (in points) of the point on each row of leaf_points
+     - split_axis : dimension each inner node compares on
+     - split_value : value each inner node compares against
+     - left : 'left' child of each inner node, or -1 for leaves
+     - right : 'right' child of each inner node, or -1 for leaves
+     - start : first row of leaf_points below each node
+     - end : row after the last row of leaf_points below each node
+
+    representation invariants:
+     - Node 0 is the root of the Tree
+     - For an inner node, rows start..end - 1 are split between its children, the points
+       on the left having a value of at most split_value on split_axis and the points
+       on the right having a value of at least split_value
+    """
+    leaf_size: int
+    leaf_points: np.ndarray
+    order: Sequence[int]
+    split_axis: Sequence[int]
+    split_value: Sequence[float]
+    left: Sequence[int]
+    right: Sequence[int]
+    start: Sequence[int]
+    end: Sequence[int]
+
+    _VERSION = _INDEX_VERSION
+
+    def __init__(self, ids: Sequence[str], features: np.ndarray, rows: Optional[Mapping[str, int]] = None,
+                 leaf_size: int = 32) -> None:
         """
-        Find and return the track ID of the point in the KD-Tree closest to the target vector.
+        Initialize the KD-Tree with the provided data, see SearchIndex.build and
+        SearchIndex.load.
+
+        Preconditions:
+            - features must be a matrix with one line per feature and one column per point.
+            - leaf_size must be a positive integer.
+        """
+        super().__init__(ids, features, rows)
+        self.leaf_size = leaf_size
+
+    def _build_parameters(self) -> list:
+        return [self.leaf_size]
+
+    def _attach(self, arrays: dict[str, Sequence]) -> None:
+        self.leaf_points = np.frombuffer(arrays["leaf_points"], dtype=np.float64).reshape(self.points.shape)
+        self.order = memoryview(arrays["order"])
+        self.split_axis = memoryview(arrays["split_axis"])
+        self.split_value = memoryview(arrays["split_value"])
+        self.left = memoryview(arrays["left"])
+        self.right = memoryview(arrays["right"])
+        self.start = memoryview(arrays["start"])
+        self.end = memoryview(arrays["end"])
+
+    def _arrays(self) -> dict[str, Sequence]:
+        return {
+            "leaf_points": self.leaf_points,
+            "order": self.order,
+            "split_axis": self.split_axis,
+            "split_value": self.split_value,
+            "left": self.left,
+            "right": self.right,
+            "start": self.start,
+            "end": self.end,
+        }
+
+    def _build(self) -> dict[str, np.ndarray]:
+        """
+        Build the arrays of the KD-Tree from self.points.
+
+        Like _KDTree._build, the tree is built in place on one array of row indices,
+        splitting the range of every node around its median with np.argpartition.
+        """
+        points = self.points
+        size = len(points)
+        order = np.arange(size)
+        split_axis, split_value, left, right, start, end = [], [], [], [], [], []
+
+        # Ranges still to be turned into nodes, with the node (and side) they hang from
+        ranges = [(0, size, -1, left)]
+        while ranges:
+            lo, hi, parent, side = ranges.pop()
+            node = len(start)
+            if parent != -1:
+                side[parent] = node
+
+            start.append(lo)
+            end.append(hi)
+            left.append(-1)
+            right.append(-1)
+
+            if hi - lo <= self.leaf_size:
+                split_axis.append(0)
+                split_value.append(0.0)
+                continue
+
+            segment = order[lo:hi]
+            block = points[segment]
+            axis = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+            median = (hi - lo) // 2
+            partition = np.argpartition(block[:, axis], median)
+            segment[:] = segment[partition]
+
+            split_axis.append(axis)
+            split_value.append(float(block[partition[median], axis]))
+            ranges.append((lo + median, hi, node, right))
+            ranges.append((lo, lo + median, node, left))
+
+        return {
+            "leaf_points": np.ascontiguousarray(points[order]),
+            "order": order,
+            "split_axis": np.array(split_axis, np.uint8),
+            "split_value": np.array(split_value, np.float64),
+            "left": np.array(left, np.int64),
+            "right": np.array(right, np.int64),
+            "start": np.array(start, np.int64),
+            "end": np.array(end, np.int64),
+        }
+
+    def _search(self, target: tuple[float], n: int, excluded: Container[str] = frozenset()) -> list[tuple[float, int]]:
+        """
+        Return the squared distance and row (in self.points) of the n points closest to
+        target, closest first, skipping the points whose id is in excluded. Ties are
+        broken by row.
 
         Preconditions:
             - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        leaf_points, order, split_axis, split_value, left, right, start, end = \
+            self.leaf_points, self.order, self.split_axis, self.split_value, self.left, self.right, self.start, \
+            self.end
+        query = np.asarray(target, dtype=np.float64)
+
+        # Max-heap of the best points so far, as (-distance, -row)
+        best = []
+        bound = math.inf
+
+        # Nodes still to visit, with a lower bound on their distance to target
+        stack = [(0, 0.0)]
+        while stack:
+            node, lower = stack.pop()
+            if lower > bound:
+                continue
+
+            if left[node] == -1:
+                first = start[node]
+                difference = leaf_points[first:end[node]] - query
+                distances = np.einsum("ij,ij->i", difference, difference)
+                close = np.flatnonzero(distances <= bound)
+                for leaf_row, dist_sq in zip((close + first).tolist(), distances[close].tolist()):
+                    row = order[leaf_row]
+                    if excluded and self.ids[row] in excluded:
+                        continue
+                    if len(best) < n:
+                        heapq.heappush(best, (-dist_sq, -row))
+                    elif (-dist_sq, -row) > best[0]:
+                        heapq.heapreplace(best, (-dist_sq, -row))
+                if len(best) == n:
+                    bound = -best[0][0]
+                continue
+
+            gap = target[split_axis[node]] - split_value[node]
+            near, far = (left[node], right[node]) if gap < 0 else (right[node], left[node])
+            stack.append((far, max(lower, gap * gap)))
+            stack.append((near, lower))
+
+        return sorted((-dist_sq, -row) for dist_sq, row in best)
+
+    def within(self, target: tuple[float], radius: float,
+               excluded: Container[str] = frozenset()) -> Iterator[tuple[float, str]]:
         """
-        def _nn(node, depth, best):
-            if node is None:
-                return best
+        Yield the squared distance and track ID of every point within radius of the target
+        vector, as they are found (not sorted by distance), skipping the track IDs in excluded.
 
-            k = len(target)
-            axis = depth % k
+        Like _KDTree.within, the search keeps the distance from target to the box covered
+        by every node along each axis and skips nodes whose box is further than radius.
+        The points of every leaf left are compared against target as one block.
 
-            next_best = best
-            dist_sq = sum((node.point[i] - target[i]) ** 2 for i in range(k))
-            if best is None or dist_sq < best[1]:
-                next_best = (node.label, dist_sq)
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - radius >= 0
+        """
+        leaf_points, order, split_axis, split_value, left, right, start, end = \
+            self.leaf_points, self.order, self.split_axis, self.split_value, self.left, self.right, self.start, \
+            self.end
+        query = np.asarray(target, dtype=np.float64)
+        limit = radius * radius
+
+        # Nodes still to visit, with the squared distance from target to their box, and
+        # the distance to that box along each axis
+        stack = [(0, 0.0, (0.0,) * len(target))]
+        while stack:
+            node, lower, offsets = stack.pop()
+            if lower > limit:
+                continue
+
+            if left[node] == -1:
+                first = start[node]
+                difference = leaf_points[first:end[node]] - query
+                distances = np.einsum("ij,ij->i", difference, difference)
+                close = np.flatnonzero(distances <= limit)
+                for leaf_row, dist_sq in zip((close + first).tolist(), distances[close].tolist()):
+                    label = self.ids[order[leaf_row]]
+                    if not excluded or label not in excluded:
+                        yield dist_sq, label
+                continue
+
+            axis = split_axis[node]
+            gap = target[axis] - split_value[node]
+            near, far = (left[node], right[node]) if gap < 0 else (right[node], left[node])
+            stack.append((far, lower - offsets[axis] ** 2 + gap * gap, offsets[:axis] + (abs(gap),) + offsets[axis + 1:]))
+            stack.append((near, lower, offsets))
+
+
+class _BruteForce(SearchIndex):
+    """ Exact search comparing the target against every point, with numpy
+
+    Points are compared against the target in blocks (see _block_nearest), straight
+    from the feature matrix shared with the TrackList, keeping only the best candidates
+    of each block, so search time is linear in the number of points but independent of
+    how they are spread out. Only the squared norms of the points are saved. Also serves
+    as the ground truth for the other engines.
+
+    attributes:
+     - features : matrix with one line per feature and one column per point (points,
+       transposed)
+     - norms : squared norm of every point
+    """
+    features: np.ndarray
+    norms: np.ndarray
 
-            next_branch = node.left if target[axis] < node.point[axis] else node.right
-            alt_branch = node.right if target[axis] < node.point[axis] else node.left
+    _VERSION = _INDEX_VERSION
 
-            next_best = _nn(next_branch, depth + 1, next_best)
-            if abs(node.point[axis] - target[axis]) ** 2 < next_best[1]:
-                next_best = _nn(alt_branch, depth + 1, next_best)
+    def _build(self) -> dict[str, np.ndarray]:
+        features = np.ascontiguousarray(self.points.T)
+        return {"norms": np.einsum("ij,ij->j", features, features)}
 
-            return next_best
+    def _attach(self, arrays: dict[str, Sequence]) -> None:
+        # Not a copy when given the C-contiguous feature matrix of a TrackList
+        self.features = np.ascontiguousarray(self.points.T)
+        self.norms = np.frombuffer(arrays["norms"], dtype=np.float64)
 
-        return _nn(self.root, 0, None)[0]
+    def _arrays(self) -> dict[str, Sequence]:
+        return {"norms": self.norms}
 
-    def n_nearest_neighbours(self, target: tuple[float], n: int) -> list[str]:
+    def nearest_batch(self, targets: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
         """
-        Find and return the track IDs of the n closest points to the target vector.
+        Return the rows (indexes into self.ids) and squared distances of the n closest
+        points to each of targets, as two matrices with one line per target, closest
+        first. Ties are broken by row. Missing entries have row -1 and distance inf.
 
         Preconditions:
-            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - targets must be a matrix with one line per target and one column per feature.
             - n must be a positive integer.
         """
-        neighbors = []
+        return _block_nearest(np.asarray(targets, dtype=np.float64), self.features, n, self.norms)
 
-        def _search(node, depth):
-            if node is None:
-                return
+    def _search(self, target: tuple[float], n: int, excluded: Container[str] = frozenset()) -> list[tuple[float, int]]:
+        """
+        Return the squared distance and index (into self.ids) of the n points closest to
+        target, closest first, skipping the points whose id is in excluded. Ties are
+        broken by index.
 
-            k = len(target)
-            axis = depth % k
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
+        """
+        if not len(self):
+            return []
+
+        # Excluded points take up room in the results, ask for more until enough are left
+        count = min(n, len(self))
+        while True:
+            rows, distances = self.nearest_batch(np.array([target]), count)
+            found = [(dist_sq, row) for dist_sq, row in zip(distances[0].tolist(), rows[0].tolist())
+                     if not (excluded and self.ids[row] in excluded)]
+            if len(found) >= n or count == len(self):
+                return found[:n]
+            count = min(2 * count, len(self))
+
+
+# Search algorithms TrackList can be built with
+_ENGINES = {
+    "kdtree": _KDTree,
+    "bucket_kdtree": _BucketKDTree,
+    "hnsw": HNSW,
+    "pq": QuantizedIndex,
+    "brute_force": _BruteForce,
+}
+
+# Engines too slow to build to rebuild parts of a _DynamicIndex with (merged levels of
+# added tracks, and compacted parts), and the engine used for those parts instead
+_REBUILD_ENGINES = {
+    "hnsw": "kdtree",
+}
+
+
+class _IndexPart:
+    """ One static tree of a _DynamicIndex, along with the points removed from it
+
+    Removed points stay in the tree, but every search skips them (see excluded in
+    _KDTree._search), until the part is compacted into a new tree without them.
 
-            dist_sq = sum((node.point[i] - target[i]) ** 2 for i in range(k))
+    attributes:
+     - tree : the static tree, one of the values of _ENGINES
+     - size : number of points in the tree, removed or not
+     - removed : ids of the points removed from the tree
+    """
+    tree: _KDTree | _BucketKDTree | HNSW | QuantizedIndex | _BruteForce
+    size: int
+    removed: set[str]
+
+    def __init__(self, tree, size: int, removed: Optional[set[str]] = None) -> None:
+        self.tree = tree
+        self.size = size
+        self.removed = set() if removed is None else removed
+
+    def get_point(self, id: str) -> Optional[tuple[float]]:
+        """Return the feature vector of the given id if it is in this part and was not removed."""
+        if id in self.removed:
+            return None
+        return self.tree.get_point(id)
 
-            if len(neighbors) < n:
-                neighbors.append((node.label, dist_sq))
-                neighbors.sort(key=lambda x: x[1])
-            elif dist_sq < neighbors[-1][1]:
-                neighbors[-1] = (node.label, dist_sq)
-                neighbors.sort(key=lambda x: x[1])
+    def live_items(self) -> dict[str, tuple[float]]:
+        """Return the points of this part that were not removed, as {id: point}."""
+        return {id: point for id, point in self.tree.items() if id not in self.removed}
 
-            next_branch = node.left if target[axis] < node.point[axis] else node.right
-            alt_branch = node.right if target[axis] < node.point[axis] else node.left
 
-            _search(next_branch, depth + 1)
-            if abs(node.point[axis] - target[axis]) ** 2 < neighbors[-1][1]:
-                _search(alt_branch, depth + 1)
+class _DynamicIndex:
+    """ Search index that accepts new points and removals, on top of a static index such
+    as _KDTree
 
-        _search(self.root, 0)
-        return [label for label, x in neighbors]
+    New points go into a small buffer, which is searched by brute force. When the buffer
+    is full, it is merged with the smallest levels into a new static tree, like carrying
+    in a binary counter: level i is either empty or holds a tree of at most
+    buffer_size * 2 ** i points. Every point is rebuilt into O(log n) trees over its
+    lifetime, for O(log^2 n) amortized time per insert, and searches fan out over the
+    base index, every level and the buffer.
 
+    Removed points are tombstoned: searches skip them as they are found, and they are
+    dropped whenever their level is merged. Once more than compact_fraction of a part
+    (the base index or a level) is removed, a background thread rebuilds that part
+    without them, so searches do not slow down as removals pile up.
 
-class _Brute_Force:
-    """
-    [Depreciated]
-    Not in use anymore, but we keep it for testing/fallback in case kdTree fails to work
+    Updates never modify what searches are reading: they build new trees on the side and
+    then swap in a new (parts, buffer) state in a single assignment. Only updates wait on
+    each other.
 
-    This object is to brute force to find similar tracks
+    attributes:
+     - engine : builds the tree of each part from the ids of its points and their
+       features, as a matrix with one column per point
+     - dimension : number of features of every point
+     - buffer_size : number of points the buffer holds before it is merged into a level
+     - compact_fraction : fraction of removed points above which a part is compacted
+     - _state : (parts, buffer), where parts holds the base index as its first element
+       and then, for every level, None or an _IndexPart (the base index too becomes None
+       once all of its points are removed and it is compacted); buffer is a tuple of
+       (id, point)
+     - _lock : held while updating
+     - _compacting : whether the compaction thread is running
     """
+    engine: Callable[[list[str], np.ndarray], Any]
+    dimension: int
+    buffer_size: int
+    compact_fraction: float
+    _state: tuple[tuple[Optional[_IndexPart], ...], tuple[tuple[str, tuple[float]], ...]]
+    _lock: threading.Lock
+    _compacting: bool
+
+    def __init__(self, base, engine: Callable[[list[str], np.ndarray], Any], removed: Optional[set[str]] = None,
+                 buffer_size: int = 128, compact_fraction: float = 0.2) -> None:
+        """
+        Initialize the index over the static index base, building new trees with engine.
+        The ids in removed are points of base that start out removed.
 
-    points: list[_Point]
+        Preconditions:
+            - engine must build one of the values of _ENGINES (possibly with options
+              bound), usually the same kind of index as base.
+            - buffer_size must be a positive integer.
+            - 0 < compact_fraction < 1
+        """
+        self.engine = engine
+        self.dimension = base.points.shape[1]
+        self.buffer_size = buffer_size
+        self.compact_fraction = compact_fraction
+        self._state = ((_IndexPart(base, len(base), removed),), ())
+        self._lock = threading.Lock()
+        self._compacting = False
+        with self._lock:
+            self._start_compaction(self._state[0][0])
+
+    def _tree(self, points: dict[str, tuple[float]]):
+        """Return a new tree, built with engine, over the given points, as {id: point}."""
+        features = np.array(list(points.values()), dtype=np.float64).reshape(len(points), self.dimension)
+        return self.engine(list(points), features.T)
+
+    def _start_compaction(self, part: _IndexPart) -> None:
+        """
+        Start compacting in the background if more than compact_fraction of the points of
+        part are removed, and no compaction is running yet. Must be called with _lock held.
+        """
+        if len(part.removed) > self.compact_fraction * part.size and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self._compact, daemon=True).start()
 
-    def __init__(self, points:dict[str, tuple[float]]):
+    def insert(self, id: str, point: tuple[float]) -> None:
         """
-        Initialize the brute force search algorithm.
+        Add the point with the given id to the index.
 
         Preconditions:
-            - points must be a dictionary mapping track IDs (str) to non-empty tuples of floats.
+            - id must not already be in the index (it may have been removed).
+            - point must have the same dimension as the other points in the index.
+        """
+        with self._lock:
+            parts, buffer = self._state
+            buffer += ((id, point),)
+
+            if len(buffer) < self.buffer_size:
+                self._state = (parts, buffer)
+                return
+
+            # Carry the buffer into the first empty level, merging every level below it
+            merged = {}
+            level = 1
+            while level < len(parts) and parts[level] is not None:
+                merged.update(parts[level].live_items())
+                level += 1
+            merged.update(buffer)
+
+            new_part = _IndexPart(self._tree(merged), len(merged))
+            self._state = (parts[:1] + (None,) * (level - 1) + (new_part,) + parts[level + 1:], ())
+
+    def remove(self, id: str) -> bool:
+        """
+        Remove the point with the given id from the index. Return whether it was found.
         """
-        id_so_far = []
-        points_formatted = []
+        with self._lock:
+            parts, buffer = self._state
+
+            if any(label == id for label, _ in buffer):
+                self._state = (parts, tuple(item for item in buffer if item[0] != id))
+                return True
 
-        for x in points:
-            if x not in id_so_far:
-                points_formatted.append(_Point(points[x], x))
+            for part in parts:
+                if part is not None and part.get_point(id) is not None:
+                    part.removed.add(id)
+                    self._start_compaction(part)
+                    return True
 
-        self.points = points_formatted
+            return False
 
-    def get_point(self, id) -> _Point:
+    def _compact(self) -> None:
         """
-        Retrieve the _Point object associated with the given track ID.
+        Rebuild the first part with more than compact_fraction of its points removed, then
+        start compacting again if a part still needs it. Runs on a background thread.
+        """
+        with self._lock:
+            parts, _ = self._state
+            stale = [i for i, part in enumerate(parts) if part is not None
+                     and len(part.removed) > self.compact_fraction * part.size]
+            if not stale:
+                self._compacting = False
+                return
+            index = stale[0]
+            part = parts[index]
+            removed = set(part.removed)
+
+        # Build the new tree without holding the lock, removals made in the meantime are
+        # carried over below. A part with every point removed becomes empty (None)
+        try:
+            live = {id: point for id, point in part.tree.items() if id not in removed}
+            compacted = _IndexPart(self._tree(live), len(live)) if live else None
+        except BaseException:
+            with self._lock:
+                self._compacting = False
+            raise
+
+        with self._lock:
+            parts, buffer = self._state
+            if parts[index] is part:
+                if compacted is not None:
+                    compacted.removed = part.removed - removed
+                parts = parts[:index] + (compacted,) + parts[index + 1:]
+                self._state = (parts, buffer)
+
+            # Removals that found this compaction running did not start one, so check
+            # every part again before anything else can see it finished
+            self._compacting = False
+            for part in parts:
+                if part is not None:
+                    self._start_compaction(part)
+
+    def get_point(self, id) -> tuple[float]:
+        """
+        Retrieve the feature vector associated with the given track ID.
 
         Preconditions:
             - id must be a non-empty string.
         """
+        parts, buffer = self._state
+        for label, point in buffer:
+            if label == id:
+                return point
 
-        for p in self.points:
-            if id == p.name:
-                return p
+        for part in parts:
+            if part is not None:
+                point = part.get_point(id)
+                if point is not None:
+                    return point
 
         return None
 
-    def find_similar(self, point: _Point) -> str:
+    def nearest_with_distances(self, target: tuple[float], n: int,
+                               track_filter: Optional[BoundFilter] = None) -> list[tuple[float, str]]:
         """
-        Find and return the track ID of the _Point closest to the given point.
+        Return the squared distance and track ID of the n closest points to the target
+        vector that pass track_filter (if given), closest first. Ties are broken by where
+        the points are stored (base index first, buffer last), then by the order of each
+        part.
 
-        Note: Uses brute force with O(n) time complexity, where n is len(self.points).
+        Trees that can skip the parts of themselves in which no track passes
+        track_filter (see _KDTree.filtered_nearest_with_distances) are asked to.
 
         Preconditions:
-            - point must be an instance of _Point.
-            - point.vector must have the same dimension as other points.
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
         """
-        current_distance = 9999
-        current_id = ""
+        parts, buffer = self._state
+
+        candidates = []
+        for number, part in enumerate(parts):
+            if part is None:
+                continue
+            if track_filter is None:
+                found = part.tree.nearest_with_distances(target, n, part.removed)
+            else:
+                excluded = _AnyOf((part.removed, track_filter))
+                search = getattr(part.tree, "filtered_nearest_with_distances", None)
+                if search is not None:
+                    found = search(target, n, excluded, track_filter)
+                else:
+                    found = part.tree.nearest_with_distances(target, n, excluded)
+            candidates.extend((dist_sq, number, position, label) for position, (dist_sq, label) in enumerate(found))
+        for position, (label, point) in enumerate(buffer):
+            if track_filter is not None and label in track_filter:
+                continue
+            dist_sq = sum((p - t) ** 2 for p, t in zip(point, target))
+            candidates.append((dist_sq, len(parts), position, label))
+
+        if len(candidates) > n:
+            candidates = heapq.nsmallest(n, candidates)
+        else:
+            candidates.sort()
+        return [(dist_sq, label) for dist_sq, x, y, label in candidates]
 
-        p = self.points[0]
+    def nearest_neighbour(self, target) -> str:
+        """
+        Find and return the track ID of the point in the index closest to the target vector.
 
-        for p in self.points:
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+        """
+        return self.n_nearest_neighbours(target, 1)[0]
 
-            distance = point.euclidiean_distance(p)
-            if distance < current_distance and p.name != point.name:
-                current_distance = distance
-                current_id = p.name
+    def within(self, target: tuple[float], radius: float) -> Iterator[tuple[float, str]]:
+        """
+        Yield the squared distance and track ID of every point within radius of the target
+        vector, as they are found (not sorted by distance).
 
-        return current_id
+        Every tree searches its own points (see SearchIndex.within). Updates made while the
+        results are consumed are not seen.
 
-    def find_multiple_similar(self, point: _Point, count:int) -> list[str]:
+        Preconditions:
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - radius >= 0
+        """
+        parts, buffer = self._state
+        limit = radius * radius
+
+        for part in parts:
+            if part is not None:
+                yield from part.tree.within(target, radius, part.removed)
+        for label, point in buffer:
+            dist_sq = sum((p - t) ** 2 for p, t in zip(point, target))
+            if dist_sq <= limit:
+                yield dist_sq, label
+
+    def n_nearest_neighbours(self, target: tuple[float], n: int,
+                             track_filter: Optional[BoundFilter] = None) -> list[str]:
         """
-        Find and return a list of track IDs for the count closest points to the given point.
+        Find and return the track IDs of the n closest points to the target vector that
+        pass track_filter (if given).
 
         Preconditions:
-            - point must be an instance of _Point.
-            - count must be a positive integer.
+            - target must be a non-empty tuple of floats with the same dimension as the feature vectors.
+            - n must be a positive integer.
         """
-        distance_dict = {p.name: point.euclidiean_distance(p) for p in self.points}
-        distance_dict.pop(point.name)
-
-        sorted_list = sorted(distance_dict, key = lambda k:distance_dict[k])
+        return [label for x, label in self.nearest_with_distances(target, n, track_filter)]
 
-        return sorted_list[:count]
 
+class _AnyOf:
+    """ Container of the items that are in any of the given containers
 
-class _Point:
-    """Helper object to represent one vector point, used in _KdTree"""
-    vector: tuple[float]
-    name: str
-
-    def __init__(self, vector: tuple[float], name: str):
-        self.vector = vector
-        self.name = name
+    attributes:
+     - containers : the containers looked into, in order
+    """
+    containers: tuple[Container, ...]
 
-    def __str__(self) -> str:
-        return f"{self.name}: " + str(self.vector)
+    def __init__(self, containers: tuple[Container, ...]) -> None:
+        self.containers = containers
 
-    def euclidiean_distance(self, comparison: _Point) -> float:
-        """
-        Return distance from self to the comparison point.
+    def __contains__(self, item) -> bool:
+        return any(item in container for container in self.containers)
 
-        Pre-conditions:
-            - len(self.vector) == len(comparison.vector)
-            - len(self.vector) > 0
-        """
 
-        v1 = self.vector
-        v2 = comparison.vector
+def _block_nearest(queries: np.ndarray, features: np.ndarray, count: int, norms: Optional[np.ndarray] = None,
+                   removed: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the rows and squared distances of the count points closest to each query, as
+    two matrices with one line per query, closest first. Ties are broken by row. If there
+    are fewer than count points, the missing entries have row -1 and distance inf.
+
+    If removed is given, points whose entry in removed is True are skipped. Like the
+    exact distances, this is only looked up for the points that pass the screening.
+
+    Queries are compared against the points in blocks of _QUERY_BLOCK queries by
+    _POINT_BLOCK points, so memory use stays bounded. Each block is first screened with a
+    single matrix product, using |q - p|^2 = |q|^2 + |p|^2 - 2 q.p, and only the points
+    that can still make a query's top count get their exact distance computed and merged
+    into the results.
+
+    Preconditions:
+        - queries must be a matrix with one line per query and one column per feature.
+        - features must be a matrix with one line per feature and one column per point.
+        - norms, if given, must hold the squared norm of every column of features.
+        - removed, if given, must hold one boolean per column of features.
+        - count must be a positive integer.
+    """
+    if norms is None:
+        norms = np.einsum("ij,ij->j", features, features)
+    half_norms = norms / 2
+    size = features.shape[1]
+
+    rows = np.full((len(queries), count), -1, np.int64)
+    distances = np.full((len(queries), count), np.inf)
+
+    for first_query in range(0, len(queries), _QUERY_BLOCK):
+        block = queries[first_query:first_query + _QUERY_BLOCK]
+        best_rows = rows[first_query:first_query + _QUERY_BLOCK]
+        best_distances = distances[first_query:first_query + _QUERY_BLOCK]
+        block_norms = np.einsum("ij,ij->i", block, block)
+
+        # Largest rounding error of a screened distance, for each query
+        tolerance = (block_norms + norms.max(initial=0.0)) * 1e-10
+
+        for first_point in range(0, size, _POINT_BLOCK):
+            chunk = features[:, first_point:first_point + _POINT_BLOCK]
+
+            # Half the squared distance to every point of the chunk, less half of |q|^2
+            screened = half_norms[first_point:first_point + chunk.shape[1]] - block @ chunk
+
+            # Only points within the count-th best distance so far can make the cut
+            bound = best_distances[:, -1]
+            if np.isinf(bound).any() and chunk.shape[1] >= count:
+                if removed is not None:
+                    screened[:, removed[first_point:first_point + chunk.shape[1]]] = np.inf
+                kth = 2 * np.partition(screened, count - 1, axis=1)[:, count - 1] + block_norms
+                bound = np.minimum(bound, kth + tolerance)
+            threshold = (bound + tolerance - block_norms) / 2
+            query, point = np.divmod(np.flatnonzero(screened <= threshold[:, None]), chunk.shape[1])
+            if removed is not None:
+                alive = ~removed[point + first_point]
+                query, point = query[alive], point[alive]
+            if len(query) == 0:
+                continue
+
+            difference = chunk[:, point] - block[query].T
+            exact = np.einsum("ij,ij->j", difference, difference)
+
+            # Merge the new candidates with the best so far, ordering by (query, distance, row)
+            query = np.concatenate([np.repeat(np.arange(len(block)), count), query])
+            candidate_rows = np.concatenate([best_rows.ravel(), point + first_point])
+            candidate_distances = np.concatenate([best_distances.ravel(), exact])
+            ranked = np.lexsort((candidate_rows, candidate_distances, query))
+
+            query = query[ranked]
+            rank = np.arange(len(query)) - np.searchsorted(query, query)
+            kept = ranked[rank < count]
+            best_rows[:] = candidate_rows[kept].reshape(len(block), count)
+            best_distances[:] = candidate_distances[kept].reshape(len(block), count)
+
+    return rows, distances
+
+
+def _merge_nearest(rows: np.ndarray, distances: np.ndarray, other_rows: np.ndarray,
+                   other_distances: np.ndarray, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merge two results of _block_nearest for the same queries (over different points) into
+    one, keeping the count closest points of each query, ordered by (distance, row).
+    """
+    rows = np.concatenate([rows, other_rows], axis=1)
+    distances = np.concatenate([distances, other_distances], axis=1)
 
-        sum_so_far = 0.0
+    # Missing entries (row -1) have to stay after every real one
+    keys = np.where(rows == -1, np.iinfo(np.int64).max, rows)
+    ranked = np.lexsort((keys, distances), axis=1)[:, :count]
 
-        for i in range(len(v1)):
-            sum_so_far += (v1[i]-v2[i]) ** 2
+    return np.take_along_axis(rows, ranked, axis=1), np.take_along_axis(distances, ranked, axis=1)
 
-        return sum_so_far ** 0.5
 
 if __name__ == "__main__":
     tk = TrackList("dataset.csv")